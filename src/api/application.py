@@ -2,9 +2,14 @@
 from .controllers.knowledge_bases import knowledge_bases_blueprint
 from .controllers.answers import answers_blueprint
 from .controllers.chunks import chunks_blueprint
+from .controllers.health import health_blueprint
+from .controllers.metrics import metrics_blueprint
+from .controllers import sockets  # Registers the Socket.IO handlers
 from api.server_application import app
 
 
 app.register_blueprint(knowledge_bases_blueprint)
 app.register_blueprint(chunks_blueprint)
 app.register_blueprint(answers_blueprint)
+app.register_blueprint(health_blueprint)
+app.register_blueprint(metrics_blueprint)
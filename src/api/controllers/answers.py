@@ -1,18 +1,29 @@
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Literal, Optional, TypedDict, Union, cast
 
-import json
-from typing import Literal, TypedDict, Union, cast
+import numpy as np
 
 from flask import jsonify, request
 from flask import Blueprint
 from api.controllers.utils.language import get_language_name
+from api.server_application import socketio
 
 from custom_types import Wisdom
-from .utils.chunks import group_chunks_by_resource_id, order_and_sew_info_chunks
+from .utils.context_builder import count_tokens, pack_context
 
 from config import settings
+from services.answer_cache import CachedAnswer, answer_cache
+from services.embeddings_batcher import embeddings_batcher
 from services.embeddings_calculator import EmbeddingsCalculator
-from services.embeddings_store import CollectionEmbeddingsStore, ResourceChunkInfo
-from services.llm_provider import LlmProvider
+from services.embeddings_store import ResourceChunkInfo
+from services.llm_event_loop import wait_for_future
+from services.llm_provider import LlmProvider, parse_search_query
+from services.llm_stream_handler import LlmStreamHandler
+from services.metrics import PROMPT_BUILD_STAGE, prompt_tokens, record_stage
+from services.reranking import rerank_chunks, reranking_candidates
+from services.retrieval import search_chunks, search_chunks_batch
 
 from logger import logger
 
@@ -22,6 +33,10 @@ class ConversationEntry(TypedDict):
     sender: Literal['USER, AI_ENGINE']
     content: str
 
+class BatchQuestion(TypedDict):
+    question: str
+    reference: str
+
 @answers_blueprint.route('/answer-request', methods=['POST'])
 def add_answer_request():
     request_data = request.get_json()
@@ -29,65 +44,228 @@ def add_answer_request():
     knowledge_base_id = request_data['knowledge_base_id']
     question = request_data['question']
     reference: str = request_data['reference']
+    session_id: Optional[str] = request_data.get('session_id')
+
+    language = request_data['language'] if 'language' in request_data else None
+    wisdom_level: Wisdom = Wisdom[request_data['wisdom_level']] if 'wisdom_level' in request_data else Wisdom.MEDIUM
+
+    start_time = time.time()
+    knowledge_base_version = answer_cache.version(knowledge_base_id)
+    n_similar_chunks = wisdom_to_n_similar_chunks(wisdom_level)
+    n_candidate_chunks = reranking_candidates(n_similar_chunks)
+    prefetched_chunks_with_similarity: list[tuple[ResourceChunkInfo, float]] = []
 
     if past_conversation is not None:
-        search_query = get_search_query_from_conversation(question, past_conversation)
+        # The raw question is embedded and searched while the search query is being rewritten
+        search_query_future = start_search_query_from_conversation(question, past_conversation)
+        question_embedding = embeddings_batcher.embed_query(question)
+        prefetched_chunks_with_similarity = search_chunks(knowledge_base_id, question, question_embedding, n_candidate_chunks, wisdom_level)
+        search_query = rewrite_search_query(search_query_future, question)
+        search_query_embedding = question_embedding if search_query == question else embeddings_batcher.embed_query(search_query)
     else:
         search_query = question
+        search_query_embedding = embeddings_batcher.embed_query(search_query)
+
+    logger.info(f"Search query: {search_query}")
+
+    # Answers to follow up questions depend on the conversation, so only standalone questions are cached
+    use_answer_cache = answer_cache.enabled and past_conversation is None
+
+    if use_answer_cache:
+        cached_answer = answer_cache.lookup(knowledge_base_id, wisdom_level, language, search_query_embedding)
+
+        if cached_answer is not None:
+            LlmStreamHandler(reference, session_id).replay_tokens(cached_answer.tokens)
+
+            return jsonify({
+                'answer': cached_answer.answer,
+                'sources': cached_answer.sources
+            }), 200
+
+    # The chunks found for the raw question are only used when the question could not be rewritten. They answer
+    # a question without its conversation, so mixing them into the chunks of the rewritten query adds noise
+    if past_conversation is not None and search_query == question:
+        similar_chunks_with_similarity = prefetched_chunks_with_similarity
+    else:
+        similar_chunks_with_similarity = search_chunks(knowledge_base_id, search_query, search_query_embedding, n_candidate_chunks, wisdom_level)
+
+    similar_chunks_with_similarity = rerank_chunks(
+        knowledge_base_id,
+        search_query,
+        search_query_embedding,
+        similar_chunks_with_similarity,
+        n_similar_chunks
+    )
+
+    response, sources = answer_from_chunks(
+        knowledge_base_id,
+        knowledge_base_version,
+        question,
+        reference,
+        session_id,
+        similar_chunks_with_similarity,
+        past_conversation,
+        language,
+        wisdom_level,
+        search_query_embedding if use_answer_cache else None,
+        start_time
+    )
+
+    return jsonify({
+        'answer': response,
+        'sources': sources
+    }), 200
+
+
+@answers_blueprint.route('/answer-requests', methods=['POST'])
+def add_answer_requests():
+    # Answers several standalone questions about one knowledge base, sharing the embedding and retrieval work.
+    # Answers are streamed per reference as usual and returned together once all of them are done
+    request_data = request.get_json()
+    knowledge_base_id = request_data['knowledge_base_id']
+    questions = cast(list[BatchQuestion], request_data['questions'])
+    session_id: Optional[str] = request_data.get('session_id')
+
+    if len(questions) == 0:
+        return 'Missing questions', 400
+
+    if len(questions) > settings.batch_answers.max_questions:
+        return f"Too many questions, at most {settings.batch_answers.max_questions} are allowed", 400
 
     language = request_data['language'] if 'language' in request_data else None
     wisdom_level: Wisdom = Wisdom[request_data['wisdom_level']] if 'wisdom_level' in request_data else Wisdom.MEDIUM
 
-    logger.info(f"Search query: {search_query}")
+    start_time = time.time()
+    knowledge_base_version = answer_cache.version(knowledge_base_id)
+    n_similar_chunks = wisdom_to_n_similar_chunks(wisdom_level)
+    question_embeddings = EmbeddingsCalculator().embed_documents([entry['question'] for entry in questions])
+    answers: list[Optional[dict[str, Any]]] = [None] * len(questions)
+    pending_indexes: list[int] = []
 
-    embeddings_store = CollectionEmbeddingsStore(collection_name=knowledge_base_id)
-    embeddings_store.setup() 
+    for i, entry in enumerate(questions):
+        cached_answer = answer_cache.lookup(knowledge_base_id, wisdom_level, language, question_embeddings[i]) if answer_cache.enabled else None
 
-    embeddings_calculator = EmbeddingsCalculator()
-    search_query_embeddings = embeddings_calculator.embed_documents([search_query])
-
-    def wisdom_to_n_similar_chunks(wisdom: Wisdom) -> int:
-        if wisdom == Wisdom.MEDIUM:
-            return 7
-        elif wisdom == Wisdom.HIGH:
-            return 12
-        elif wisdom == Wisdom.VERY_HIGH:
-            return 12
+        if cached_answer is not None:
+            LlmStreamHandler(entry['reference'], session_id).replay_tokens(cached_answer.tokens)
+            answers[i] = { 'reference': entry['reference'], 'answer': cached_answer.answer, 'sources': cached_answer.sources }
         else:
-            raise ValueError(f"Unknown wisdom level: {wisdom}")
+            pending_indexes.append(i)
+
+    chunks_per_question = search_chunks_batch(
+        knowledge_base_id,
+        [questions[i]['question'] for i in pending_indexes],
+        question_embeddings[pending_indexes],
+        reranking_candidates(n_similar_chunks),
+        wisdom_level
+    ) if len(pending_indexes) > 0 else []
+
+    pending_answers = deque(zip(pending_indexes, chunks_per_question))
+    active_workers = min(settings.batch_answers.max_concurrent_llm_calls, len(pending_answers))
+    all_answered = socketio.server.eio.create_event()
+
+    # At most max_concurrent_llm_calls answers are generated at a time, the last worker to finish wakes the request
+    def work():
+        nonlocal active_workers
+
+        while len(pending_answers) > 0:
+            i, candidate_chunks_with_similarity = pending_answers.popleft()
+            reference = questions[i]['reference']
+
+            try:
+                similar_chunks_with_similarity = rerank_chunks(
+                    knowledge_base_id,
+                    questions[i]['question'],
+                    question_embeddings[i],
+                    candidate_chunks_with_similarity,
+                    n_similar_chunks
+                )
+                response, sources = answer_from_chunks(
+                    knowledge_base_id,
+                    knowledge_base_version,
+                    questions[i]['question'],
+                    reference,
+                    session_id,
+                    similar_chunks_with_similarity,
+                    None,
+                    language,
+                    wisdom_level,
+                    question_embeddings[i] if answer_cache.enabled else None,
+                    start_time
+                )
+                answers[i] = { 'reference': reference, 'answer': response, 'sources': sources }
+            except Exception as e:
+                logger.exception(f"Failed to answer question {reference}")
+
+                answers[i] = { 'reference': reference, 'error': str(e) }
+
+        active_workers -= 1
+
+        if active_workers == 0:
+            all_answered.set()
+
+    for _ in range(active_workers):
+        socketio.start_background_task(work)
+
+    if active_workers > 0:
+        all_answered.wait()
+
+    logger.info(f"Answered {len(questions)} questions about knowledge base {knowledge_base_id} in {time.time() - start_time:.2f} seconds")
 
-    similar_chunks_with_similarity = embeddings_store.search_similar_chunks(
-        search_query_embeddings[0],
-        limit=wisdom_to_n_similar_chunks(wisdom_level)
-    )
-    similar_chunks_with_similarity: list[tuple[ResourceChunkInfo, float]] = list(filter(lambda x: x[1] > settings.answers.minimum_trustable_similarity, similar_chunks_with_similarity))
-    similar_chunks = list(map(lambda x: x[0], similar_chunks_with_similarity))
+    return jsonify({
+        'answers': answers
+    }), 200
+
+
+def answer_from_chunks(
+    knowledge_base_id: str,
+    knowledge_base_version: int,
+    question: str,
+    reference: str,
+    session_id: Optional[str],
+    similar_chunks_with_similarity: list[tuple[ResourceChunkInfo, float]],
+    past_conversation: Union[list[ConversationEntry], None],
+    language: Union[str, None],
+    wisdom_level: Wisdom,
+    cache_embedding: Optional[np.ndarray],
+    start_time: float
+) -> tuple[str, list[dict[str, Any]]]:
+    # Streams the answer to the clients subscribed to reference, or to session_id when given, and returns it with
+    # its sources. It is stored in the answer cache under cache_embedding, when given
+    similar_chunks_with_similarity = list(filter(lambda x: x[1] > settings.answers.minimum_trustable_similarity, similar_chunks_with_similarity))
 
-    prompt = build_qa_llm_prompt(question, similar_chunks, past_conversation, language)
+    prompt, similar_chunks = build_qa_llm_prompt(question, similar_chunks_with_similarity, past_conversation, language, wisdom_level)
 
     logger.debug(f"Prompt: {prompt}")
 
+    stream_handler = LlmStreamHandler(reference, session_id)
     llm = LlmProvider();
-    response = llm.request_answer(prompt, reference, wisdom_level)
+    response = llm.request_answer(prompt, reference, wisdom_level, stream_handler)
 
     sources = []
     for chunk in similar_chunks:
-        payload = json.loads(chunk['payload'])
         sources.append({
-            'chunk_id': str(chunk['id']),
-            'file_name': chunk['resource_name'],
-            'resource_name': chunk['resource_name'],
-            'resource_id': chunk['resource_id'],
-            'chunk_number': payload['chunk_number'],
-            'percentage_in': payload['percentage_in'],
-            'resource_mimetype': payload['resource_mimetype'],
-            'page_index': payload['page_index']
+            'chunk_id': str(chunk.id),
+            'file_name': chunk.resource_name,
+            'resource_name': chunk.resource_name,
+            'resource_id': chunk.resource_id,
+            'chunk_number': chunk.chunk_number,
+            'percentage_in': chunk.percentage_in,
+            'resource_mimetype': chunk.resource_mimetype,
+            'page_index': chunk.page_index
         });
 
-    return jsonify({
-        'answer': response,
-        'sources': sources
-    }), 200
+    if cache_embedding is not None:
+        answer_cache.store(knowledge_base_id, knowledge_base_version, CachedAnswer(
+            cache_embedding,
+            wisdom_level,
+            language,
+            response,
+            sources,
+            stream_handler.tokens,
+            time.time() - start_time
+        ))
+
+    return response, sources
 
 
 
@@ -103,44 +281,91 @@ def build_search_query_prompt(question: str, past_conversation: list[Conversatio
 
     return prompt
 
-def get_search_query_from_conversation(question: str, past_conversation: list[ConversationEntry]) -> str:
+def start_search_query_from_conversation(question: str, past_conversation: list[ConversationEntry]) -> 'Future[str]':
     prompt = build_search_query_prompt(question, past_conversation)
 
     llm = LlmProvider()
-    response = llm.get_search_query(prompt)
 
-    return response
+    return llm.start_search_query(prompt)
+
+def get_search_query_from_conversation(question: str, past_conversation: list[ConversationEntry]) -> str:
+    return rewrite_search_query(start_search_query_from_conversation(question, past_conversation), question)
+
+
+def rewrite_search_query(search_query_future: 'Future[str]', question: str) -> str:
+    # Falls back to the question itself when the rewrite fails, times out or returns nothing
+    try:
+        return parse_search_query(wait_for_future(search_query_future, settings.llm.search_query_timeout), question)
+    except Exception:
+        logger.exception("Failed to rewrite the search query, searching for the question itself")
+
+        return question
+
+
+def wisdom_to_n_similar_chunks(wisdom: Wisdom) -> int:
+    # About as many chunks as fit in the context of the model, assuming 4 characters per token.
+    # The prompt builder then packs what really fits
+    context_tokens = LlmProvider().context_window(wisdom) - settings.prompt.answer_tokens
+    chunk_tokens = settings.chunking.chunk_size // 4
+
+    return max(settings.prompt.min_chunks, min(settings.prompt.max_chunks, context_tokens // chunk_tokens))
 
 
 def build_qa_llm_prompt(
     question: str,
-    relevant_info_chunks: list[ResourceChunkInfo],
+    relevant_chunks_with_similarity: list[tuple[ResourceChunkInfo, float]],
     past_conversation: Union[list[ConversationEntry], None],
-    language: Union[str, None] = None
-) -> str:
-    grouped_chunks = group_chunks_by_resource_id(relevant_info_chunks)
-    context = ""
-
-    for resource_id, chunks in grouped_chunks.items():
-        resource_name = chunks[0]['resource_name']
-
-        rearranged_info_chunks = order_and_sew_info_chunks(chunks)
-        resource_info = "".join([
-            f"{segment['data']}\n[...]\n"
-            for i, segment in enumerate(rearranged_info_chunks)
-        ])
-        
-        context += f"<<SOURCE {resource_name}>>\n{resource_info}\n<</SOURCE {resource_name}>>\n"
-
-    previous_conversation = ""
-    if past_conversation is not None:
-        for entry in past_conversation[-5:]:
-            previous_conversation += f"{entry['sender']}: {entry['content']}\n"
-
-    previous_conversation_part = f"<<PREVIOUS_CONVERSATION>>\n{previous_conversation}<</PREVIOUS_CONVERSATION>>"
+    language: Union[str, None] = None,
+    wisdom_level: Wisdom = Wisdom.MEDIUM
+) -> tuple[str, list[ResourceChunkInfo]]:
+    # Returns the prompt and the chunks that made it into its sources
+    start_time = time.perf_counter()
+    llm = LlmProvider()
+    model_name = llm.model_name(wisdom_level)
+    conversation_entries = past_conversation[-5:] if past_conversation is not None else []
     language_part = "The answer must be in the same language as the question (no need to mention the language in the answer)."
 
     if language is not None:
         language_part = f"The answer must be in {get_language_name(language)} (no need to mention the language in the answer)."
 
-    return f"<<PREVIOUS_CONVERSATION>>\n{previous_conversation}<</PREVIOUS_CONVERSATION>>\n\n<<SOURCES>>\n{context}<</SOURCES>>\n\n{previous_conversation_part}<<QUESTION>>\n{question}\n<</QUESTION>>\n\nInstruction: First, detect the language of the text inside <<QUESTION>> tags. Then, thoroughly answer the question having into account the past conversation using only information from the sources and nothing else. {language_part} If the answer can't be determined from the sources or you are not sure it can, explain you don't know. Use of markdown to format the answer is encouraged, titles, lits, tables, bolds, italics, code blocks etc are allowed."
\ No newline at end of file
+    question_part = f"<<QUESTION>>\n{question}\n<</QUESTION>>\n\n"
+    instruction_part = f"Instruction: First, detect the language of the text inside <<QUESTION>> tags. Then, thoroughly answer the question having into account the past conversation using only information from the sources and nothing else. {language_part} If the answer can't be determined from the sources or you are not sure it can, explain you don't know. Use of markdown to format the answer is encouraged, titles, lits, tables, bolds, italics, code blocks etc are allowed."
+    fixed_tokens = count_tokens(question_part + instruction_part + "<<SOURCES>>\n<</SOURCES>>\n\n", model_name)
+    sources_budget = llm.context_window(wisdom_level) - settings.prompt.answer_tokens - fixed_tokens
+
+    # The oldest conversation entries are dropped when they would leave too little room for sources
+    while True:
+        previous_conversation_part = "".join([
+            "<<PREVIOUS_CONVERSATION>>\n",
+            *[f"{entry['sender']}: {entry['content']}\n" for entry in conversation_entries],
+            "<</PREVIOUS_CONVERSATION>>\n\n"
+        ])
+        context_budget = sources_budget - count_tokens(previous_conversation_part, model_name)
+
+        if context_budget >= settings.prompt.min_context_tokens or len(conversation_entries) == 0:
+            break
+
+        conversation_entries = conversation_entries[1:]
+
+    context = pack_context(relevant_chunks_with_similarity, model_name, context_budget)
+
+    logger.debug(
+        f"Packed {len(context.chunks)} of {len(relevant_chunks_with_similarity)} chunks into {context.tokens} "
+        f"of {context_budget} context tokens for {model_name}"
+    )
+
+    prompt = "".join([
+        previous_conversation_part,
+        "<<SOURCES>>\n",
+        context.text,
+        "<</SOURCES>>\n\n",
+        question_part,
+        instruction_part
+    ])
+    total_tokens = fixed_tokens + sources_budget - context_budget + context.tokens
+
+    prompt_tokens.observe(context.tokens, 'sources')
+    prompt_tokens.observe(total_tokens, 'prompt')
+    record_stage(PROMPT_BUILD_STAGE, time.perf_counter() - start_time, tokens=total_tokens, source_tokens=context.tokens, chunks=len(context.chunks))
+
+    return prompt, context.chunks
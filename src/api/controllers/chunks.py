@@ -1,11 +1,9 @@
-
-import json
-
 from flask import request
 from flask import Blueprint
 from .utils.chunks import group_chunks_by_resource_id, order_and_sew_info_chunks
 
-from services.embeddings_store import CollectionEmbeddingsStore, ResourceChunkInfo
+from services.embeddings_store import ResourceChunkInfo
+from services.embeddings_store_registry import embeddings_stores
 
 chunks_blueprint = Blueprint('chunks', __name__)
 
@@ -23,9 +21,8 @@ def retrieve_chunks():
     chunk_ids = request_body['chunk_ids']
     knowledge_base_id = request_body['knowledge_base_id']
 
-    embeddings_store = CollectionEmbeddingsStore(collection_name=knowledge_base_id)
-    embeddings_store.setup(True)
-    chunks_data = embeddings_store.get_chunks_data(chunk_ids)
+    with embeddings_stores.lease_store(knowledge_base_id, create_index=True) as embeddings_store:
+        chunks_data = embeddings_store.get_chunks_data(chunk_ids)
 
     grouped_chunks = group_chunks_by_resource_id(chunks_data)
 
@@ -39,8 +36,10 @@ def retrieve_chunks():
 
     return {
         'chunks_data': [{
-            **chunk_data,
-            'id': str(chunk_data['id']),
-            'payload': json.loads(chunk_data['payload'])
+            'id': str(chunk_data.id),
+            'resource_name': chunk_data.resource_name,
+            'resource_id': chunk_data.resource_id,
+            'data': chunk_data.data,
+            'payload': chunk_data.payload()
         } for chunk_data in all_chunks]
     }, 200
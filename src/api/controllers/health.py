@@ -0,0 +1,15 @@
+from flask import Blueprint
+
+from services.warmup import service_warmup
+
+health_blueprint = Blueprint('health', __name__)
+
+@health_blueprint.route('/health', methods=['GET'])
+def get_health():
+    return 'OK', 200
+
+
+@health_blueprint.route('/ready', methods=['GET'])
+def get_readiness():
+    # Ready once the embeddings model, the Milvus connection and the rest of the warmup steps are loaded
+    return service_warmup.to_dict(), 200 if service_warmup.ready() else 503
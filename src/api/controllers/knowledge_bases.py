@@ -1,17 +1,23 @@
 
 import json
+import mimetypes
 import os
+import shutil
+import tarfile
 import tempfile
-import time
+import zipfile
+from typing import Iterator
 
 from flask import request
 from flask import Blueprint
-from langchain.document_loaders import UnstructuredFileLoader, PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from werkzeug.datastructures import FileStorage
 
 from config import settings
-from services.embeddings_calculator import EmbeddingsCalculator
-from services.embeddings_store import ResourceChunkInfo, CollectionEmbeddingsStore
+from services.answer_cache import answer_cache
+from services.embeddings_store_registry import embeddings_stores
+from services.lexical_index import lexical_indexes
+from services.ingestion_jobs import IngestionJob, IngestionQueueFullError, ingestion_job_queue
+from services.resource_ingestion import ResourceLimitExceededError, ResourceUpload, ingest_resource, ingest_resources
 from logger import logger
 
 knowledge_bases_blueprint = Blueprint('knowledge_base', __name__)
@@ -22,105 +28,143 @@ def assimilate_resource(knowledge_base_id: str, resource_id: str):
         return 'Missing file', 400
 
     file = request.files['file']
-    resource_name = file.filename
+    resource_name = str(file.filename)
 
-    # Start timing
-    start_time = time.time()
+    if request.args.get('async', 'false').lower() == 'true':
+        return enqueue_resource_assimilation(knowledge_base_id, resource_id, file)
 
     with tempfile.TemporaryDirectory() as tmpdir:
-        file_path = os.path.join(tmpdir, resource_name)  # type: ignore
+        file_path = os.path.join(tmpdir, resource_name)
         file.save(file_path)
 
-        if file.mimetype == 'application/pdf':
-            loader = PyPDFLoader(file_path)
+        try:
+            processed_data_stats = ingest_resource(knowledge_base_id, resource_id, resource_name, file.mimetype, file_path)
+        except ResourceLimitExceededError as e:
+            return str(e), 400
 
-            logger.debug(f"Used pdf file loader for {file_path}")
+    return json.dumps(processed_data_stats), 200
+
+
+def enqueue_resource_assimilation(knowledge_base_id: str, resource_id: str, file: FileStorage):
+    resource_name = str(file.filename)
+
+    # The job outlives the request, so the upload is kept in a directory the job removes when done
+    work_dir = tempfile.mkdtemp()
+    file_path = os.path.join(work_dir, resource_name)
+    file.save(file_path)
+
+    job = IngestionJob(knowledge_base_id, resource_id, resource_name, file.mimetype, file_path, work_dir)
+
+    try:
+        ingestion_job_queue.submit(job)
+    except IngestionQueueFullError as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+        return str(e), 429
+
+    return json.dumps({ 'job_id': job.id }), 202
+
+
+@knowledge_bases_blueprint.route('/knowledge-base/<knowledge_base_id>/resources', methods=['POST'])
+def assimilate_resources(knowledge_base_id: str):
+    # Either one file part per resource, named after its resource id, or a zip/tar archive in the 'archive' part
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if 'archive' in request.files:
+            resource_ids = json.loads(request.form['resource_ids']) if 'resource_ids' in request.form else {}
+
+            try:
+                resources = list(extract_archive_resources(request.files['archive'], resource_ids, tmpdir))
+            except (zipfile.BadZipFile, tarfile.TarError):
+                return 'Invalid archive', 400
         else:
-            loader = UnstructuredFileLoader(
-                file_path,
-                strategy='fast'
-            )
+            resources = []
 
-            logger.debug(f"Used unstructured file loader for {file_path}")
+            for i, (resource_id, file) in enumerate(request.files.items(multi=True)):
+                file_path = os.path.join(tmpdir, str(i))
+                file.save(file_path)
 
-        docs = loader.load()
+                resources.append(ResourceUpload(
+                    resource_id=resource_id,
+                    resource_name=str(file.filename),
+                    mimetype=file.mimetype,
+                    file_path=file_path
+                ))
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=settings.chunking.chunk_size,
-        chunk_overlap=settings.chunking.chunk_overlap,
-        length_function=len,
-    )
+        if len(resources) == 0:
+            return 'Missing files', 400
 
-    texts = text_splitter.split_documents(docs)
+        if len(resources) > settings.ingestion.max_bulk_files:
+            return 'Too many files', 400
 
-    if len(texts) > settings.limits.max_total_chunks:
-        return 'Too many chunks', 400
-    
-    # End timing
-    end_time = time.time()
+        results = ingest_resources(knowledge_base_id, resources)
 
-    # Calculate the elapsed time
-    elapsed_time = end_time - start_time
+    return json.dumps({
+        'processed_data_stats': {resource_id: result for resource_id, result in results.items() if 'error' not in result},
+        'errors': {resource_id: result['error'] for resource_id, result in results.items() if 'error' in result}
+    }), 200
 
-    # Log the elapsed time
-    logger.debug(f"Loading file took {elapsed_time:.2f} seconds")
 
-    embeddings_calculator = EmbeddingsCalculator();
-    embeddings_result = embeddings_calculator.embed_documents([text.page_content for text in texts])
+def extract_archive_resources(archive: FileStorage, resource_ids: dict[str, str], tmpdir: str) -> Iterator[ResourceUpload]:
+    archive_path = os.path.join(tmpdir, 'archive')
+    archive.save(archive_path)
 
-    cumulative_character_count = [0]
-    for text in texts:
-        cumulative_character_count.append(cumulative_character_count[-1] + len(text.page_content))
+    def make_resource(member_name: str, index: int) -> ResourceUpload:
+        # Members are written under generated names so archive paths can never escape the temporary folder
+        return ResourceUpload(
+            resource_id=resource_ids.get(member_name, member_name),
+            resource_name=os.path.basename(member_name),
+            mimetype=mimetypes.guess_type(member_name)[0] or 'application/octet-stream',
+            file_path=os.path.join(tmpdir, str(index))
+        )
 
-    if cumulative_character_count[-1] > settings.limits.max_total_characters:
-        return 'Too many characters', 400
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zip_archive:
+            members = [member for member in zip_archive.infolist() if not member.is_dir()]
 
-    rows = [
-        ResourceChunkInfo(
-            id=None,
-            resource_name=str(resource_name),
-            data=texts[i].page_content,
-            embeddings=embeddings_result[i],
-            resource_id=resource_id,
-            payload=json.dumps({
-                'total_chunks': len(texts),
-                'percentage_in': cumulative_character_count[i] / cumulative_character_count[-1],
-                'chunk_number': i,
-                'resource_mimetype': file.mimetype,
-                'page_index': texts[i].metadata.get('page', None) if file.mimetype == 'application/pdf' else None
-            })
-        ) for i in range(len(texts))
-    ]
+            for index, member in enumerate(members[:settings.ingestion.max_bulk_files + 1]):
+                resource = make_resource(member.filename, index)
 
-    start_time = time.time()
+                with zip_archive.open(member) as source, open(resource['file_path'], 'wb') as target:
+                    shutil.copyfileobj(source, target)
 
-    embeddings_store = CollectionEmbeddingsStore(collection_name=knowledge_base_id)
-    embeddings_store.setup(True)
-    embeddings_store.delete_resource_chunks(resource_id)
-    embeddings_store.insert_resource_chunks(rows)
+                yield resource
+    else:
+        with tarfile.open(archive_path) as tar_archive:
+            members = [member for member in tar_archive.getmembers() if member.isfile()]
 
-    end_time = time.time()
-    elapsed_time = end_time - start_time
+            for index, member in enumerate(members[:settings.ingestion.max_bulk_files + 1]):
+                resource = make_resource(member.name, index)
+                source = tar_archive.extractfile(member)
 
-    print(f"Inserting into database took {elapsed_time:.2f} seconds")
+                if source is None:
+                    continue
 
-    logger.info(f"Assimilated {resource_name} into knowledge base {knowledge_base_id}")
+                with source, open(resource['file_path'], 'wb') as target:
+                    shutil.copyfileobj(source, target)
 
-    processed_data_stats = {
-        'total_chunks': len(texts),
-        'total_characters': cumulative_character_count[-1]
-    }
+                yield resource
 
-    return json.dumps(processed_data_stats), 200
+
+@knowledge_bases_blueprint.route('/ingestion-job/<job_id>', methods=['GET'])
+def get_ingestion_job(job_id: str):
+    job = ingestion_job_queue.get_job(job_id)
+
+    if job is None:
+        return 'Unknown ingestion job', 404
+
+    return {
+        **job.to_dict(),
+        'queue_depth': ingestion_job_queue.queue_depth()
+    }, 200
 
 
 @knowledge_bases_blueprint.route('/knowledge-base/<knowledge_base_id>/resource/<resource_id>', methods=['DELETE'])
 def remove_resource(knowledge_base_id: str, resource_id: str):
-    embeddings_store = CollectionEmbeddingsStore(collection_name=knowledge_base_id,
-                                                 host=settings.milvus.host, port=settings.milvus.host)
-    
-    embeddings_store.setup()
-    embeddings_store.delete_resource_chunks(resource_id)
+    with embeddings_stores.lease_store(knowledge_base_id) as embeddings_store:
+        embeddings_store.delete_resource_chunks(resource_id)
+
+    lexical_indexes.get_index(knowledge_base_id).remove_resource(resource_id)
+    answer_cache.invalidate(knowledge_base_id)
 
     logger.info(f"Removed resource {resource_id} from knowledge base {knowledge_base_id}")
 
@@ -129,10 +173,9 @@ def remove_resource(knowledge_base_id: str, resource_id: str):
 
 @knowledge_bases_blueprint.route('/knowledge-base/<knowledge_base_id>', methods=['DELETE'])
 def remove_knowledge_base(knowledge_base_id: str):
-    embeddings_store = CollectionEmbeddingsStore(collection_name=knowledge_base_id,
-                                                 host=settings.milvus.host, port=settings.milvus.host)
-
-    embeddings_store.drop_collection()
+    embeddings_stores.drop_store(knowledge_base_id)
+    lexical_indexes.drop_index(knowledge_base_id)
+    answer_cache.invalidate(knowledge_base_id)
 
     logger.info(f"Removed knowledge base {knowledge_base_id}")
 
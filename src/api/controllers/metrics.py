@@ -0,0 +1,52 @@
+import time
+
+from flask import Blueprint, Response, g, request
+
+from services.metrics import finish_trace, http_request_duration, metrics, recent_traces, start_trace
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+TRACE_HEADER = 'X-Trace'
+TRACE_ID_HEADER = 'X-Trace-Id'
+
+
+@metrics_blueprint.before_app_request
+def start_request_metrics():
+    # Requests with an X-Trace: 1 header are always traced, others with metrics.trace_sample_rate
+    g.request_start_time = time.perf_counter()
+    g.trace = start_trace(f"{request.method} {request.path}", forced=request.headers.get(TRACE_HEADER) == '1')
+
+
+@metrics_blueprint.after_app_request
+def finish_request_metrics(response: Response) -> Response:
+    if 'request_start_time' not in g:
+        return response
+
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    http_request_duration.observe(time.perf_counter() - g.request_start_time, endpoint, request.method, str(response.status_code))
+
+    if g.trace is not None:
+        finish_trace(g.trace)
+        response.headers[TRACE_ID_HEADER] = g.trace.id
+
+    return response
+
+
+@metrics_blueprint.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@metrics_blueprint.route('/traces', methods=['GET'])
+def get_traces():
+    # The latest traced requests, most recent first
+    return { 'traces': [trace.to_dict() for trace in reversed(recent_traces)] }, 200
+
+
+@metrics_blueprint.route('/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id: str):
+    for trace in recent_traces:
+        if trace.id == trace_id:
+            return trace.to_dict(), 200
+
+    return "Trace not found", 404
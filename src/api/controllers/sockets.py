@@ -0,0 +1,35 @@
+from flask import request
+from flask_socketio import join_room, leave_room, rooms
+
+from api.server_application import socketio
+from config import settings
+from services.socket_rooms import subscription_rooms
+from logger import logger
+
+
+# Clients subscribe before sending /answer-request, the acknowledgement tells them the subscription is active.
+# Every client is also in a room named after its session id, which answer requests can target with session_id
+@socketio.on('subscribe', namespace=settings.socketio.namespace)
+def subscribe(data):
+    new_rooms = [room for room in subscription_rooms(data) if room not in rooms()]
+    subscriptions = len(rooms()) - 1
+
+    if subscriptions + len(new_rooms) > settings.socketio.max_subscriptions:
+        logger.warning(f"Client {request.sid} exceeded {settings.socketio.max_subscriptions} subscriptions")
+
+        return { 'error': f"At most {settings.socketio.max_subscriptions} subscriptions are allowed" }
+
+    for room in new_rooms:
+        join_room(room)
+
+    return { 'rooms': new_rooms, 'session_id': request.sid }
+
+
+@socketio.on('unsubscribe', namespace=settings.socketio.namespace)
+def unsubscribe(data):
+    left_rooms = [room for room in subscription_rooms(data) if room in rooms()]
+
+    for room in left_rooms:
+        leave_room(room)
+
+    return { 'rooms': left_rooms }
@@ -1,56 +1,88 @@
-
-
-import json
 from collections import defaultdict
 
+from config import settings
 from services.embeddings_store import ResourceChunkInfo
+from services.metrics import SEW_STAGE, timed_stage
+
 
 def order_and_sew_info_chunks(info_chunks: list[ResourceChunkInfo]) -> list[ResourceChunkInfo]:
-    # First we need to sort the chunks based on their chunk_number
-    sorted_chunks = sorted(
-        info_chunks, 
-        key=lambda chunk: (chunk['resource_id'], json.loads(chunk['payload'])['chunk_number'])
-    )
-
-    sewed_chunks = []
-    previous_chunk_number = -1
-    previous_resource_id = None
-
-    for i in range(len(sorted_chunks)):
-        current_chunk_number = json.loads(sorted_chunks[i]['payload'])['chunk_number']
-        current_resource_id = sorted_chunks[i]['resource_id']
-
-        # If it's the first chunk or the chunk belongs to a different resource or 
-        # the chunk_number is not one greater than the previous chunk_number, just append it to the list
-        if i == 0 or previous_resource_id != current_resource_id or previous_chunk_number + 1 != current_chunk_number:
-            sewed_chunks.append(sorted_chunks[i])
+    return [sewed_chunk for sewed_chunk, _ in sew_info_chunks(info_chunks)]
+
+
+def sew_info_chunks(info_chunks: list[ResourceChunkInfo]) -> list[tuple[ResourceChunkInfo, list[ResourceChunkInfo]]]:
+    # Returns every sewed chunk with the chunks it was sewed from, chunks are sorted by resource and chunk_number
+    with timed_stage(SEW_STAGE, chunks=len(info_chunks)):
+        return _sew_info_chunks(info_chunks)
+
+
+def _sew_info_chunks(info_chunks: list[ResourceChunkInfo]) -> list[tuple[ResourceChunkInfo, list[ResourceChunkInfo]]]:
+    sorted_chunks = sorted(info_chunks, key=lambda chunk: (chunk.resource_id, chunk.chunk_number))
+
+    sewed_chunks: list[ResourceChunkInfo] = []
+    sewed_data: list[list[str]] = []
+    sewed_members: list[list[ResourceChunkInfo]] = []
+    previous_chunk = None
+
+    for current_chunk in sorted_chunks:
+        # If it's the first chunk or the chunk belongs to a different resource or
+        # the chunk_number is not one greater than the previous chunk_number, it starts a new sewed chunk
+        if previous_chunk is None or previous_chunk.resource_id != current_chunk.resource_id or previous_chunk.chunk_number + 1 != current_chunk.chunk_number:
+            sewed_chunks.append(current_chunk.copy())
+            sewed_data.append([current_chunk.data])
+            sewed_members.append([current_chunk])
         else:
-            # If not the first chunk of the resource and the chunk_number is one greater than 
-            # the previous chunk_number, we need to find the overlap and merge the non-overlapping part
-            previous_chunk_data = sorted_chunks[i - 1]['data']
-            current_chunk_data = sorted_chunks[i]['data']
-            overlap = find_overlap(previous_chunk_data, current_chunk_data)
-            
-            # Merge the non-overlapping part of the current chunk with the last chunk in the list
-            sewed_chunks[-1]['data'] += current_chunk_data[len(overlap):]
+            # Consecutive chunks share the overlap left by the splitter, only the non-overlapping part is appended
+            overlap_length = find_overlap_length(previous_chunk.data, current_chunk.data)
+
+            sewed_data[-1].append(current_chunk.data[overlap_length:])
+            sewed_members[-1].append(current_chunk)
+
+        previous_chunk = current_chunk
+
+    for sewed_chunk, data in zip(sewed_chunks, sewed_data):
+        sewed_chunk.data = "".join(data)
+
+    return list(zip(sewed_chunks, sewed_members))
+
+
+def find_overlap_length(str1: str, str2: str) -> int:
+    # Length of the longest suffix of str1 that is also a prefix of str2, found with the KMP failure function in O(n).
+    # The splitter never overlaps consecutive chunks by more than chunk_overlap characters, which bounds n
+    overlap_bound = min(len(str1), len(str2), settings.chunking.chunk_overlap)
+
+    if overlap_bound == 0:
+        return 0
+
+    pattern = str2[:overlap_bound]
+    text = str1[len(str1) - overlap_bound:]
+
+    failure = [0] * overlap_bound
+    matched = 0
+    for i in range(1, overlap_bound):
+        while matched > 0 and pattern[i] != pattern[matched]:
+            matched = failure[matched - 1]
+        if pattern[i] == pattern[matched]:
+            matched += 1
+        failure[i] = matched
+
+    matched = 0
+    for character in text:
+        while matched > 0 and character != pattern[matched]:
+            matched = failure[matched - 1]
+        if character == pattern[matched]:
+            matched += 1
 
-        previous_chunk_number = current_chunk_number
-        previous_resource_id = current_resource_id
+    return matched
 
-    return sewed_chunks
 
 def find_overlap(str1: str, str2: str) -> str:
-    end_offset = min(len(str1), len(str2))
-    for i in range(end_offset, 0, -1):
-        if str1.endswith(str2[:i]):
-            return str2[:i]
-    return ""
+    return str2[:find_overlap_length(str1, str2)]
 
 
 def group_chunks_by_resource_id(chunks: list[ResourceChunkInfo]) -> dict[str, list[ResourceChunkInfo]]:
     grouped_chunks = defaultdict(list)
     for chunk in chunks:
-        resource_id = chunk['resource_id']
+        resource_id = chunk.resource_id
         grouped_chunks[resource_id].append(chunk)
 
     return grouped_chunks
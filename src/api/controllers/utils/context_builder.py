@@ -0,0 +1,131 @@
+import hashlib
+import re
+from functools import lru_cache
+from typing import TYPE_CHECKING, NamedTuple
+
+from services.embeddings_store import ResourceChunkInfo
+from .chunks import sew_info_chunks
+
+SECTION_SEPARATOR = "\n[...]\n"
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+if TYPE_CHECKING:
+    import tiktoken
+
+
+class ContextSection(NamedTuple):
+    resource_id: str
+    resource_name: str
+    position: int
+    data: str
+    similarity: float
+    chunks: list[ResourceChunkInfo]
+    tokens: int
+
+
+class PackedContext(NamedTuple):
+    text: str
+    chunks: list[ResourceChunkInfo]
+    tokens: int
+
+
+@lru_cache(maxsize=None)
+def get_encoder(model_name: str) -> 'tiktoken.Encoding':
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    return len(get_encoder(model_name).encode_ordinary(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model_name: str) -> str:
+    encoder = get_encoder(model_name)
+
+    return encoder.decode(encoder.encode_ordinary(text)[:max(0, max_tokens)])
+
+
+def source_header(resource_name: str) -> str:
+    return f"<<SOURCE {resource_name}>>\n"
+
+
+def source_footer(resource_name: str) -> str:
+    return f"\n<</SOURCE {resource_name}>>\n"
+
+
+def build_sections(chunks_with_similarity: list[tuple[ResourceChunkInfo, float]], model_name: str) -> list[ContextSection]:
+    # Sews consecutive chunks into sections scored by their most similar chunk, best first.
+    # Sections whose text was already seen, e.g. the same document uploaded twice, are dropped
+    similarities = {chunk.id: similarity for chunk, similarity in chunks_with_similarity}
+    seen_hashes: set[str] = set()
+    sections: list[ContextSection] = []
+
+    for sewed_chunk, chunks in sew_info_chunks([chunk for chunk, _ in chunks_with_similarity]):
+        normalized_data = WHITESPACE_PATTERN.sub(" ", sewed_chunk.data).strip().lower()
+        data_hash = hashlib.sha1(normalized_data.encode('utf-8')).hexdigest()
+
+        if data_hash in seen_hashes:
+            continue
+
+        seen_hashes.add(data_hash)
+        sections.append(ContextSection(
+            resource_id=sewed_chunk.resource_id,
+            resource_name=sewed_chunk.resource_name,
+            position=len(sections),
+            data=sewed_chunk.data,
+            similarity=max(similarities[chunk.id] for chunk in chunks),
+            chunks=chunks,
+            tokens=count_tokens(sewed_chunk.data + SECTION_SEPARATOR, model_name)
+        ))
+
+    return sorted(sections, key=lambda section: section.similarity, reverse=True)
+
+
+def pack_context(chunks_with_similarity: list[tuple[ResourceChunkInfo, float]], model_name: str, token_budget: int) -> PackedContext:
+    # Takes sections by decreasing similarity while they fit in the budget, counting tokens as they are added
+    sections = build_sections(chunks_with_similarity, model_name)
+    packed_sections: dict[str, list[ContextSection]] = {}
+    used_tokens = 0
+
+    for section in sections:
+        section_tokens = section.tokens
+
+        if section.resource_id not in packed_sections:
+            section_tokens += count_tokens(source_header(section.resource_name) + source_footer(section.resource_name), model_name)
+
+        if used_tokens + section_tokens > token_budget:
+            continue
+
+        packed_sections.setdefault(section.resource_id, []).append(section)
+        used_tokens += section_tokens
+
+    # Rather than answering without sources, the best section is cut down to the budget
+    if len(packed_sections) == 0 and len(sections) > 0:
+        section = sections[0]
+        wrapper_tokens = count_tokens(source_header(section.resource_name) + source_footer(section.resource_name) + SECTION_SEPARATOR, model_name)
+        data = truncate_to_tokens(section.data, token_budget - wrapper_tokens, model_name)
+
+        packed_sections[section.resource_id] = [section._replace(data=data)]
+        used_tokens = count_tokens(data, model_name) + wrapper_tokens
+
+    # Sources keep the order of their best section, and sections the order they have in the resource
+    parts: list[str] = []
+    packed_chunks: list[ResourceChunkInfo] = []
+
+    for resource_sections in packed_sections.values():
+        resource_name = resource_sections[0].resource_name
+
+        parts.append(source_header(resource_name))
+
+        for section in sorted(resource_sections, key=lambda section: section.position):
+            parts.append(section.data)
+            parts.append(SECTION_SEPARATOR)
+            packed_chunks.extend(section.chunks)
+
+        parts.append(source_footer(resource_name))
+
+    return PackedContext("".join(parts), packed_chunks, used_tokens)
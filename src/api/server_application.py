@@ -1,6 +1,23 @@
-
 from flask import Flask
 from flask_socketio import SocketIO
 
+from config import settings
+
+
+def socketio_options() -> dict:
+    # With a message queue, server processes share emits and rooms, so any of them can stream to any client
+    message_queue = settings.socketio.message_queue
+
+    if not message_queue:
+        return {}
+
+    if message_queue.startswith(('redis://', 'rediss://')):
+        from api.socketio_manager import ThreadedRedisManager
+
+        return {'client_manager': ThreadedRedisManager(message_queue, settings.socketio.channel)}
+
+    return {'message_queue': message_queue, 'channel': settings.socketio.channel}
+
+
 app = Flask(__name__)
-socketio = SocketIO(app)
\ No newline at end of file
+socketio = SocketIO(app, **socketio_options())
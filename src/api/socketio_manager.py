@@ -0,0 +1,55 @@
+import queue
+import threading
+from typing import TYPE_CHECKING
+
+import socketio
+
+if TYPE_CHECKING:
+    from services.llm_event_loop import ThreadSafeEvent
+
+
+class ThreadedRedisManager(socketio.RedisManager):
+    # Shares emits and rooms between server processes through Redis. Redis calls block and the server runs on gevent
+    # without monkey patching, so the subscription is read and events are published from real threads. The listener
+    # thread wakes the server up for every received message, as the LLM event loop thread does for tokens
+    name = 'threaded-redis'
+
+    def __init__(self, url: str, channel: str):
+        super().__init__(url, channel=channel)
+        self.received: queue.SimpleQueue = queue.SimpleQueue()
+        self.to_publish: queue.SimpleQueue = queue.SimpleQueue()
+
+    def initialize(self):
+        # Skips the check of RedisManager for a monkey patched socket module
+        socketio.PubSubManager.initialize(self)
+
+        threading.Thread(target=self._publish_forever, name='socketio-redis-publisher', daemon=True).start()
+
+    def _publish(self, data):
+        self.to_publish.put(data)
+
+    def _publish_forever(self):
+        while True:
+            super()._publish(self.to_publish.get())
+
+    def _receive_forever(self, message_received: 'ThreadSafeEvent'):
+        for message in super()._listen():
+            self.received.put(message)
+            message_received.set()
+
+    def _listen(self):
+        # Imported here, services.llm_event_loop imports the server this manager is created for
+        from services.llm_event_loop import ThreadSafeEvent
+
+        message_received = ThreadSafeEvent()
+        threading.Thread(target=self._receive_forever, args=(message_received,), name='socketio-redis-listener', daemon=True).start()
+
+        while True:
+            message_received.wait()
+            message_received.clear()
+
+            while True:
+                try:
+                    yield self.received.get_nowait()
+                except queue.Empty:
+                    break
@@ -0,0 +1,98 @@
+# Compares answering a set of questions with one /answer-request call each against a single /answer-requests
+# batch call, on a synthetic knowledge base in the local embeddings store and a local fake OpenAI server.
+# Run from the src folder: python -m benchmarks.batch_answers
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import openai
+from tabulate import tabulate
+
+from config import settings
+
+KNOWLEDGE_BASE_ID = 'batch-answers-benchmark'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--chunks', type=int, default=5000)
+    parser.add_argument('--answer-tokens', type=int, default=50)
+    parser.add_argument('--first-token-latency', type=float, default=0.3)
+    parser.add_argument('--token-interval', type=float, default=0.005)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp()
+
+    # Stores and indexes read their location when their modules are imported, so settings are overridden first
+    settings.set('embeddings_store.backend', 'local')
+    settings.set('embeddings_store.local.path', f"{data_dir}/embeddings")
+    settings.set('lexical_index.path', f"{data_dir}/lexical")
+    settings.set('answer_cache.enabled', False)
+
+    if settings.get('open_ai_secrets') is None:
+        settings.set('open_ai_secrets', { 'api_key': "fake" })
+
+    from api.application import app
+    from benchmarks.fake_openai import FakeOpenAiServer
+    from services.embeddings_calculator import EmbeddingsCalculator
+    from services.embeddings_store import ResourceChunkInfo
+    from services.embeddings_store_registry import embeddings_stores
+    from services.lexical_index import LexicalChunk, lexical_indexes
+
+    server = FakeOpenAiServer(8766, args.answer_tokens, args.first_token_latency, args.token_interval)
+    server.start()
+    openai.api_base = server.api_base
+
+    texts = [f"Section {i}: the device model {i % 97} supports setting number {i} from the advanced configuration menu." for i in range(args.chunks)]
+    embeddings = EmbeddingsCalculator().embed_documents(texts)
+    embeddings_store = embeddings_stores.get_store(KNOWLEDGE_BASE_ID, create_index=True)
+    chunk_ids = embeddings_store.insert_resource_chunks([ResourceChunkInfo(
+        id=None,
+        resource_name=f"manual-{i // 100}.pdf",
+        resource_id=f"manual-{i // 100}",
+        data=text,
+        chunk_number=i % 100,
+        total_chunks=100,
+        percentage_in=(i % 100) / 100,
+        page_index=i % 100,
+        resource_mimetype='application/pdf',
+        content_hash="",
+        embeddings=embedding
+    ) for i, (text, embedding) in enumerate(zip(texts, embeddings))])
+    lexical_indexes.get_index(KNOWLEDGE_BASE_ID).replace_resources(
+        [],
+        [LexicalChunk(chunk_id, f"manual-{i // 100}", text) for i, (chunk_id, text) in enumerate(zip(chunk_ids, texts))]
+    )
+
+    questions = [{ 'question': f"How do I change setting number {i * 13} of device model {i % 97}?", 'reference': f"question-{i}" } for i in range(args.questions)]
+    client = app.test_client()
+
+    # Warm up model, store and HTTP sessions
+    client.post('/answer-request', json={ 'knowledge_base_id': KNOWLEDGE_BASE_ID, **questions[0] })
+
+    start_time = time.perf_counter()
+    for question in questions:
+        client.post('/answer-request', json={ 'knowledge_base_id': KNOWLEDGE_BASE_ID, **question })
+    sequential_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    client.post('/answer-requests', json={ 'knowledge_base_id': KNOWLEDGE_BASE_ID, 'questions': questions })
+    batch_time = time.perf_counter() - start_time
+
+    single_llm_time = args.first_token_latency + args.answer_tokens * args.token_interval
+    llm_rounds = int(np.ceil(args.questions / settings.batch_answers.max_concurrent_llm_calls))
+
+    print(tabulate([
+        [f"{args.questions} x /answer-request", f"{sequential_time:.2f}", f"{args.questions / sequential_time:.1f}"],
+        ['/answer-requests', f"{batch_time:.2f}", f"{args.questions / batch_time:.1f}"],
+        [f"LLM time alone ({llm_rounds} rounds of {single_llm_time:.2f} s)", f"{llm_rounds * single_llm_time:.2f}", '']
+    ], headers=['Mode', 'Total (s)', 'Questions/s']))
+
+    embeddings_stores.drop_store(KNOWLEDGE_BASE_ID)
+    lexical_indexes.drop_index(KNOWLEDGE_BASE_ID)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# Compares the previous chunk sewing (dict chunks with a JSON payload parsed per comparison, quadratic overlap search)
+# with the current one over 12 and 1000 retrieved chunks, as done by /answer-request and /chunks-retrieval.
+# Run from the src folder: python -m benchmarks.chunk_sewing
+import argparse
+import json
+import random
+import timeit
+from collections import defaultdict
+from typing import Any, Callable
+
+from tabulate import tabulate
+
+from api.controllers.utils.chunks import group_chunks_by_resource_id, order_and_sew_info_chunks
+from config import settings
+from services.embeddings_store import ResourceChunkInfo
+
+
+def legacy_find_overlap(str1: str, str2: str) -> str:
+    end_offset = min(len(str1), len(str2))
+    for i in range(end_offset, 0, -1):
+        if str1.endswith(str2[:i]):
+            return str2[:i]
+    return ""
+
+
+def legacy_chunk(chunk: ResourceChunkInfo) -> dict[str, Any]:
+    # A chunk as stores returned them before positions had fields of their own
+    return {
+        'id': chunk.id,
+        'resource_name': chunk.resource_name,
+        'resource_id': chunk.resource_id,
+        'data': chunk.data,
+        'payload': json.dumps(chunk.payload())
+    }
+
+
+def legacy_group_chunks_by_resource_id(chunks: list[dict[str, Any]]) -> dict[str, list[dict[str, Any]]]:
+    grouped_chunks = defaultdict(list)
+    for chunk in chunks:
+        grouped_chunks[chunk['resource_id']].append(chunk)
+
+    return grouped_chunks
+
+
+def legacy_order_and_sew_info_chunks(info_chunks: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    sorted_chunks = sorted(
+        info_chunks,
+        key=lambda chunk: (chunk['resource_id'], json.loads(chunk['payload'])['chunk_number'])
+    )
+
+    sewed_chunks = []
+    previous_chunk_number = -1
+    previous_resource_id = None
+
+    for i in range(len(sorted_chunks)):
+        current_chunk_number = json.loads(sorted_chunks[i]['payload'])['chunk_number']
+        current_resource_id = sorted_chunks[i]['resource_id']
+
+        if i == 0 or previous_resource_id != current_resource_id or previous_chunk_number + 1 != current_chunk_number:
+            sewed_chunks.append(sorted_chunks[i])
+        else:
+            overlap = legacy_find_overlap(sorted_chunks[i - 1]['data'], sorted_chunks[i]['data'])
+            sewed_chunks[-1]['data'] += sorted_chunks[i]['data'][len(overlap):]
+
+        previous_chunk_number = current_chunk_number
+        previous_resource_id = current_resource_id
+
+    return sewed_chunks
+
+
+def make_chunks(total_chunks: int, resources: int) -> list[ResourceChunkInfo]:
+    chunk_size = settings.chunking.chunk_size
+    step = chunk_size - settings.chunking.chunk_overlap
+    random_generator = random.Random(0)
+    words = "the quick brown fox jumps over a lazy dog while error code E1042 shows up".split()
+    text = " ".join(random_generator.choice(words) for _ in range(total_chunks * step // 4 + chunk_size))
+
+    chunks = [
+        ResourceChunkInfo(
+            id=i,
+            resource_name=f"resource-{i % resources}.pdf",
+            resource_id=f"resource-{i % resources}",
+            data=text[(i // resources) * step:(i // resources) * step + chunk_size],
+            chunk_number=i // resources,
+            total_chunks=total_chunks,
+            percentage_in=0.0,
+            page_index=0,
+            resource_mimetype='application/pdf',
+            content_hash=""
+        )
+        for i in range(total_chunks)
+    ]
+    random_generator.shuffle(chunks)
+
+    return chunks
+
+
+def legacy_answer_request_path(chunks: list[dict[str, Any]]):
+    for _, resource_chunks in legacy_group_chunks_by_resource_id(chunks).items():
+        "".join(f"{segment['data']}\n[...]\n" for segment in legacy_order_and_sew_info_chunks(resource_chunks))
+
+
+def legacy_chunks_retrieval_path(chunks: list[dict[str, Any]]):
+    for _, resource_chunks in legacy_group_chunks_by_resource_id(chunks).items():
+        [{**chunk, 'id': str(chunk['id']), 'payload': json.loads(chunk['payload'])} for chunk in legacy_order_and_sew_info_chunks(resource_chunks)]
+
+
+def answer_request_path(chunks: list[ResourceChunkInfo]):
+    for _, resource_chunks in group_chunks_by_resource_id(chunks).items():
+        "".join(f"{segment.data}\n[...]\n" for segment in order_and_sew_info_chunks(resource_chunks))
+
+
+def chunks_retrieval_path(chunks: list[ResourceChunkInfo]):
+    for _, resource_chunks in group_chunks_by_resource_id(chunks).items():
+        [{
+            'id': str(chunk.id),
+            'resource_name': chunk.resource_name,
+            'resource_id': chunk.resource_id,
+            'data': chunk.data,
+            'payload': chunk.payload()
+        } for chunk in order_and_sew_info_chunks(resource_chunks)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rows = []
+    for total_chunks in [12, 1000]:
+        chunks = make_chunks(total_chunks, resources=3)
+
+        legacy_chunks = [legacy_chunk(chunk) for chunk in chunks]
+        paths: list[tuple[str, Callable, Callable]] = [
+            ('/answer-request', legacy_answer_request_path, answer_request_path),
+            ('/chunks-retrieval', legacy_chunks_retrieval_path, chunks_retrieval_path)
+        ]
+
+        for path_name, legacy_path, path in paths:
+            # The legacy implementation mutates its input, so every run gets fresh copies
+            legacy_timer = timeit.Timer(lambda: legacy_path([{**chunk} for chunk in legacy_chunks]))
+            timer = timeit.Timer(lambda: path([chunk.copy() for chunk in chunks]))
+            timings = [min(t.repeat(repeat=args.repeat, number=1)) * 1000 for t in [legacy_timer, timer]]
+
+            rows.append([total_chunks, path_name, f"{timings[0]:.2f}", f"{timings[1]:.2f}", f"{timings[0] / timings[1]:.1f}x"])
+
+    print(tabulate(rows, headers=['Chunks', 'Path', 'Legacy (ms)', 'Current (ms)', 'Speedup']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# Compares /chunks-retrieval of 1000 chunk ids with the previous chunk representation (dicts holding a JSON payload,
+# parsed to sort and again to respond) against slotted chunk records with scalar fields. Both handlers sew chunks the
+# same way and read the same local store through the Flask test client. Reports latency and the peak memory of a
+# request as traced by tracemalloc.
+# Run from the src folder: python -m benchmarks.chunks_retrieval
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, NamedTuple
+
+import numpy as np
+from flask import request
+from tabulate import tabulate
+
+from config import settings
+
+KNOWLEDGE_BASE_ID = 'chunks-retrieval-benchmark'
+
+WORDS = "the quick brown fox jumps over a lazy dog while error code E1042 shows up".split()
+
+
+def build_knowledge_base(resources: int, chunks_per_resource: int, dimension: int) -> list[int]:
+    from services.embeddings_store import ResourceChunkInfo
+    from services.embeddings_store_registry import embeddings_stores
+
+    rng = np.random.default_rng(0)
+    step = settings.chunking.chunk_size - settings.chunking.chunk_overlap
+    rows = []
+
+    for resource in range(resources):
+        text = " ".join(rng.choice(WORDS, size=chunks_per_resource * step // 4 + settings.chunking.chunk_size))
+        embeddings = rng.standard_normal((chunks_per_resource, dimension)).astype(np.float32)
+
+        rows += [ResourceChunkInfo(
+            id=None,
+            resource_name=f"manual-{resource}.pdf",
+            resource_id=f"manual-{resource}",
+            data=text[i * step:i * step + settings.chunking.chunk_size],
+            chunk_number=i,
+            total_chunks=chunks_per_resource,
+            percentage_in=(i + 1) / chunks_per_resource,
+            page_index=i // 4,
+            resource_mimetype='application/pdf',
+            content_hash="",
+            embeddings=embeddings[i] / np.linalg.norm(embeddings[i])
+        ) for i in range(chunks_per_resource)]
+
+    return embeddings_stores.get_store(KNOWLEDGE_BASE_ID, create_index=True).insert_resource_chunks(rows)
+
+
+class NumberedChunk(NamedTuple):
+    resource_id: str
+    chunk_number: int
+    chunk: dict[str, Any]
+
+
+def legacy_order_and_sew_info_chunks(info_chunks: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    # The previous sewing of dict chunks, parsing every payload once to sort them
+    from api.controllers.utils.chunks import find_overlap_length
+
+    numbered_chunks = sorted(
+        (NumberedChunk(chunk['resource_id'], json.loads(chunk['payload'])['chunk_number'], chunk) for chunk in info_chunks),
+        key=lambda numbered_chunk: (numbered_chunk.resource_id, numbered_chunk.chunk_number)
+    )
+
+    sewed_chunks: list[dict[str, Any]] = []
+    sewed_data: list[list[str]] = []
+    previous_chunk = None
+
+    for current_chunk in numbered_chunks:
+        if previous_chunk is None or previous_chunk.resource_id != current_chunk.resource_id or previous_chunk.chunk_number + 1 != current_chunk.chunk_number:
+            sewed_chunks.append({**current_chunk.chunk})
+            sewed_data.append([current_chunk.chunk['data']])
+        else:
+            overlap_length = find_overlap_length(previous_chunk.chunk['data'], current_chunk.chunk['data'])
+            sewed_data[-1].append(current_chunk.chunk['data'][overlap_length:])
+
+        previous_chunk = current_chunk
+
+    for sewed_chunk, data in zip(sewed_chunks, sewed_data):
+        sewed_chunk['data'] = "".join(data)
+
+    return sewed_chunks
+
+
+def register_legacy_route(app) -> dict[str, Any]:
+    # The previous handler, over dict chunks as the stores returned them with their metadata as a JSON string
+    from benchmarks.chunk_sewing import legacy_chunk, legacy_group_chunks_by_resource_id
+    from services.embeddings_store_registry import embeddings_stores
+
+    embeddings_store = embeddings_stores.get_store(KNOWLEDGE_BASE_ID)
+    stored_chunks = {
+        chunk.id: legacy_chunk(chunk)
+        for chunk in embeddings_store.get_chunks_data([str(id) for id in embeddings_store.row_by_id])
+    }
+
+    def legacy_retrieve_chunks():
+        request_body = request.get_json()
+        chunks_data = [stored_chunks[int(id)] for id in request_body['chunk_ids'] if int(id) in stored_chunks]
+
+        grouped_chunks = legacy_group_chunks_by_resource_id(chunks_data)
+
+        for resource_id, chunks in grouped_chunks.items():
+            grouped_chunks[resource_id] = legacy_order_and_sew_info_chunks(chunks)
+
+        all_chunks = []
+        for resource_id, chunks in grouped_chunks.items():
+            all_chunks += chunks
+
+        return {
+            'chunks_data': [{
+                **chunk_data,
+                'id': str(chunk_data['id']),
+                'payload': json.loads(chunk_data['payload'])
+            } for chunk_data in all_chunks]
+        }, 200
+
+    app.add_url_rule('/legacy-chunks-retrieval', 'legacy_chunks_retrieval', legacy_retrieve_chunks, methods=['POST'])
+
+    return next(iter(stored_chunks.values()))
+
+
+def measure(client, path: str, body: dict, requests: int) -> tuple[list[float], int]:
+    # Returns the latencies in milliseconds, then the peak traced memory of one more request
+    latencies: list[float] = []
+
+    for _ in range(requests):
+        start_time = time.perf_counter()
+        response = client.post(path, json=body)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+
+        assert response.status_code == 200
+
+    tracemalloc.start()
+    client.post(path, json=body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return latencies, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ids', type=int, default=1000)
+    parser.add_argument('--resources', type=int, default=20)
+    parser.add_argument('--chunks-per-resource', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp()
+
+    # Stores read their location when their modules are imported, so settings are overridden first
+    settings.set('embeddings_store.backend', 'local')
+    settings.set('embeddings_store.local.path', f"{data_dir}/embeddings")
+
+    if settings.get('open_ai_secrets') is None:
+        settings.set('open_ai_secrets', { 'api_key': "fake" })
+
+    from api.application import app
+    from services.embeddings_store_registry import embeddings_stores
+
+    chunk_ids = build_knowledge_base(args.resources, args.chunks_per_resource, settings.database.embedding_size)
+    sample_legacy_chunk = register_legacy_route(app)
+    sample_chunk = embeddings_stores.get_store(KNOWLEDGE_BASE_ID).get_chunks_data([str(chunk_ids[0])])[0]
+
+    # Runs of consecutive chunks, as the sources of answers are, so sewing has work to do
+    rng = np.random.default_rng(1)
+    starts = rng.choice(len(chunk_ids) // 4, size=args.ids // 4, replace=False) * 4
+    body = {
+        'knowledge_base_id': KNOWLEDGE_BASE_ID,
+        'chunk_ids': [str(chunk_ids[start + i]) for start in starts for i in range(4)]
+    }
+    client = app.test_client()
+
+    rows = []
+    for name, path in [('Dicts with JSON payload', '/legacy-chunks-retrieval'), ('Chunk records', '/chunks-retrieval')]:
+        client.post(path, json=body)
+        latencies, peak = measure(client, path, body, args.requests)
+
+        rows.append([
+            name,
+            f"{statistics.median(latencies):.2f}",
+            f"{statistics.quantiles(latencies, n=20)[18]:.2f}",
+            f"{peak / 1024:.0f}"
+        ])
+
+    # Shallow sizes of one chunk without its text, the payload string is part of the dict chunk
+    legacy_chunk_size = sys.getsizeof(sample_legacy_chunk) + sys.getsizeof(sample_legacy_chunk['payload'])
+    chunk_size = sys.getsizeof(sample_chunk) + sum(
+        sys.getsizeof(getattr(sample_chunk, name)) for name in ['chunk_number', 'total_chunks', 'percentage_in', 'page_index']
+    )
+
+    print(f"/chunks-retrieval of {len(body['chunk_ids'])} ids among {len(chunk_ids)} chunks, {args.requests} requests")
+    print(tabulate(rows, headers=['Chunks', 'p50 (ms)', 'p95 (ms)', 'Peak memory (KiB)']))
+    print(f"Chunk overhead: {legacy_chunk_size} bytes as a dict with a JSON payload, {chunk_size} bytes as a record")
+
+    embeddings_stores.drop_store(KNOWLEDGE_BASE_ID)
+
+
+if __name__ == '__main__':
+    main()
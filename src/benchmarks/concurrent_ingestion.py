@@ -0,0 +1,136 @@
+# Compares 10 concurrent resource uploads into one knowledge base with the previous Milvus write path (query every
+# id then delete them, embed everything then insert it, flush per upload) against the current one (delete by
+# resource id, batched inserts overlapped with embedding, periodic flush). Every resource is uploaded twice, so the
+# second round also measures deleting the chunks of the first one. Needs a running Milvus and the embeddings model.
+# Run from the src folder: python -m benchmarks.concurrent_ingestion
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import numpy as np
+from tabulate import tabulate
+
+from config import settings
+
+KNOWLEDGE_BASE_ID = 'concurrent-ingestion-benchmark'
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore".split()
+
+
+def build_rows(resource_id: str, chunks: int, seed: int) -> list:
+    from services.embeddings_store import ResourceChunkInfo
+
+    rng = np.random.default_rng(seed)
+
+    return [
+        ResourceChunkInfo(
+            id=None,
+            resource_name=f"{resource_id}.pdf",
+            resource_id=resource_id,
+            data=" ".join(rng.choice(WORDS, size=180)) + f" {seed}.{i}",
+            chunk_number=i,
+            total_chunks=chunks,
+            percentage_in=i / chunks,
+            page_index=None,
+            resource_mimetype='application/pdf',
+            content_hash=""
+        ) for i in range(chunks)
+    ]
+
+
+def previous_write(embeddings_store, resource_id: str, rows: list):
+    from services.embeddings_calculator import EmbeddingsCalculator
+    from services.embeddings_store import EMBEDDINGS_FIELD, ID_FIELD
+    from services.milvus_embeddings_store import INSERT_FIELDS
+
+    embeddings_store.ensure_loaded()
+
+    result = embeddings_store.collection.query(expr=f"resource_id == \"{resource_id}\"", output_fields=[ID_FIELD])
+
+    if len(result) > 0:
+        embeddings_store.collection.delete(f"{ID_FIELD} in [{','.join(str(r[ID_FIELD]) for r in result)}]")
+
+    embeddings = EmbeddingsCalculator().embed_documents([row.data for row in rows])
+
+    embeddings_store.collection.insert([
+        embeddings.tolist() if field == EMBEDDINGS_FIELD else [row.field(field) for row in rows]
+        for field in INSERT_FIELDS
+    ])
+    embeddings_store.collection.flush()
+
+
+def current_write(embeddings_store, resource_id: str, rows: list):
+    from services.resource_ingestion import write_resource_rows
+
+    write_resource_rows(KNOWLEDGE_BASE_ID, embeddings_store, {resource_id: rows}, settings.ingestion.batch_size)
+
+
+def run_uploads(write: Callable, uploads: int, chunks: int, rounds: int) -> tuple[list[float], float]:
+    from services.embeddings_store_registry import embeddings_stores
+
+    embeddings_store = embeddings_stores.get_store(KNOWLEDGE_BASE_ID, create_index=True)
+    latencies: list[float] = []
+
+    def upload(resource_number: int, round_number: int):
+        rows = build_rows(f"resource-{resource_number}", chunks, seed=round_number * uploads + resource_number)
+        start_time = time.perf_counter()
+
+        write(embeddings_store, f"resource-{resource_number}", rows)
+
+        latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=uploads) as executor:
+        for round_number in range(rounds):
+            list(executor.map(lambda resource_number: upload(resource_number, round_number), range(uploads)))
+
+    elapsed_time = time.perf_counter() - start_time
+
+    embeddings_stores.drop_store(KNOWLEDGE_BASE_ID)
+
+    return latencies, elapsed_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uploads', type=int, default=10)
+    parser.add_argument('--chunks', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=2)
+    args = parser.parse_args()
+
+    # Every chunk is embedded and fully rewritten, the lexical index is left out to measure store writes only
+    settings.set('embeddings_cache.enabled', False)
+    settings.set('ingestion.incremental_updates', False)
+    settings.set('lexical_index.enabled', False)
+
+    from services.embedding_models import get_embedding_model
+    from services.milvus_embeddings_store import connect_milvus, flush_scheduler
+
+    connect_milvus()
+    get_embedding_model().encode(["warmup"])
+
+    rows = []
+    for name, write in [('Previous', previous_write), ('Current', current_write)]:
+        latencies, elapsed_time = run_uploads(write, args.uploads, args.chunks, args.rounds)
+        latencies = [latency * 1000 for latency in latencies]
+
+        rows.append([
+            name,
+            f"{statistics.median(latencies):.0f}",
+            f"{statistics.quantiles(latencies, n=20)[18]:.0f}",
+            f"{max(latencies):.0f}",
+            f"{elapsed_time:.2f}",
+            f"{args.uploads * args.chunks * args.rounds / elapsed_time:.0f}"
+        ])
+
+        flush_scheduler.flush_pending()
+
+    print(f"{args.uploads} concurrent uploads of {args.chunks} chunks, {args.rounds} rounds")
+    print(tabulate(rows, headers=['Write path', 'Upload p50 (ms)', 'p95 (ms)', 'max (ms)', 'Total (s)', 'Chunks/s']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# Compares the embeddings backends: cold start, encode throughput, resident memory and how close their cosine
+# similarities are to the ones of the default torch backend on a fixed multilingual corpus.
+# Every backend runs in its own process. Run from the src folder: python -m benchmarks.embedding_backends
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from tabulate import tabulate
+
+from config import settings
+
+BACKENDS = ['torch', 'torch_int8', 'onnx', 'onnx_int8']
+
+SUBJECTS = [
+    ("the invoice", "la factura", "a fatura", "die Rechnung"),
+    ("the password", "la contraseña", "a palavra-passe", "das Passwort"),
+    ("the printer", "la impresora", "a impressora", "der Drucker"),
+    ("the subscription", "la suscripción", "a subscrição", "das Abonnement"),
+    ("error ERR-1042", "el error ERR-1042", "o erro ERR-1042", "der Fehler ERR-1042")
+]
+
+TEMPLATES = [
+    ("How do I update {}?", "¿Cómo actualizo {}?", "Como atualizo {}?", "Wie aktualisiere ich {}?"),
+    ("Where can I find {}?", "¿Dónde encuentro {}?", "Onde encontro {}?", "Wo finde ich {}?"),
+    ("Why is {} not working?", "¿Por qué no funciona {}?", "Porque é que {} não funciona?", "Warum funktioniert {} nicht?"),
+    ("Who is responsible for {}?", "¿Quién es responsable de {}?", "Quem é responsável por {}?", "Wer ist für {} zuständig?")
+]
+
+
+def make_corpus() -> list[str]:
+    corpus = [
+        template.format(subject)
+        for subjects in SUBJECTS
+        for templates in TEMPLATES
+        for template, subject in zip(templates, subjects)
+    ]
+
+    # Longer passages, close to the size of ingested chunks
+    corpus += [" ".join(corpus[i:i + 12]) * 3 for i in range(0, len(corpus), 4)]
+
+    return corpus
+
+
+def run_worker(backend: str, output_path: str, repeats: int):
+    settings.set('embeddings.backend', backend)
+    settings.set('embeddings_cache.enabled', False)
+
+    start_time = time.perf_counter()
+
+    from services.embedding_models import get_embedding_model
+
+    model = get_embedding_model()
+    corpus = make_corpus()
+    embeddings = model.encode(corpus)
+    cold_start = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        model.encode(corpus)
+    documents_per_second = repeats * len(corpus) / (time.perf_counter() - start_time)
+
+    np.save(output_path, embeddings)
+
+    print(json.dumps({
+        'cold_start': cold_start,
+        'documents_per_second': documents_per_second,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backends', nargs='+', default=BACKENDS)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.output, args.repeats)
+        return
+
+    results = {}
+    embeddings = {}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for backend in args.backends:
+            output_path = os.path.join(tmpdir, f"{backend}.npy")
+            process = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.embedding_backends', '--worker', backend, '--output', output_path, '--repeats', str(args.repeats)],
+                capture_output=True,
+                text=True
+            )
+
+            if process.returncode != 0:
+                print(f"Backend {backend} failed:\n{process.stderr[-2000:]}")
+                continue
+
+            results[backend] = json.loads(process.stdout.strip().splitlines()[-1])
+            embeddings[backend] = np.load(output_path)
+
+    reference = embeddings.get('torch')
+    rows = []
+
+    for backend, result in results.items():
+        if reference is not None:
+            # Cosine between the vectors of both backends for the same document, and the largest change
+            # in the similarity of any pair of documents
+            self_similarity = (embeddings[backend] * reference).sum(axis=1)
+            pair_difference = np.abs(embeddings[backend] @ embeddings[backend].T - reference @ reference.T).max()
+            accuracy = [f"{self_similarity.mean():.4f}", f"{self_similarity.min():.4f}", f"{pair_difference:.4f}"]
+        else:
+            accuracy = ['', '', '']
+
+        rows.append([
+            backend,
+            f"{result['cold_start']:.2f}",
+            f"{result['documents_per_second']:.1f}",
+            f"{result['max_rss_mb']:.0f}",
+            *accuracy
+        ])
+
+    print(tabulate(rows, headers=[
+        'Backend', 'Cold start (s)', 'Documents/s', 'Max RSS (MB)',
+        'Mean cosine to torch', 'Min cosine to torch', 'Max pair similarity change'
+    ]))
+
+
+if __name__ == '__main__':
+    main()
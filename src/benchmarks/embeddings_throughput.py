@@ -0,0 +1,68 @@
+# Measures query embedding throughput with and without micro batching.
+# Run from the src folder: python -m benchmarks.embeddings_throughput
+import argparse
+import time
+from typing import Callable
+
+from tabulate import tabulate
+
+from api.server_application import socketio
+from services.embeddings_batcher import embeddings_batcher
+from services.embeddings_calculator import EmbeddingsCalculator
+
+CONCURRENCY_LEVELS = [1, 8, 64]
+
+
+def make_queries(total_queries: int) -> list[str]:
+    return [f"How do I configure feature number {i} of the product?" for i in range(total_queries)]
+
+
+def measure_queries_per_second(embed_query: Callable[[str], object], queries: list[str], concurrency: int) -> float:
+    remaining_queries = list(queries)
+    finished_workers = []
+
+    def work():
+        while True:
+            try:
+                query = remaining_queries.pop()
+            except IndexError:
+                break
+
+            embed_query(query)
+
+        finished_workers.append(True)
+
+    start_time = time.perf_counter()
+
+    for _ in range(concurrency):
+        socketio.start_background_task(work)
+
+    while len(finished_workers) < concurrency:
+        socketio.sleep(0.001)
+
+    return len(queries) / (time.perf_counter() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', type=int, default=512)
+    args = parser.parse_args()
+
+    embeddings_calculator = EmbeddingsCalculator()
+    queries = make_queries(args.queries)
+
+    # Warm up the model so the first measurement does not pay for lazy initialization
+    embeddings_calculator.embed_documents(queries[:8])
+
+    rows = []
+    for concurrency in CONCURRENCY_LEVELS:
+        unbatched = measure_queries_per_second(lambda query: embeddings_calculator.embed_documents([query]), queries, concurrency)
+        batched = measure_queries_per_second(embeddings_batcher.embed_query, queries, concurrency)
+
+        rows.append([concurrency, f"{unbatched:.1f}", f"{batched:.1f}", f"{batched / unbatched:.2f}x"])
+
+    print(tabulate(rows, headers=['Concurrency', 'Unbatched q/s', 'Micro batched q/s', 'Speedup']))
+
+
+if __name__ == '__main__':
+    main()
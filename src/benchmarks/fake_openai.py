@@ -0,0 +1,101 @@
+# Local stand-in for the OpenAI chat completions API, streams a fixed answer at a configurable pace.
+# Used by the benchmarks, can also be run on its own: python -m benchmarks.fake_openai --port 8765
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+from aiohttp import web
+
+ANSWER_WORDS = "The configuration of the product is done from the settings page of the administration panel".split()
+
+
+class FakeOpenAiServer:
+    def __init__(self, port: int = 8765, answer_tokens: int = 200, first_token_latency: float = 0.3, token_interval: float = 0.01):
+        self.port = port
+        self.answer_tokens = answer_tokens
+        self.first_token_latency = first_token_latency
+        self.token_interval = token_interval
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+
+    @property
+    def api_base(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self):
+        threading.Thread(target=self._run, name='fake-openai', daemon=True).start()
+        self.started.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self._chat_completions)
+
+        runner = web.AppRunner(app)
+        self.loop.run_until_complete(runner.setup())
+        self.loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', self.port).start())
+        self.started.set()
+        self.loop.run_forever()
+
+    async def _chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        tokens = [f"{ANSWER_WORDS[i % len(ANSWER_WORDS)]} " for i in range(self.answer_tokens)]
+
+        await asyncio.sleep(self.first_token_latency)
+
+        if not body.get('stream'):
+            content = json.dumps({ 'search_query': "product configuration" })
+
+            return web.json_response({
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': body['model'],
+                'choices': [{ 'index': 0, 'message': { 'role': 'assistant', 'content': content }, 'finish_reason': 'stop' }],
+                'usage': { 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0 }
+            })
+
+        response = web.StreamResponse(headers={ 'Content-Type': 'text/event-stream' })
+        await response.prepare(request)
+
+        for i, token in enumerate(tokens):
+            if i > 0:
+                await asyncio.sleep(self.token_interval)
+
+            chunk = {
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': body['model'],
+                'choices': [{ 'index': 0, 'delta': { 'content': token }, 'finish_reason': None }]
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--answer-tokens', type=int, default=200)
+    parser.add_argument('--first-token-latency', type=float, default=0.3)
+    parser.add_argument('--token-interval', type=float, default=0.01)
+    args = parser.parse_args()
+
+    server = FakeOpenAiServer(args.port, args.answer_tokens, args.first_token_latency, args.token_interval)
+    server.start()
+
+    print(f"Fake OpenAI API listening on {server.api_base}")
+
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == '__main__':
+    main()
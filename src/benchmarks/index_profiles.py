@@ -0,0 +1,178 @@
+# Offline recall versus latency sweep of the vector index settings on a synthetic clustered corpus. The local store
+# is swept over nprobe with IVF lists, with and without product quantization, and compared to its exact search. With
+# --milvus every Milvus index profile is built in a running Milvus and swept over nprobe (IVF) or ef (HNSW).
+# Run from the src folder: python -m benchmarks.index_profiles [--vectors 100000] [--milvus]
+import argparse
+import statistics
+import tempfile
+import time
+
+import numpy as np
+from tabulate import tabulate
+
+from config import settings
+from custom_types import Wisdom
+
+KNOWLEDGE_BASE_ID = 'index-profiles-benchmark'
+INSERT_BATCH_SIZE = 5000
+
+NPROBE_VALUES = [1, 4, 8, 16, 32, 64, 128]
+EF_VALUES = [16, 32, 64, 128, 256, 512]
+
+
+def build_corpus(vectors: int, queries: int, clusters: int, dimension: int) -> tuple[np.ndarray, np.ndarray]:
+    # Gaussian clusters around random directions, queries are drawn from the same clusters
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+
+    def sample(count: int) -> np.ndarray:
+        points = centers[rng.integers(clusters, size=count)] + rng.standard_normal((count, dimension)).astype(np.float32) * 2.0
+        return points / np.linalg.norm(points, axis=1, keepdims=True)
+
+    return sample(vectors), sample(queries)
+
+
+def exact_top_rows(corpus: np.ndarray, queries: np.ndarray, limit: int) -> list[set[int]]:
+    scores = queries @ corpus.T
+
+    return [set(np.argpartition(-row, limit - 1)[:limit].tolist()) for row in scores]
+
+
+def insert_corpus(store, corpus: np.ndarray) -> dict[int, int]:
+    # Returns the row of every inserted id
+    from services.embeddings_store import ResourceChunkInfo
+
+    row_by_id: dict[int, int] = {}
+
+    for start in range(0, len(corpus), INSERT_BATCH_SIZE):
+        batch = corpus[start:start + INSERT_BATCH_SIZE]
+        ids = store.insert_resource_chunks([
+            ResourceChunkInfo(
+                id=None,
+                resource_name="synthetic",
+                resource_id=f"resource-{(start + i) // 1000}",
+                data=f"chunk {start + i}",
+                chunk_number=start + i,
+                total_chunks=len(corpus),
+                percentage_in=(start + i) / len(corpus),
+                page_index=None,
+                resource_mimetype='text/plain',
+                content_hash="",
+                embeddings=vector
+            ) for i, vector in enumerate(batch)
+        ])
+
+        row_by_id.update((id, start + i) for i, id in enumerate(ids))
+
+    return row_by_id
+
+
+def measure(store, queries: np.ndarray, expected_rows: list[set[int]], row_by_id: dict[int, int], limit: int) -> tuple[float, float, float]:
+    # Returns recall at limit, p50 and p95 latency in milliseconds, one query per search as /answer-request does
+    latencies: list[float] = []
+    hits = 0
+
+    for query, expected in zip(queries, expected_rows):
+        start_time = time.perf_counter()
+        result = store.search_similar_chunk_ids(query[np.newaxis, :], limit=limit, wisdom=Wisdom.MEDIUM)[0]
+        latencies.append((time.perf_counter() - start_time) * 1000)
+
+        hits += len(expected & {row_by_id[id] for id, _ in result})
+
+    return hits / (len(queries) * limit), statistics.median(latencies), statistics.quantiles(latencies, n=20)[18]
+
+
+def set_search_param(name: str, value: int):
+    settings.set(f"embeddings_store.search_params.{Wisdom.MEDIUM.name}.{name}", value)
+
+
+def sweep_local(corpus: np.ndarray, queries: np.ndarray, expected_rows: list[set[int]], limit: int) -> list[list]:
+    from services.local_embeddings_store import FLAT_INDEX, IVF_INDEX, IVF_PQ_INDEX, LocalEmbeddingsStore
+
+    data_dir = tempfile.mkdtemp()
+    rows = []
+
+    for index_type in [FLAT_INDEX, IVF_INDEX, IVF_PQ_INDEX]:
+        settings.set('embeddings_store.local.index_type', index_type)
+
+        store = LocalEmbeddingsStore(f"{KNOWLEDGE_BASE_ID}-{index_type.lower()}", path=data_dir)
+        store.setup(create_index=True)
+
+        build_start_time = time.perf_counter()
+        row_by_id = insert_corpus(store, corpus)
+        build_time = time.perf_counter() - build_start_time
+
+        for nprobe in NPROBE_VALUES if index_type != FLAT_INDEX else [None]:
+            if nprobe is not None:
+                set_search_param('nprobe', nprobe)
+
+            recall, p50, p95 = measure(store, queries, expected_rows, row_by_id, limit)
+            rows.append([f"local {index_type}", f"nprobe={nprobe}" if nprobe is not None else "-", f"{build_time:.1f}", f"{recall:.3f}", f"{p50:.2f}", f"{p95:.2f}"])
+
+        store.drop_collection()
+
+    return rows
+
+
+def sweep_milvus(corpus: np.ndarray, queries: np.ndarray, expected_rows: list[set[int]], limit: int) -> list[list]:
+    from services.milvus_embeddings_store import HNSW_INDEX, CollectionEmbeddingsStore, connect_milvus, flush_scheduler
+
+    connect_milvus()
+    rows = []
+
+    for profile in settings.milvus.index_profiles:
+        index_type = profile['index_type']
+        settings.set('milvus.index_type', index_type)
+
+        store = CollectionEmbeddingsStore(f"{KNOWLEDGE_BASE_ID}-{index_type.lower()}")
+        store.setup(create_index=True)
+
+        build_start_time = time.perf_counter()
+        row_by_id = insert_corpus(store, corpus)
+        flush_scheduler.forget(store.collection_name)
+        store.collection.flush()
+        store.ensure_loaded()
+        build_time = time.perf_counter() - build_start_time
+
+        if index_type.startswith('IVF'):
+            sweep = [('nprobe', value) for value in NPROBE_VALUES]
+        elif index_type == HNSW_INDEX:
+            sweep = [('ef', value) for value in EF_VALUES]
+        else:
+            sweep = [(None, None)]
+
+        for name, value in sweep:
+            if name is not None:
+                set_search_param(name, value)
+
+            recall, p50, p95 = measure(store, queries, expected_rows, row_by_id, limit)
+            rows.append([f"milvus {index_type}", f"{name}={value}" if name is not None else "-", f"{build_time:.1f}", f"{recall:.3f}", f"{p50:.2f}", f"{p95:.2f}"])
+
+        store.drop_collection()
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--clusters', type=int, default=1000)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--milvus', action='store_true', help='Also sweep the Milvus index profiles, needs a running Milvus')
+    args = parser.parse_args()
+
+    corpus, queries = build_corpus(args.vectors, args.queries, args.clusters, settings.database.embedding_size)
+    expected_rows = exact_top_rows(corpus, queries, args.limit)
+
+    rows = sweep_local(corpus, queries, expected_rows, args.limit)
+
+    if args.milvus:
+        rows += sweep_milvus(corpus, queries, expected_rows, args.limit)
+
+    print(f"{args.vectors} vectors, {args.queries} queries, recall at {args.limit}")
+    print(tabulate(rows, headers=['Index', 'Search params', 'Build (s)', 'Recall', 'p50 (ms)', 'p95 (ms)']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# Measures build time, update time, size on disk and lookup latency of the BM25 lexical index over synthetic chunks.
+# Updates merge postings in linear time but save the whole index, so the time of a save is shown on its own.
+# Run from the src folder: python -m benchmarks.lexical_search
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+from tabulate import tabulate
+
+from services.lexical_index import LexicalChunk, LexicalIndex
+
+VOCABULARY_SIZE = 50000
+WORDS_PER_CHUNK = 180
+CHUNKS_PER_RESOURCE = 500
+
+
+def make_chunks(total_chunks: int, random: np.random.Generator) -> list[LexicalChunk]:
+    vocabulary = [f"word{i}" for i in range(VOCABULARY_SIZE)]
+    # Word frequencies follow a Zipf distribution like natural text, and every chunk mentions one error code
+    word_ids = (random.zipf(1.2, size=(total_chunks, WORDS_PER_CHUNK)) - 1) % VOCABULARY_SIZE
+
+    return [
+        LexicalChunk(
+            i + 1,
+            f"resource-{i // CHUNKS_PER_RESOURCE}",
+            " ".join(vocabulary[word_id] for word_id in word_ids[i]) + f" ERR-{i % 20000:05d}"
+        )
+        for i in range(total_chunks)
+    ]
+
+
+def make_queries(total_queries: int, random: np.random.Generator) -> list[str]:
+    queries = []
+
+    for i in range(total_queries):
+        if i % 2 == 0:
+            queries.append(f"What does ERR-{random.integers(20000):05d} mean?")
+        else:
+            queries.append(" ".join(f"word{word_id}" for word_id in random.integers(0, 2000, size=6)))
+
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--limit', type=int, default=36)
+    args = parser.parse_args()
+
+    random = np.random.default_rng(0)
+    chunks = make_chunks(args.chunks, random)
+    queries = make_queries(args.queries, random)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index_path = os.path.join(tmpdir, 'index.npz')
+        index = LexicalIndex(index_path)
+
+        build_start_time = time.perf_counter()
+        for start in range(0, len(chunks), CHUNKS_PER_RESOURCE):
+            resource_chunks = chunks[start:start + CHUNKS_PER_RESOURCE]
+            index.replace_resources([resource_chunks[0].resource_id], resource_chunks)
+        build_time = time.perf_counter() - build_start_time
+
+        update_start_time = time.perf_counter()
+        index.replace_resources([chunks[0].resource_id], chunks[:CHUNKS_PER_RESOURCE])
+        update_time = time.perf_counter() - update_start_time
+
+        removal_start_time = time.perf_counter()
+        index.remove_resource(chunks[0].resource_id)
+        removal_time = time.perf_counter() - removal_start_time
+
+        addition_start_time = time.perf_counter()
+        index.replace_resources([chunks[0].resource_id], chunks[:CHUNKS_PER_RESOURCE])
+        addition_time = time.perf_counter() - addition_start_time
+
+        save_start_time = time.perf_counter()
+        index._save()
+        save_time = time.perf_counter() - save_start_time
+
+        load_start_time = time.perf_counter()
+        index = LexicalIndex(index_path)
+        index.load()
+        load_time = time.perf_counter() - load_start_time
+
+        latencies = []
+        for query in queries:
+            start_time = time.perf_counter()
+            index.search(query, args.limit)
+            latencies.append((time.perf_counter() - start_time) * 1000)
+
+        latencies.sort()
+
+        print(tabulate([
+            ['Chunks', args.chunks],
+            ['Postings', len(index.snapshot.posting_rows)],
+            ['Size on disk (MB)', f"{os.path.getsize(index_path) / 1024 ** 2:.1f}"],
+            [f"Incremental build, {CHUNKS_PER_RESOURCE} chunks per resource (s)", f"{build_time:.2f}"],
+            ['Re-assimilation of one resource (s)', f"{update_time:.2f}"],
+            ['Removal of one resource (s)', f"{removal_time:.2f}"],
+            ['Addition of one resource (s)', f"{addition_time:.2f}"],
+            ['Of which saving the index (s)', f"{save_time:.2f}"],
+            ['Load from disk (s)', f"{load_time:.2f}"],
+            ['Lookup p50 (ms)', f"{statistics.median(latencies):.2f}"],
+            ['Lookup p95 (ms)', f"{latencies[int(len(latencies) * 0.95)]:.2f}"],
+            ['Lookup max (ms)', f"{latencies[-1]:.2f}"]
+        ]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# Measures answer streaming time to first token and tokens per second against a local fake OpenAI server,
+# per call blocking ChatOpenAI with one emit per token versus the pooled asyncio client with token frames.
+# Run from the src folder: python -m benchmarks.llm_streaming
+import argparse
+import statistics
+import time
+from typing import Any, Callable
+
+import openai
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import SystemMessage
+from tabulate import tabulate
+
+from api.server_application import socketio
+from benchmarks.fake_openai import FakeOpenAiServer
+from config import settings
+from services.llm_provider import LlmProvider
+
+CONCURRENCY_LEVELS = [1, 8]
+PROMPT = "Answer the question using only the sources."
+
+
+class LegacyStreamHandler(BaseCallbackHandler):
+    def __init__(self, reference: str):
+        self.reference = reference
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        socketio.emit('answer_token', { 'token': token, 'reference': self.reference })
+        socketio.sleep(0)
+
+
+def legacy_request_answer(reference: str, api_base: str):
+    chat = ChatOpenAI(
+        streaming=True,
+        callbacks=[LegacyStreamHandler(reference)],
+        temperature=0.2,
+        model_name="gpt-3.5-turbo",
+        client=None,
+        openai_api_key="fake",
+        openai_api_base=api_base
+    )
+    chat([SystemMessage(content=PROMPT)])
+
+
+def pooled_request_answer(reference: str, api_base: str):
+    LlmProvider().request_answer(PROMPT, reference)
+
+
+def measure(request_answer: Callable[[str, str], None], api_base: str, concurrency: int) -> dict[str, float]:
+    emits: dict[str, list[tuple[float, int]]] = {}
+    start_times: dict[str, float] = {}
+    original_emit = socketio.emit
+
+    def recording_emit(event: str, data: Any = None, *args, **kwargs):
+        if event == 'answer_token':
+            emits.setdefault(data['reference'], []).append((time.perf_counter(), len(data['token'].split())))
+
+    socketio.emit = recording_emit  # type: ignore
+    finished = []
+
+    def work(reference: str):
+        start_times[reference] = time.perf_counter()
+        request_answer(reference, api_base)
+        finished.append(reference)
+
+    try:
+        for i in range(concurrency):
+            socketio.start_background_task(work, f"request-{i}")
+
+        while len(finished) < concurrency:
+            socketio.sleep(0.001)
+    finally:
+        socketio.emit = original_emit  # type: ignore
+
+    times_to_first_token = [emits[reference][0][0] - start_times[reference] for reference in finished]
+    tokens_per_second = [
+        sum(tokens for _, tokens in emits[reference]) / (emits[reference][-1][0] - start_times[reference])
+        for reference in finished
+    ]
+
+    return {
+        'ttft': statistics.mean(times_to_first_token),
+        'tokens_per_second': statistics.mean(tokens_per_second),
+        'emits': statistics.mean(len(emits[reference]) for reference in finished)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--answer-tokens', type=int, default=200)
+    parser.add_argument('--first-token-latency', type=float, default=0.3)
+    parser.add_argument('--token-interval', type=float, default=0.005)
+    args = parser.parse_args()
+
+    server = FakeOpenAiServer(args.port, args.answer_tokens, args.first_token_latency, args.token_interval)
+    server.start()
+    openai.api_base = server.api_base
+
+    # The fake server does not check keys, so the benchmark also runs without a secrets file
+    if settings.get('open_ai_secrets') is None:
+        settings.set('open_ai_secrets', { 'api_key': "fake" })
+
+    rows = []
+    for concurrency in CONCURRENCY_LEVELS:
+        for name, request_answer in [('ChatOpenAI per call', legacy_request_answer), ('Pooled async', pooled_request_answer)]:
+            result = measure(request_answer, server.api_base, concurrency)
+
+            rows.append([
+                concurrency,
+                name,
+                f"{result['ttft'] * 1000:.0f}",
+                f"{result['tokens_per_second']:.0f}",
+                f"{result['emits']:.0f}"
+            ])
+
+    print(tabulate(rows, headers=['Concurrency', 'Client', 'Time to first token (ms)', 'Tokens/s', 'Emits per answer']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+# Replays traffic against the whole service and reports latency percentiles, throughput, peak RSS and the time
+# spent per stage for every scenario: uploading documents of 1, 10 and 1000 chunks, answering questions with
+# and without a conversation, retrieving chunks, and a mix of them. Answers are streamed by a local fake OpenAI
+# server and chunks are kept in the local embeddings store (--store milvus uses a running Milvus instead), so
+# nothing else is needed. Every scenario runs in its own process so its peak RSS is its own.
+# Run from the src folder: python -m benchmarks.load_suite --output results.json
+# and compare with a previous run: python -m benchmarks.load_suite --compare results.json
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+import numpy as np
+from tabulate import tabulate
+
+from config import settings
+
+CORPUS_KNOWLEDGE_BASE_ID = 'load-suite-corpus'
+INGEST_KNOWLEDGE_BASE_ID = 'load-suite-ingest'
+
+INGEST_SCENARIOS = { 'ingest_1': 1, 'ingest_10': 10, 'ingest_1000': 1000 }
+SCENARIOS = [*INGEST_SCENARIOS, 'answer', 'answer_conversation', 'chunks_retrieval', 'mixed']
+
+# Share of every request kind in the mixed scenario, close to production traffic
+MIXED_TRAFFIC = { 'answer': 0.7, 'answer_conversation': 0.15, 'chunks_retrieval': 0.1, 'ingest_10': 0.05 }
+
+# Large uploads take seconds each, fewer of them are enough for stable percentiles
+MAX_REQUESTS = { 'ingest_1000': 5 }
+
+# Compared between runs, with whether higher is better
+COMPARED_RESULTS = { 'p50_ms': False, 'p95_ms': False, 'p99_ms': False, 'throughput': True, 'peak_rss_mib': False }
+
+WORDS = "device settings menu power button reset firmware update network password account invoice printer".split()
+
+
+def make_paragraph(index: int) -> str:
+    # About 1200 characters, so every paragraph of an upload becomes one chunk
+    words = [WORDS[(index * 7 + i * 3) % len(WORDS)] for i in range(170)]
+
+    return f"Section {index}: " + " ".join(words) + "."
+
+
+def make_question(index: int) -> str:
+    return f"How do I change setting number {index * 13} of device model {index % 97}?"
+
+
+def make_requests(scenario: str, count: int, seed: int) -> list[tuple[str, int]]:
+    # Request kinds with their index, the index keeps uploaded resource ids and questions unique
+    rng = random.Random(seed)
+
+    if scenario == 'mixed':
+        kinds = rng.choices(list(MIXED_TRAFFIC), weights=list(MIXED_TRAFFIC.values()), k=count)
+    else:
+        kinds = [scenario] * min(count, MAX_REQUESTS.get(scenario, count))
+
+    return [(kind, i) for i, kind in enumerate(kinds)]
+
+
+def send_request(client: Any, kind: str, index: int, chunk_ids: list[int]) -> tuple[int, int]:
+    # Returns the status code and the chunks uploaded or retrieved
+    if kind in INGEST_SCENARIOS:
+        text = "\n\n".join(make_paragraph(index * 1000 + i) for i in range(INGEST_SCENARIOS[kind]))
+        response = client.post(
+            f"/knowledge-base/{INGEST_KNOWLEDGE_BASE_ID}/resource/{kind}-{index}",
+            data={ 'file': (io.BytesIO(text.encode('utf-8')), f"{kind}-{index}.txt", 'text/plain') },
+            content_type='multipart/form-data'
+        )
+
+        return response.status_code, json.loads(response.data)['total_chunks'] if response.status_code == 200 else 0
+
+    if kind == 'chunks_retrieval':
+        rng = random.Random(index)
+        response = client.post('/chunks-retrieval', json={
+            'knowledge_base_id': CORPUS_KNOWLEDGE_BASE_ID,
+            'chunk_ids': [str(chunk_id) for chunk_id in rng.sample(chunk_ids, min(20, len(chunk_ids)))]
+        })
+
+        return response.status_code, len(response.get_json()['chunks_data']) if response.status_code == 200 else 0
+
+    request_data: dict[str, Any] = {
+        'knowledge_base_id': CORPUS_KNOWLEDGE_BASE_ID,
+        'question': make_question(index),
+        'reference': f"{kind}-{index}"
+    }
+
+    if kind == 'answer_conversation':
+        request_data['conversation'] = [
+            { 'sender': 'USER', 'content': make_question(index + 1) },
+            { 'sender': 'AI_ENGINE', 'content': "It can be changed from the advanced configuration menu." }
+        ]
+        request_data['question'] = "And for the other model?"
+
+    response = client.post('/answer-request', json=request_data)
+
+    return response.status_code, len(response.get_json()['sources']) if response.status_code == 200 else 0
+
+
+def peak_rss_mib() -> float:
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return peak_rss / 1024 / 1024 if sys.platform == 'darwin' else peak_rss / 1024
+
+
+def stage_totals() -> dict[str, tuple[float, float]]:
+    # Observations and seconds per stage so far, from the stage duration histogram
+    from services.metrics import stage_duration
+
+    with stage_duration.lock:
+        return {label_values[0]: (sum(values[:-1]), values[-1]) for label_values, values in stage_duration.series.items()}
+
+
+def run_worker(scenario: str, args: argparse.Namespace):
+    data_dir = tempfile.mkdtemp()
+
+    # Stores and indexes read their location when their modules are imported, so settings are overridden first
+    if args.store == 'local':
+        settings.set('embeddings_store.backend', 'local')
+        settings.set('embeddings_store.local.path', f"{data_dir}/embeddings")
+
+    settings.set('lexical_index.path', f"{data_dir}/lexical")
+    settings.set('answer_cache.enabled', False)
+    settings.set('limits.max_total_chunks', max(INGEST_SCENARIOS.values()) * 2)
+
+    if settings.get('open_ai_secrets') is None:
+        settings.set('open_ai_secrets', { 'api_key': "fake" })
+
+    import openai
+
+    from api.application import app
+    from benchmarks.fake_openai import FakeOpenAiServer
+    from services.embeddings_calculator import EmbeddingsCalculator
+    from services.embeddings_store import ResourceChunkInfo
+    from services.embeddings_store_registry import embeddings_stores
+    from services.lexical_index import LexicalChunk, lexical_indexes
+
+    server = FakeOpenAiServer(args.port, args.answer_tokens, args.first_token_latency, args.token_interval)
+    server.start()
+    openai.api_base = server.api_base
+
+    texts = [
+        f"Section {i}: the device model {i % 97} supports setting number {i} from the advanced configuration menu."
+        for i in range(args.corpus_chunks)
+    ]
+    embeddings_store = embeddings_stores.get_store(CORPUS_KNOWLEDGE_BASE_ID, create_index=True)
+    chunk_ids = embeddings_store.insert_resource_chunks([ResourceChunkInfo(
+        id=None,
+        resource_name=f"manual-{i // 100}.pdf",
+        resource_id=f"manual-{i // 100}",
+        data=text,
+        chunk_number=i % 100,
+        total_chunks=100,
+        percentage_in=(i % 100) / 100,
+        page_index=i % 100,
+        resource_mimetype='application/pdf',
+        content_hash="",
+        embeddings=embedding
+    ) for i, (text, embedding) in enumerate(zip(texts, EmbeddingsCalculator().embed_documents(texts)))])
+    lexical_indexes.get_index(CORPUS_KNOWLEDGE_BASE_ID).replace_resources(
+        [],
+        [LexicalChunk(chunk_id, f"manual-{i // 100}", text) for i, (chunk_id, text) in enumerate(zip(chunk_ids, texts))]
+    )
+
+    # Flask test clients are not shared between threads
+    clients = threading.local()
+
+    def timed_request(request: tuple[str, int]) -> tuple[float, int, int]:
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+
+        start_time = time.perf_counter()
+
+        try:
+            status_code, items = send_request(clients.client, request[0], request[1], chunk_ids)
+        except Exception as e:
+            print(f"{request[0]} request {request[1]} failed: {e}", file=sys.stderr)
+            status_code, items = 500, 0
+
+        return time.perf_counter() - start_time, status_code, items
+
+    requests = make_requests(scenario, args.requests, args.seed)
+
+    # Warm up the model, stores and HTTP sessions with requests of the same kinds, under other indexes
+    for kind in sorted({kind for kind, _ in requests}):
+        timed_request((kind, len(requests) + 1))
+
+    setup_peak_rss = peak_rss_mib()
+    stages_before = stage_totals()
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(timed_request, requests))
+
+    wall_time = time.perf_counter() - start_time
+    latencies = np.array([latency for latency, status_code, _ in results if status_code < 400]) * 1000
+    stages = {
+        stage: {
+            'count': int(count - stages_before.get(stage, (0, 0))[0]),
+            'mean_ms': (total - stages_before.get(stage, (0, 0))[1]) / (count - stages_before.get(stage, (0, 0))[0]) * 1000
+        }
+        for stage, (count, total) in stage_totals().items()
+        if count > stages_before.get(stage, (0, 0))[0]
+    }
+
+    print(json.dumps({
+        'requests': len(results),
+        'errors': sum(status_code >= 400 for _, status_code, _ in results),
+        'items_per_request': float(np.mean([items for _, _, items in results])) if results else 0.0,
+        'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else None,
+        'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+        'throughput': len(latencies) / wall_time,
+        'wall_seconds': wall_time,
+        'setup_peak_rss_mib': setup_peak_rss,
+        'peak_rss_mib': peak_rss_mib(),
+        'stages': stages
+    }))
+
+    embeddings_stores.drop_store(CORPUS_KNOWLEDGE_BASE_ID)
+    embeddings_stores.drop_store(INGEST_KNOWLEDGE_BASE_ID)
+    lexical_indexes.drop_index(CORPUS_KNOWLEDGE_BASE_ID)
+    lexical_indexes.drop_index(INGEST_KNOWLEDGE_BASE_ID)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return revision + ('-dirty' if dirty else '')
+
+
+def compare_results(results: dict[str, Any], baseline: dict[str, Any], max_regression: float) -> list[str]:
+    # Prints the change of every result against the baseline and returns the regressions beyond max_regression
+    rows = []
+    regressions = []
+
+    for scenario, result in results['scenarios'].items():
+        baseline_result = baseline['scenarios'].get(scenario)
+
+        if baseline_result is None:
+            continue
+
+        for key, higher_is_better in COMPARED_RESULTS.items():
+            value, baseline_value = result.get(key), baseline_result.get(key)
+
+            if value is None or not baseline_value:
+                continue
+
+            change = value / baseline_value - 1
+            regression = -change if higher_is_better else change
+            rows.append([scenario, key, f"{baseline_value:.1f}", f"{value:.1f}", f"{change:+.1%}"])
+
+            if regression > max_regression:
+                regressions.append(f"{scenario} {key} {change:+.1%}")
+
+    print(f"\nCompared with {baseline.get('revision')}")
+    print(tabulate(rows, headers=['Scenario', 'Result', 'Baseline', 'Current', 'Change']))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--corpus-chunks', type=int, default=5000)
+    parser.add_argument('--store', choices=['local', 'milvus'], default='local')
+    parser.add_argument('--answer-tokens', type=int, default=100)
+    parser.add_argument('--first-token-latency', type=float, default=0.3)
+    parser.add_argument('--token-interval', type=float, default=0.005)
+    parser.add_argument('--port', type=int, default=8767)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare with")
+    parser.add_argument('--max-regression', type=float, default=0.1, help="Exit with an error when a result of --compare is worse by more than this")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args)
+        return
+
+    options = [
+        '--requests', str(args.requests), '--concurrency', str(args.concurrency), '--corpus-chunks', str(args.corpus_chunks),
+        '--store', args.store, '--answer-tokens', str(args.answer_tokens), '--first-token-latency', str(args.first_token_latency),
+        '--token-interval', str(args.token_interval), '--port', str(args.port), '--seed', str(args.seed)
+    ]
+    results: dict[str, Any] = {
+        'revision': git_revision(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'options': {key: value for key, value in vars(args).items() if key not in ['output', 'compare', 'max_regression', 'worker']},
+        'scenarios': {}
+    }
+
+    for scenario in args.scenarios:
+        process = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.load_suite', '--worker', scenario, *options],
+            capture_output=True,
+            text=True,
+            env={**os.environ, 'PYTHONUNBUFFERED': '1'}
+        )
+
+        if process.returncode != 0:
+            print(f"Scenario {scenario} failed:\n{process.stderr[-2000:]}")
+            continue
+
+        results['scenarios'][scenario] = json.loads(process.stdout.strip().splitlines()[-1])
+
+    print(tabulate([[
+        scenario,
+        result['requests'],
+        result['errors'],
+        f"{result['items_per_request']:.1f}",
+        *[f"{result[key]:.0f}" if result[key] is not None else '' for key in ['p50_ms', 'p95_ms', 'p99_ms']],
+        f"{result['throughput']:.2f}",
+        f"{result['peak_rss_mib']:.0f}"
+    ] for scenario, result in results['scenarios'].items()], headers=[
+        'Scenario', 'Requests', 'Errors', 'Chunks per request', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'Requests/s', 'Peak RSS (MiB)'
+    ]))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare_results(results, json.load(baseline_file), args.max_regression)
+
+        if regressions:
+            print(f"\nRegressions beyond {args.max_regression:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
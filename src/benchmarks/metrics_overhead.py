@@ -0,0 +1,69 @@
+# Measures what metrics and traces cost on the hot path: one histogram observation, one timed stage without and
+# with a trace, and rendering /metrics once every stage and endpoint has series. An answer goes through about
+# 15 stages, so the cost per answer is 15 times the timed stage cost.
+# Run from the src folder: python -m benchmarks.metrics_overhead
+import argparse
+import time
+
+from tabulate import tabulate
+
+from services.metrics import (
+    EMBED_QUERY_STAGE, Trace, current_trace, http_request_duration, metrics, stage_duration, timed_stage
+)
+
+STAGES_PER_ANSWER = 15
+
+
+def time_per_call(function, iterations: int) -> float:
+    start_time = time.perf_counter()
+
+    for _ in range(iterations):
+        function()
+
+    return (time.perf_counter() - start_time) / iterations
+
+
+def run_timed_stage():
+    with timed_stage(EMBED_QUERY_STAGE, cached=False):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=200000)
+    args = parser.parse_args()
+
+    observe_time = time_per_call(lambda: stage_duration.observe(0.01, EMBED_QUERY_STAGE), args.iterations)
+    untraced_stage_time = time_per_call(run_timed_stage, args.iterations)
+
+    # Spans pile up in the trace, a new one every 1000 stages keeps it the size of a real request
+    def run_traced_stage():
+        if len(trace.spans) >= 1000:
+            trace.spans.clear()
+
+        run_timed_stage()
+
+    trace = Trace('benchmark')
+    token = current_trace.set(trace)
+    traced_stage_time = time_per_call(run_traced_stage, args.iterations)
+    current_trace.reset(token)
+
+    for i in range(20):
+        for status in ['200', '400', '500']:
+            http_request_duration.observe(0.1, f"/endpoint-{i}", 'POST', status)
+
+    for i in range(30):
+        stage_duration.observe(0.1, f"stage-{i}")
+
+    render_time = time_per_call(metrics.render, 200)
+
+    print(tabulate([
+        ['Histogram observation', f"{observe_time * 1e6:.2f}", "-"],
+        ['Timed stage, not traced', f"{untraced_stage_time * 1e6:.2f}", f"{untraced_stage_time * STAGES_PER_ANSWER * 1e6:.1f}"],
+        ['Timed stage, traced', f"{traced_stage_time * 1e6:.2f}", f"{traced_stage_time * STAGES_PER_ANSWER * 1e6:.1f}"],
+        [f"Render /metrics ({len(metrics.render().splitlines())} lines)", f"{render_time * 1e6:.0f}", "-"]
+    ], headers=['Operation', 'Time per call (µs)', f"Time per answer of {STAGES_PER_ANSWER} stages (µs)"]))
+
+
+if __name__ == '__main__':
+    main()
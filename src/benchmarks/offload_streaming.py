@@ -0,0 +1,144 @@
+# Measures the gaps between the answer_token frames of answers streamed while a 1000 chunk document is uploaded,
+# with embedding and parsing run inline on the server loop (cpu_offload.enabled off) versus offloaded to their
+# pools, and without any upload as the baseline. Answers come from a local fake OpenAI server and chunks go to
+# the local store. Run it with the server dependencies installed, so tasks run on gevent as they do in production.
+# Run from the src folder: python -m benchmarks.offload_streaming
+import argparse
+import os
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+import openai
+from tabulate import tabulate
+
+from config import settings
+
+KNOWLEDGE_BASE_ID = 'offload-streaming-benchmark'
+
+WORDS = "device settings menu power button reset firmware update network password account invoice printer".split()
+
+
+def write_document(file_path: str, chunks: int):
+    # Paragraphs of about 1200 characters, every one becomes a chunk
+    with open(file_path, 'w') as file:
+        file.write("\n\n".join(
+            f"Section {i}: " + " ".join(WORDS[(i * 7 + j * 3) % len(WORDS)] for j in range(170)) + "."
+            for i in range(chunks)
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=1000)
+    parser.add_argument('--streams', type=int, default=4)
+    parser.add_argument('--baseline-answers', type=int, default=3)
+    parser.add_argument('--port', type=int, default=8768)
+    parser.add_argument('--answer-tokens', type=int, default=300)
+    parser.add_argument('--first-token-latency', type=float, default=0.1)
+    parser.add_argument('--token-interval', type=float, default=0.01)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp()
+
+    # Stores and indexes read their location when their modules are imported, so settings are overridden first
+    settings.set('embeddings_store.backend', 'local')
+    settings.set('embeddings_store.local.path', f"{data_dir}/embeddings")
+    settings.set('lexical_index.path', f"{data_dir}/lexical")
+    settings.set('embeddings_cache.enabled', False)
+    settings.set('limits.max_total_chunks', args.chunks * 2)
+
+    if settings.get('open_ai_secrets') is None:
+        settings.set('open_ai_secrets', { 'api_key': "fake" })
+
+    from api.server_application import socketio
+    from benchmarks.fake_openai import FakeOpenAiServer
+    from services.cpu_offload import PARSING_WORKLOAD, run_offloaded
+    from services.embeddings_calculator import EmbeddingsCalculator
+    from services.embeddings_store_registry import embeddings_stores
+    from services.lexical_index import lexical_indexes
+    from services.llm_provider import LlmProvider
+    from services.resource_ingestion import ingest_resource, parse_resource
+
+    server = FakeOpenAiServer(args.port, args.answer_tokens, args.first_token_latency, args.token_interval)
+    server.start()
+    openai.api_base = server.api_base
+
+    document_path = os.path.join(data_dir, 'upload.txt')
+    write_document(document_path, args.chunks)
+
+    # Load the model and start the parsing processes before anything is timed
+    EmbeddingsCalculator().embed_documents(["warm up"])
+    run_offloaded(PARSING_WORKLOAD, parse_resource, document_path, 'text/plain')
+
+    frame_times: dict[str, list[float]] = defaultdict(list)
+    emit = socketio.emit
+
+    def recording_emit(event, data=None, *emit_args, **emit_kwargs):
+        if event == 'answer_token':
+            frame_times[data['reference']].append(time.perf_counter())
+
+        return emit(event, data, *emit_args, **emit_kwargs)
+
+    socketio.emit = recording_emit
+
+    rows = []
+    for name, upload, offload in [('No upload', False, True), ('Upload, inline', True, False), ('Upload, offloaded', True, True)]:
+        settings.set('cpu_offload.enabled', offload)
+        frame_times.clear()
+        upload_time = 0.0
+        uploading = upload
+
+        def run_upload():
+            nonlocal upload_time, uploading
+            start_time = time.perf_counter()
+
+            try:
+                ingest_resource(KNOWLEDGE_BASE_ID, f"upload-{name}", 'upload.txt', 'text/plain', document_path)
+            finally:
+                upload_time = time.perf_counter() - start_time
+                uploading = False
+
+        def run_stream(stream: int):
+            # Answers one question after another, for as long as the upload runs
+            answers = 0
+
+            while answers == 0 or (uploading if upload else answers < args.baseline_answers):
+                LlmProvider().request_answer("Answer the question using only the sources.", f"{name}-{stream}-{answers}")
+                answers += 1
+
+        tasks = [socketio.start_background_task(run_stream, stream) for stream in range(args.streams)]
+
+        # The upload starts once every answer is streaming, so stalls show up as gaps between their frames
+        while len(frame_times) < args.streams:
+            socketio.sleep(0.01)
+
+        if upload:
+            tasks.append(socketio.start_background_task(run_upload))
+
+        for task in tasks:
+            task.join()
+
+        gaps = np.concatenate([np.diff(times) for times in frame_times.values() if len(times) > 1]) * 1000
+
+        rows.append([
+            name,
+            len(frame_times),
+            f"{np.percentile(gaps, 50):.0f}",
+            f"{np.percentile(gaps, 99):.0f}",
+            f"{gaps.max():.0f}",
+            f"{upload_time:.1f}" if upload else ''
+        ])
+
+    socketio.emit = emit
+
+    print(f"{args.streams} concurrent answer streams, {socketio.async_mode} server, {args.chunks} chunk upload")
+    print(tabulate(rows, headers=['Mode', 'Answers', 'p50 frame gap (ms)', 'p99 frame gap (ms)', 'Max frame gap (ms)', 'Upload (s)']))
+
+    embeddings_stores.drop_store(KNOWLEDGE_BASE_ID)
+    lexical_indexes.drop_index(KNOWLEDGE_BASE_ID)
+
+
+if __name__ == '__main__':
+    main()
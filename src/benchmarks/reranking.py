@@ -0,0 +1,129 @@
+# Compares feeding the top chunks by similarity to the prompt against over-fetching and reranking them with MMR
+# (and the cross-encoder with --cross-encoder), on a synthetic knowledge base in the local store where every passage
+# was chunked into several overlapping, near-duplicate chunks. Reports the latency reranking adds, the prompt tokens
+# of the packed sources and how many distinct passages they cover.
+# Run from the src folder: python -m benchmarks.reranking
+import argparse
+import statistics
+import tempfile
+import time
+
+import numpy as np
+from tabulate import tabulate
+
+from config import settings
+
+KNOWLEDGE_BASE_ID = 'reranking-benchmark'
+MODEL_NAME = 'gpt-3.5-turbo'
+
+WORDS = "device model setting menu network reset firmware update battery display cable port error code support warranty".split()
+
+
+def build_knowledge_base(passages: int, duplicates: int, dimension: int) -> np.ndarray:
+    # Every passage gets a direction and `duplicates` chunks close to it sharing most of their text, as overlapping
+    # chunks of the same paragraph do. Returns the passage directions
+    from services.embeddings_store import ResourceChunkInfo
+    from services.embeddings_store_registry import embeddings_stores
+
+    rng = np.random.default_rng(0)
+    directions = rng.standard_normal((passages, dimension)).astype(np.float32)
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    rows = []
+
+    for passage, direction in enumerate(directions):
+        text = " ".join(rng.choice(WORDS, size=200))
+
+        for duplicate in range(duplicates):
+            embedding = direction + rng.standard_normal(dimension).astype(np.float32) * 0.01
+            rows.append(ResourceChunkInfo(
+                id=None,
+                resource_name=f"manual-{passage // 50}.pdf",
+                resource_id=f"manual-{passage // 50}",
+                data=f"{text[duplicate * 40:]} {' '.join(rng.choice(WORDS, size=8))}",
+                chunk_number=passage * duplicates + duplicate,
+                total_chunks=passages * duplicates,
+                percentage_in=0.0,
+                page_index=passage,
+                resource_mimetype='application/pdf',
+                content_hash="",
+                embeddings=embedding / np.linalg.norm(embedding)
+            ))
+
+    embeddings_stores.get_store(KNOWLEDGE_BASE_ID, create_index=True).insert_resource_chunks(rows)
+
+    return directions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--passages', type=int, default=2000)
+    parser.add_argument('--duplicates', type=int, default=4)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--chunks', type=int, default=12, help='Chunks the prompt takes without reranking')
+    parser.add_argument('--cross-encoder', action='store_true', help='Also rerank with the cross-encoder, needs sentence-transformers')
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp()
+
+    # Stores read their location when their modules are imported, so settings are overridden first
+    settings.set('embeddings_store.backend', 'local')
+    settings.set('embeddings_store.local.path', f"{data_dir}/embeddings")
+    settings.set('retrieval.mode', 'vector')
+
+    from api.controllers.utils.context_builder import pack_context
+    from services.embeddings_store_registry import embeddings_stores
+    from services.reranking import rerank_chunks
+    from services.retrieval import search_chunks
+
+    directions = build_knowledge_base(args.passages, args.duplicates, settings.database.embedding_size)
+
+    # Queries are halfway between two passages, so a good set of sources covers both
+    rng = np.random.default_rng(1)
+    pairs = rng.integers(args.passages, size=(args.queries, 2))
+    queries = directions[pairs[:, 0]] + 0.9 * directions[pairs[:, 1]] + rng.standard_normal((args.queries, directions.shape[1])).astype(np.float32) * 0.02
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    modes = [('Top by similarity', False, False), ('MMR', True, False)] + ([('Cross-encoder + MMR', True, True)] if args.cross_encoder else [])
+    rows = []
+
+    for name, reranking, cross_encoder in modes:
+        settings.set('reranking.enabled', reranking)
+        settings.set('reranking.cross_encoder.enabled', cross_encoder)
+
+        latencies: list[float] = []
+        rerank_latencies: list[float] = []
+        chunk_counts: list[int] = []
+        tokens: list[int] = []
+        passages: list[int] = []
+
+        for query in queries:
+            start_time = time.perf_counter()
+            candidates = search_chunks(KNOWLEDGE_BASE_ID, "", query, args.chunks * settings.reranking.candidates_multiplier if reranking else args.chunks)
+            rerank_start_time = time.perf_counter()
+            chunks = rerank_chunks(KNOWLEDGE_BASE_ID, "device settings", query, candidates, args.chunks)
+            end_time = time.perf_counter()
+
+            latencies.append((end_time - start_time) * 1000)
+            rerank_latencies.append((end_time - rerank_start_time) * 1000)
+            chunk_counts.append(len(chunks))
+            tokens.append(pack_context(chunks, MODEL_NAME, 1_000_000).tokens)
+            passages.append(len({chunk.page_index for chunk, _ in chunks}))
+
+        rows.append([
+            name,
+            f"{statistics.median(latencies):.2f}",
+            f"{statistics.median(rerank_latencies):.2f}",
+            f"{statistics.quantiles(rerank_latencies, n=20)[18]:.2f}",
+            f"{statistics.mean(chunk_counts):.1f}",
+            f"{statistics.mean(tokens):.0f}",
+            f"{statistics.mean(passages):.2f}"
+        ])
+
+    print(f"{args.passages} passages with {args.duplicates} overlapping chunks each, {args.queries} queries")
+    print(tabulate(rows, headers=['Mode', 'Retrieval p50 (ms)', 'Rerank p50 (ms)', 'Rerank p95 (ms)', 'Chunks', 'Prompt tokens', 'Distinct passages']))
+
+    embeddings_stores.drop_store(KNOWLEDGE_BASE_ID)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# Compares one Milvus collection per knowledge base with knowledge bases sharing collections (milvus.storage_mode):
+# time to set up 5000 knowledge bases of 200 chunks, search latency over random knowledge bases through the store
+# registry, collections loaded on the way, and the resident memory Milvus reports. Needs a running Milvus, with its
+# metrics on --metrics-url. Every collection it creates is dropped at the end.
+# Run from the src folder: python -m benchmarks.shared_collections
+import argparse
+import random
+import re
+import time
+import urllib.request
+from typing import Optional
+
+import numpy as np
+from tabulate import tabulate
+
+from config import settings
+from custom_types import Wisdom
+
+KNOWLEDGE_BASE_PREFIX = 'shared-collections-benchmark'
+MODES = ['collection_per_knowledge_base', 'shared']
+
+
+def milvus_resident_memory(metrics_url: str) -> Optional[float]:
+    # Sum over the Milvus processes exposing metrics on the URL, in MiB
+    try:
+        with urllib.request.urlopen(metrics_url, timeout=5) as response:
+            metrics = response.read().decode('utf-8')
+    except OSError:
+        return None
+
+    values = [float(value) for value in re.findall(r"^process_resident_memory_bytes(?:\{[^}]*\})? (\S+)$", metrics, re.MULTILINE)]
+
+    return sum(values) / 1024 / 1024 if values else None
+
+
+def random_unit_vectors(rng: np.random.Generator, count: int) -> np.ndarray:
+    vectors = rng.standard_normal((count, settings.database.embedding_size)).astype(np.float32)
+
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def run_mode(mode: str, args: argparse.Namespace) -> list:
+    from pymilvus import MilvusException, utility
+    from services.embeddings_store import ResourceChunkInfo
+    from services.embeddings_store_registry import EmbeddingsStoreRegistry, create_embeddings_store
+    from services.metrics import STORE_LOAD_STAGE, stage_duration
+    from services.milvus_embeddings_store import flush_scheduler
+
+    # Shared collections of its own, so the ones of the service are never dropped
+    settings.set('milvus.storage_mode', mode)
+    settings.set('milvus.shared.collection_prefix', KNOWLEDGE_BASE_PREFIX.replace('-', '_'))
+    rng = np.random.default_rng(0)
+    knowledge_base_ids = [f"{KNOWLEDGE_BASE_PREFIX}-{i}" for i in range(args.bases)]
+    collection_names: set[str] = set()
+    ready_bases = 0
+
+    start_time = time.perf_counter()
+
+    # Milvus limits the number of collections, a failure is part of the result
+    try:
+        for knowledge_base_id in knowledge_base_ids:
+            store = create_embeddings_store(knowledge_base_id)
+            store.setup(create_index=True)
+            collection_names.add(store.collection_name)
+
+            store.insert_resource_chunks([ResourceChunkInfo(
+                id=None,
+                resource_name="manual.pdf",
+                resource_id="manual",
+                data=f"Chunk {i} of knowledge base {knowledge_base_id}",
+                chunk_number=i,
+                total_chunks=args.chunks,
+                percentage_in=i / args.chunks,
+                page_index=i,
+                resource_mimetype='application/pdf',
+                content_hash="",
+                embeddings=embedding
+            ) for i, embedding in enumerate(random_unit_vectors(rng, args.chunks))])
+            ready_bases += 1
+
+        flush_scheduler.flush_pending()
+    except MilvusException as e:
+        print(f"{mode}: setting up knowledge base {ready_bases + 1} failed: {e}")
+
+    setup_time = time.perf_counter() - start_time
+
+    # Searches go through a registry like requests do, so per base collections are loaded and released on the way
+    registry = EmbeddingsStoreRegistry(settings.embeddings_store.max_loaded_collections, settings.embeddings_store.idle_release_seconds)
+    searched_bases = random.Random(0).choices(knowledge_base_ids[:ready_bases], k=args.searches) if ready_bases else []
+    latencies = []
+    loads_before = sum(stage_duration.series.get((STORE_LOAD_STAGE,), [0.0])[:-1])
+
+    for knowledge_base_id, query in zip(searched_bases, random_unit_vectors(rng, len(searched_bases))):
+        search_start_time = time.perf_counter()
+        registry.get_store(knowledge_base_id).search_similar_chunks(query, 10, Wisdom.MEDIUM)
+        latencies.append((time.perf_counter() - search_start_time) * 1000)
+
+    # The registry times every collection it loads
+    loads = int(sum(stage_duration.series.get((STORE_LOAD_STAGE,), [0.0])[:-1]) - loads_before)
+    memory = milvus_resident_memory(args.metrics_url)
+
+    for collection_name in collection_names:
+        flush_scheduler.forget(collection_name)
+        utility.drop_collection(collection_name)
+
+    return [
+        mode,
+        f"{ready_bases}/{args.bases}",
+        len(collection_names),
+        f"{setup_time:.0f}",
+        *([f"{np.percentile(latencies, p):.1f}" for p in [50, 95, 99]] if latencies else ['', '', '']),
+        loads,
+        f"{memory:.0f}" if memory is not None else ''
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bases', type=int, default=5000)
+    parser.add_argument('--chunks', type=int, default=200)
+    parser.add_argument('--searches', type=int, default=1000)
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--metrics-url', default=f"http://{settings.milvus.host}:9091/metrics")
+    args = parser.parse_args()
+
+    from services.milvus_embeddings_store import connect_milvus
+
+    connect_milvus()
+
+    rows = [run_mode(mode, args) for mode in args.modes]
+
+    print(f"{args.bases} knowledge bases of {args.chunks} chunks, {args.searches} searches over random knowledge bases")
+    print(tabulate(rows, headers=[
+        'Storage mode', 'Knowledge bases', 'Collections', 'Setup (s)', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'Collection loads', 'Milvus RSS (MiB)'
+    ]))
+
+
+if __name__ == '__main__':
+    main()
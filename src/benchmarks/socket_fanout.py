@@ -0,0 +1,81 @@
+# Streams answers while 500 Socket.IO clients are connected, one of them per answer subscribed to its reference,
+# and counts the answer_token frames and bytes delivered per answer and the time spent emitting them, broadcasting
+# every frame to every client (socketio.broadcast_events) versus per reference rooms. Clients are in process
+# Flask-SocketIO test clients, so no server or network is needed.
+# Run from the src folder: python -m benchmarks.socket_fanout
+import argparse
+import json
+import time
+
+from tabulate import tabulate
+
+from config import settings
+
+WORDS = "the device can be reset from the settings menu by holding the power button for ten seconds".split()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--answers', type=int, default=50)
+    parser.add_argument('--answer-tokens', type=int, default=200)
+    args = parser.parse_args()
+
+    if settings.get('open_ai_secrets') is None:
+        settings.set('open_ai_secrets', { 'api_key': "fake" })
+
+    from api.application import app
+    from api.server_application import socketio
+    from services.llm_stream_handler import LlmStreamHandler
+
+    namespace = settings.socketio.namespace
+    clients = [socketio.test_client(app, namespace=namespace) for _ in range(args.clients)]
+    tokens = [f"{WORDS[i % len(WORDS)]} " for i in range(args.answer_tokens)]
+
+    # The first clients each wait for one answer, the others are idle, e.g. users reading a previous answer
+    for i in range(args.answers):
+        clients[i].emit('subscribe', { 'reference': f"answer-{i}" }, namespace=namespace, callback=True)
+
+    rows = []
+    for name, broadcast in [('Broadcast to every client', True), ('Rooms per reference', False)]:
+        settings.set('socketio.broadcast_events', broadcast)
+
+        for client in clients:
+            client.get_received(namespace)
+
+        start_time = time.perf_counter()
+
+        for i in range(args.answers):
+            LlmStreamHandler(f"answer-{i}").replay_tokens(tokens)
+
+        elapsed_time = time.perf_counter() - start_time
+        frames = 0
+        frame_bytes = 0
+        misdelivered_frames = 0
+
+        for i, client in enumerate(clients):
+            for packet in client.get_received(namespace):
+                if packet['name'] != 'answer_token':
+                    continue
+
+                frames += 1
+                frame_bytes += len("42" + json.dumps([packet['name'], *packet['args']], separators=(',', ':')))
+                misdelivered_frames += packet['args'][0]['reference'] != f"answer-{i}"
+
+        rows.append([
+            name,
+            f"{frames / args.answers:.0f}",
+            f"{frame_bytes / args.answers / 1024:.1f}",
+            f"{misdelivered_frames / frames:.1%}",
+            f"{elapsed_time / args.answers * 1000:.2f}"
+        ])
+
+    for client in clients:
+        client.disconnect(namespace=namespace)
+
+    print(f"{args.clients} connected clients, {args.answers} answers of {args.answer_tokens} tokens")
+    print(tabulate(rows, headers=['Delivery', 'Frames delivered per answer', 'KiB per answer', 'Frames for other answers', 'Emit time per answer (ms)']))
+
+
+if __name__ == '__main__':
+    main()
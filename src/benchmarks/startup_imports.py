@@ -0,0 +1,73 @@
+# Startup import profile: runs python -X importtime on the service modules and reports the total import time and the
+# packages that take most of it, so heavy dependencies creeping back into the import path are easy to spot.
+# Run from the src folder: python -m benchmarks.startup_imports [--max-seconds 2]
+import argparse
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+from tabulate import tabulate
+
+IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+# Should never be imported just by starting the service
+HEAVY_PACKAGES = ['torch', 'sentence_transformers', 'transformers', 'langchain', 'unstructured', 'pymilvus', 'onnxruntime', 'openai', 'tiktoken']
+
+
+def profile_imports(module: str) -> tuple[int, dict[str, int]]:
+    # Returns the cumulative import time of the module and the self time per top level package, in microseconds
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], capture_output=True, text=True)
+
+    if process.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{process.stderr[-2000:]}")
+
+    total_time = 0
+    package_times: dict[str, int] = defaultdict(int)
+
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+
+        if match is None:
+            continue
+
+        self_time, cumulative_time, _, imported_module = match.groups()
+        package_times[imported_module.split('.')[0]] += int(self_time)
+
+        if imported_module == module:
+            total_time = int(cumulative_time)
+
+    return total_time, package_times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='api.application')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--max-seconds', type=float, help='Exit with an error when importing takes longer')
+    args = parser.parse_args()
+
+    # The fastest run is reported, the others pay for cold file system caches
+    profiles = [profile_imports(args.module) for _ in range(args.runs)]
+    total_time, package_times = min(profiles, key=lambda profile: profile[0])
+
+    rows = sorted(package_times.items(), key=lambda item: item[1], reverse=True)[:args.top]
+
+    print(tabulate(
+        [[package, f"{self_time / 1000:.1f}", f"{100 * self_time / max(total_time, 1):.1f}"] for package, self_time in rows],
+        headers=['Package', 'Self time (ms)', 'Share (%)']
+    ))
+    print(f"\nImporting {args.module} took {total_time / 1e6:.2f} seconds")
+
+    heavy_packages = [package for package in HEAVY_PACKAGES if package in package_times]
+
+    if len(heavy_packages) > 0:
+        print(f"Heavy packages imported at startup: {', '.join(heavy_packages)}")
+
+    if args.max_seconds is not None and (total_time / 1e6 > args.max_seconds or len(heavy_packages) > 0):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
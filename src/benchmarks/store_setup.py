@@ -0,0 +1,50 @@
+# Compares the time /answer-request spends setting up and loading the embeddings store when a new store is
+# built per request against the shared registry. Needs a running Milvus with an existing knowledge base.
+# Run from the src folder: python -m benchmarks.store_setup <knowledge_base_id>
+import argparse
+import statistics
+import time
+
+from tabulate import tabulate
+
+from services.milvus_embeddings_store import CollectionEmbeddingsStore, connect_milvus
+from services.embeddings_store_registry import embeddings_stores
+
+
+def measure_per_request_store(knowledge_base_id: str) -> float:
+    start_time = time.perf_counter()
+
+    embeddings_store = CollectionEmbeddingsStore(collection_name=knowledge_base_id)
+    embeddings_store.setup()
+    embeddings_store.collection.load()
+
+    return time.perf_counter() - start_time
+
+
+def measure_registry_store(knowledge_base_id: str) -> float:
+    start_time = time.perf_counter()
+
+    embeddings_stores.get_store(knowledge_base_id)
+
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('knowledge_base_id')
+    parser.add_argument('--requests', type=int, default=100)
+    args = parser.parse_args()
+
+    connect_milvus()
+
+    rows = []
+    for name, measure in [('Store per request', measure_per_request_store), ('Store registry', measure_registry_store)]:
+        timings = [measure(args.knowledge_base_id) * 1000 for _ in range(args.requests)]
+
+        rows.append([name, f"{statistics.median(timings):.2f}", f"{statistics.quantiles(timings, n=100)[94]:.2f}", f"{max(timings):.2f}"])
+
+    print(tabulate(rows, headers=['Mode', 'p50 (ms)', 'p95 (ms)', 'max (ms)']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# Compares peak memory and latency of loading and splitting a synthetic 2000 page PDF with the
+# previous materialize-everything approach and with the streaming pipeline.
+# Run from the src folder: python -m benchmarks.streaming_ingestion
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from typing import Callable
+
+from langchain.document_loaders import PyPDFLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from tabulate import tabulate
+
+from config import settings
+from services.resource_ingestion import ResourceLimitExceededError, iterate_resource_pages, split_resource
+
+WORDS = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore".split()
+
+
+def write_synthetic_pdf(file_path: str, pages: int, lines_per_page: int = 45):
+    # Minimal PDF writer: one Helvetica text stream per page, enough for pypdf text extraction
+    objects: list[bytes] = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    ]
+    page_ids = []
+
+    for page in range(pages):
+        lines = [
+            " ".join(WORDS[(page + line + i) % len(WORDS)] for i in range(12)) + f" {page}.{line}"
+            for line in range(lines_per_page)
+        ]
+        content = "BT /F1 10 Tf 14 TL 40 800 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+        content_bytes = content.encode('latin-1')
+
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content_bytes), content_bytes))
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R /Resources << /Font << /F1 3 0 R >> >> >>" % content_id)
+        page_ids.append(len(objects))
+
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % i for i in page_ids), pages)
+
+    with open(file_path, 'wb') as pdf_file:
+        pdf_file.write(b"%PDF-1.4\n")
+        offsets = []
+
+        for i, body in enumerate(objects):
+            offsets.append(pdf_file.tell())
+            pdf_file.write(b"%d 0 obj\n%s\nendobj\n" % (i + 1, body))
+
+        xref_offset = pdf_file.tell()
+        pdf_file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        pdf_file.write(b"".join(b"%010d 00000 n \n" % offset for offset in offsets))
+        pdf_file.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset))
+
+
+def materialized_load_and_split(file_path: str) -> int:
+    docs = PyPDFLoader(file_path).load()
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=settings.chunking.chunk_size,
+        chunk_overlap=settings.chunking.chunk_overlap,
+        length_function=len,
+    )
+
+    texts = text_splitter.split_documents(docs)
+
+    if len(texts) > settings.limits.max_total_chunks:
+        raise ResourceLimitExceededError('Too many chunks')
+
+    return len(texts)
+
+
+def streaming_load_and_split(file_path: str) -> int:
+    return len(split_resource(iterate_resource_pages(file_path, 'application/pdf')))
+
+
+def measure(operation: Callable[[str], int], file_path: str) -> tuple[str, float, float]:
+    tracemalloc.start()
+    start_time = time.perf_counter()
+
+    try:
+        outcome = f"{operation(file_path)} chunks"
+    except ResourceLimitExceededError as e:
+        outcome = f"aborted: {e}"
+
+    elapsed_time = time.perf_counter() - start_time
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return outcome, elapsed_time, peak_memory / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_path = os.path.join(tmpdir, 'synthetic.pdf')
+        write_synthetic_pdf(file_path, args.pages)
+
+        rows = []
+        for limits in ['default', 'unlimited']:
+            if limits == 'unlimited':
+                settings.set('limits.max_total_chunks', 10 ** 9)
+                settings.set('limits.max_total_characters', 10 ** 12)
+
+            for name, operation in [('Materialized', materialized_load_and_split), ('Streaming', streaming_load_and_split)]:
+                outcome, elapsed_time, peak_memory = measure(operation, file_path)
+                rows.append([name, limits, outcome, f"{elapsed_time:.2f}", f"{peak_memory:.1f}"])
+
+    print(tabulate(rows, headers=['Pipeline', 'Limits', 'Outcome', 'Seconds', 'Peak MiB']))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,15 @@ import json
 from api.server_application import socketio
 from api.application import app
 from config import settings, settings_without_secrets
-from pymilvus import connections
+from services.warmup import start_service_warmup
 from logger import logger
 
 
 logger.info("Settings *WITHOUT* secrets:")
 logger.info(json.dumps(settings_without_secrets.as_dict(), indent=4))
 
-connections.connect(host=settings.milvus.host, port=settings.milvus.port)
+# The embeddings model, the Milvus connection and other slow dependencies load in the background,
+# GET /ready answers 200 once they are done
+start_service_warmup()
 
 socketio.run(app, port=settings.server.port, host='0.0.0.0')
@@ -0,0 +1,177 @@
+# Moves the chunk metadata kept as a JSON string in the payload field of every knowledge base into scalar fields
+# of their own. Milvus schemas cannot gain fields, so every legacy collection is copied into a new one, which then
+# takes its name. Copied chunks get new ids: the lexical index of the knowledge base is remapped, and the mapping of
+# every collection is written to --id-map for the callers that kept chunk ids. Local stores keep their ids, their
+# metadata file is rewritten. Answers cached for migrated knowledge bases cite the old ids, so they are dropped: ids
+# of knowledge bases are restored from collection names like in migrations.shared_collections. Stop the service while
+# migrating.
+# Run from the src folder: python -m migrations.chunk_fields [--backend milvus|local] [--knowledge-base-ids ids.txt]
+import argparse
+import json
+import os
+import re
+import time
+from typing import Optional
+
+from config import settings
+from services.embeddings_store import (
+    ID_FIELD, RESOURCE_NAME_FIELD, RESOURCE_ID_FIELD, DATA_FIELD, EMBEDDINGS_FIELD, PAYLOAD_FIELD, fields_from_payload
+)
+from services.lexical_index import LexicalIndex
+from services.answer_cache import answer_cache
+from logger import logger
+
+MIGRATION_SUFFIX = "_chunk_fields"
+LEGACY_SUFFIX = "_legacy"
+UUID_COLLECTION_NAME = re.compile(r"^_([0-9a-fA-F]{8})_([0-9a-fA-F]{4})_([0-9a-fA-F]{4})_([0-9a-fA-F]{4})_([0-9a-fA-F]{12})$")
+
+
+def read_known_ids(path: Optional[str]) -> dict[str, str]:
+    # Keyed by their collection names, made the same way as the stores make them
+    if not path:
+        return {}
+
+    with open(path) as ids_file:
+        return {"_" + id.replace("-", "_"): id for id in (line.strip() for line in ids_file) if id}
+
+
+def knowledge_base_id_of(collection_name: str, known_ids: dict[str, str]) -> Optional[str]:
+    if collection_name in known_ids:
+        return known_ids[collection_name]
+
+    match = UUID_COLLECTION_NAME.match(collection_name)
+
+    return "-".join(match.groups()) if match else None
+
+
+def remap_lexical_index(collection_name: str, id_map: dict[int, int]):
+    # Lexical index files are named after the knowledge base like collections are
+    file_path = os.path.join(settings.lexical_index.path, collection_name + ".npz")
+
+    if not os.path.exists(file_path):
+        return
+
+    index = LexicalIndex(file_path)
+    index.load()
+    index.remap_chunk_ids(id_map)
+
+
+def migrate_milvus_collection(collection_name: str, batch_size: int, keep_legacy: bool) -> dict[int, int]:
+    from pymilvus import Collection, utility
+    from services.milvus_embeddings_store import INSERT_FIELDS, build_resource_chunk_schema, query_pages
+
+    start_time = time.time()
+    legacy_collection = Collection(collection_name)
+    legacy_collection.load()
+
+    # Left over by an interrupted run, the legacy collection is still complete
+    if utility.has_collection(collection_name + MIGRATION_SUFFIX):
+        utility.drop_collection(collection_name + MIGRATION_SUFFIX)
+
+    collection = Collection(collection_name + MIGRATION_SUFFIX, build_resource_chunk_schema(), consistency_level="Bounded")
+    id_map: dict[int, int] = {}
+
+    output_fields = [RESOURCE_NAME_FIELD, RESOURCE_ID_FIELD, DATA_FIELD, EMBEDDINGS_FIELD, PAYLOAD_FIELD]
+
+    for rows in query_pages(legacy_collection, output_fields, batch_size):
+        rows = [{**row, **fields_from_payload(row[PAYLOAD_FIELD])} for row in rows]
+        new_ids = collection.insert([[row[field] for row in rows] for field in INSERT_FIELDS]).primary_keys
+
+        id_map.update(zip((row[ID_FIELD] for row in rows), new_ids))
+
+    collection.flush()
+    legacy_collection.release()
+
+    # The index is built by the store on first use, with the profile that fits the size of the collection
+    utility.rename_collection(collection_name, collection_name + LEGACY_SUFFIX)
+    utility.rename_collection(collection_name + MIGRATION_SUFFIX, collection_name)
+
+    if not keep_legacy:
+        utility.drop_collection(collection_name + LEGACY_SUFFIX)
+
+    remap_lexical_index(collection_name, id_map)
+
+    logger.info(f"Migrated {len(id_map)} chunks of collection {collection_name} in {time.time() - start_time:.2f} seconds")
+
+    return id_map
+
+
+def migrate_milvus(batch_size: int, keep_legacy: bool, id_map_path: str, known_ids: dict[str, str]):
+    from pymilvus import Collection, utility
+    from services.milvus_embeddings_store import connect_milvus
+
+    connect_milvus()
+
+    id_maps: dict[str, dict[int, int]] = {}
+
+    for collection_name in utility.list_collections():
+        if collection_name.endswith(LEGACY_SUFFIX) or collection_name.endswith(MIGRATION_SUFFIX):
+            continue
+
+        if PAYLOAD_FIELD not in [field.name for field in Collection(collection_name).schema.fields]:
+            continue
+
+        id_maps[collection_name] = migrate_milvus_collection(collection_name, batch_size, keep_legacy)
+        invalidate_cached_answers(collection_name, known_ids)
+
+        # Written after every collection, so an interrupted run keeps the mappings of the migrated ones
+        with open(id_map_path, 'w') as id_map_file:
+            json.dump(id_maps, id_map_file)
+
+    logger.info(f"Migrated {len(id_maps)} Milvus collections, chunk id mappings are in {id_map_path}")
+
+
+def invalidate_cached_answers(collection_name: str, known_ids: dict[str, str]):
+    # Versions are shared through Redis, so this also reaches server processes started before the migration
+    knowledge_base_id = knowledge_base_id_of(collection_name, known_ids)
+
+    if knowledge_base_id is None:
+        logger.warning(f"Kept the cached answers of collection {collection_name}, its knowledge base id is not in --knowledge-base-ids")
+        return
+
+    answer_cache.invalidate(knowledge_base_id)
+
+
+def migrate_local(path: str):
+    from services.local_embeddings_store import METADATA_FILE, upgrade_legacy_metadata
+
+    migrated = 0
+
+    for collection_name in sorted(os.listdir(path)) if os.path.isdir(path) else []:
+        metadata_path = os.path.join(path, collection_name, METADATA_FILE)
+
+        if not os.path.exists(metadata_path):
+            continue
+
+        with open(metadata_path, 'r') as metadata_file:
+            metadata = json.load(metadata_file)
+
+        if PAYLOAD_FIELD not in metadata:
+            continue
+
+        with open(metadata_path + '.tmp', 'w') as metadata_file:
+            json.dump(upgrade_legacy_metadata(metadata), metadata_file)
+
+        os.replace(metadata_path + '.tmp', metadata_path)
+        migrated += 1
+
+    logger.info(f"Migrated {migrated} local embeddings stores in {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', choices=['milvus', 'local'], default=settings.embeddings_store.backend)
+    parser.add_argument('--batch-size', type=int, default=1000, help='Chunks copied per Milvus query')
+    parser.add_argument('--keep-legacy', action='store_true', help=f"Keep legacy Milvus collections, renamed with a {LEGACY_SUFFIX} suffix")
+    parser.add_argument('--id-map', default='chunk_id_map.json', help='Where the new id of every copied Milvus chunk is written')
+    parser.add_argument('--knowledge-base-ids', help='File with the id of every knowledge base, one per line')
+    args = parser.parse_args()
+
+    if args.backend == 'milvus':
+        migrate_milvus(args.batch_size, args.keep_legacy, args.id_map, read_known_ids(args.knowledge_base_ids))
+    else:
+        migrate_local(settings.embeddings_store.local.path)
+
+
+if __name__ == '__main__':
+    main()
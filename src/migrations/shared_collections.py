@@ -0,0 +1,110 @@
+# Moves the chunks of every knowledge base kept in a collection of its own into the shared collections of
+# milvus.storage_mode "shared". Collection names lost the dashes of knowledge base ids, so ids are read from
+# --knowledge-base-ids (one per line) when given, and otherwise restored for ids shaped like UUIDs. Copied chunks
+# get new ids: the lexical index of every knowledge base is remapped, and the mapping of every collection is
+# written to --id-map for the callers that kept chunk ids. Answers cached for the knowledge base cite the old ids, so
+# they are dropped. Stop the service while migrating, and set milvus.storage_mode to "shared" before starting it again.
+# Run from the src folder: python -m migrations.shared_collections [--keep-collections]
+import argparse
+import json
+import time
+
+from config import settings
+from migrations.chunk_fields import (
+    LEGACY_SUFFIX, MIGRATION_SUFFIX, knowledge_base_id_of, read_known_ids, remap_lexical_index
+)
+from services.answer_cache import answer_cache
+from services.embeddings_store import METADATA_FIELDS, EMBEDDINGS_FIELD, PAYLOAD_FIELD, ResourceChunkInfo
+from logger import logger
+
+
+def migrate_collection(collection_name: str, knowledge_base_id: str, batch_size: int, keep_collection: bool) -> dict[int, int]:
+    import numpy as np
+    from pymilvus import Collection, utility
+    from services.milvus_embeddings_store import SharedCollectionEmbeddingsStore, query_pages
+
+    start_time = time.time()
+    collection = Collection(collection_name)
+    collection.load()
+
+    # Chunks left over by an interrupted run are deleted, the collection of the knowledge base is still complete
+    store = SharedCollectionEmbeddingsStore(knowledge_base_id)
+    store.drop_collection()
+    id_map: dict[int, int] = {}
+
+    for rows in query_pages(collection, METADATA_FIELDS + [EMBEDDINGS_FIELD], batch_size):
+        chunks = [ResourceChunkInfo.from_fields(r) for r in rows]
+
+        for chunk in chunks:
+            chunk.embeddings = np.asarray(chunk.embeddings, dtype=np.float32)
+
+        id_map.update(zip((chunk.id for chunk in chunks), store.insert_resource_chunks([chunk.copy(id=None) for chunk in chunks])))
+
+    collection.release()
+
+    if not keep_collection:
+        utility.drop_collection(collection_name)
+
+    remap_lexical_index(collection_name, id_map)
+    answer_cache.invalidate(knowledge_base_id)
+
+    logger.info(
+        f"Moved {len(id_map)} chunks of knowledge base {knowledge_base_id} into collection {store.collection_name} "
+        f"in {time.time() - start_time:.2f} seconds"
+    )
+
+    return id_map
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--knowledge-base-ids', help='File with the id of every knowledge base, one per line')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Chunks copied per Milvus query')
+    parser.add_argument('--keep-collections', action='store_true', help='Keep the collections of the knowledge bases once copied')
+    parser.add_argument('--id-map', default='chunk_id_map.json', help='Where the new id of every copied chunk is written')
+    args = parser.parse_args()
+
+    from pymilvus import Collection, utility
+    from services.milvus_embeddings_store import KNOWLEDGE_BASE_ID_FIELD, connect_milvus, flush_scheduler
+
+    connect_milvus()
+
+    known_ids = read_known_ids(args.knowledge_base_ids)
+    id_maps: dict[str, dict[int, int]] = {}
+    start_time = time.time()
+
+    for collection_name in utility.list_collections():
+        if collection_name.endswith(LEGACY_SUFFIX) or collection_name.endswith(MIGRATION_SUFFIX):
+            continue
+
+        field_names = [field.name for field in Collection(collection_name).schema.fields]
+
+        if KNOWLEDGE_BASE_ID_FIELD in field_names:
+            continue
+
+        if PAYLOAD_FIELD in field_names:
+            logger.warning(f"Skipped collection {collection_name}, migrate it first with: python -m migrations.chunk_fields")
+            continue
+
+        knowledge_base_id = knowledge_base_id_of(collection_name, known_ids)
+
+        if knowledge_base_id is None:
+            logger.warning(f"Skipped collection {collection_name}, its knowledge base id is not in --knowledge-base-ids")
+            continue
+
+        id_maps[collection_name] = migrate_collection(collection_name, knowledge_base_id, args.batch_size, args.keep_collections)
+
+        # Written after every collection, so an interrupted run keeps the mappings of the migrated ones
+        with open(args.id_map, 'w') as id_map_file:
+            json.dump(id_maps, id_map_file)
+
+    flush_scheduler.flush_pending()
+
+    logger.info(
+        f"Moved {len(id_maps)} knowledge bases into {settings.milvus.shared.collections} shared collections "
+        f"in {time.time() - start_time:.2f} seconds, chunk id mappings are in {args.id_map}"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+import json
+import threading
+import time
+from typing import Any, Optional
+
+import numpy as np
+
+from config import settings
+from custom_types import Wisdom
+from services.metrics import answer_cache_hits, answer_cache_latency_saved, answer_cache_misses
+from logger import logger
+
+
+class CachedAnswer:
+    def __init__(
+        self,
+        query_embedding: np.ndarray,
+        wisdom_level: Wisdom,
+        language: Optional[str],
+        answer: str,
+        sources: list[dict[str, Any]],
+        tokens: list[str],
+        latency: float
+    ):
+        self.query_embedding = query_embedding
+        self.wisdom_level = wisdom_level
+        self.language = language
+        self.answer = answer
+        self.sources = sources
+        self.tokens = tokens
+        self.latency = latency
+        self.created_at = time.time()
+
+
+class AnswerCacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+
+    def to_dict(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            'latency_saved_seconds': self.latency_saved
+        }
+
+
+class AnswerCache:
+    # Answers are cached per knowledge base and matched by query embedding similarity. Every write to a knowledge
+    # base bumps its version, which drops its entries and keeps answers computed against the old content out.
+    # With several server processes, versions are shared through Redis, see RedisAnswerCacheVersions
+    def __init__(
+        self,
+        similarity_threshold: float,
+        max_entries_per_knowledge_base: int,
+        ttl: float,
+        shared_versions: Optional['RedisAnswerCacheVersions'] = None,
+        unshared_processes: bool = False
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries_per_knowledge_base = max_entries_per_knowledge_base
+        self.ttl = ttl
+        self.shared_versions = shared_versions
+        self.unshared_processes = unshared_processes
+        self.versions: dict[str, int] = {}
+        self.entries: dict[str, list[CachedAnswer]] = {}
+        self.stats = AnswerCacheStats()
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        # Server processes without shared versions would keep serving answers from before the writes of the others
+        return settings.answer_cache.enabled and not self.unshared_processes
+
+    def version(self, knowledge_base_id: str) -> int:
+        return self.versions.get(knowledge_base_id, 0)
+
+    def lookup(self, knowledge_base_id: str, wisdom_level: Wisdom, language: Optional[str], query_embedding: np.ndarray) -> Optional[CachedAnswer]:
+        now = time.time()
+
+        with self.lock:
+            candidates = [
+                entry for entry in self.entries.get(knowledge_base_id, [])
+                if entry.wisdom_level == wisdom_level and entry.language == language and now - entry.created_at < self.ttl
+            ]
+
+            cached_answer = None
+
+            if len(candidates) > 0:
+                similarities = np.stack([entry.query_embedding for entry in candidates]) @ query_embedding
+                best = int(np.argmax(similarities))
+
+                if similarities[best] >= self.similarity_threshold:
+                    cached_answer = candidates[best]
+
+            if cached_answer is not None:
+                self.stats.hits += 1
+                self.stats.latency_saved += cached_answer.latency
+                answer_cache_hits.inc()
+                answer_cache_latency_saved.inc(amount=cached_answer.latency)
+            else:
+                self.stats.misses += 1
+                answer_cache_misses.inc()
+
+        logger.debug(f"Answer cache {'hit' if cached_answer is not None else 'miss'} for knowledge base {knowledge_base_id}, stats: {self.stats.to_dict()}")
+
+        return cached_answer
+
+    def store(self, knowledge_base_id: str, knowledge_base_version: int, cached_answer: CachedAnswer):
+        with self.lock:
+            # The knowledge base changed while the answer was being computed
+            if self.version(knowledge_base_id) != knowledge_base_version:
+                return
+
+            entries = self.entries.setdefault(knowledge_base_id, [])
+            entries.append(cached_answer)
+
+            if len(entries) > self.max_entries_per_knowledge_base:
+                del entries[0]
+
+    def invalidate(self, knowledge_base_id: str):
+        if self.shared_versions is not None:
+            self.apply_version(knowledge_base_id, self.shared_versions.increment(knowledge_base_id))
+            return
+
+        with self.lock:
+            self.versions[knowledge_base_id] = self.version(knowledge_base_id) + 1
+            self.entries.pop(knowledge_base_id, None)
+
+    def apply_version(self, knowledge_base_id: str, version: int):
+        # Versions only move forward, whether the invalidation was made here or received from another process
+        with self.lock:
+            if version > self.version(knowledge_base_id):
+                self.versions[knowledge_base_id] = version
+                self.entries.pop(knowledge_base_id, None)
+
+    def resync(self, versions: dict[str, int]):
+        # Invalidations published while not subscribed were missed, so every entry is dropped
+        with self.lock:
+            for knowledge_base_id, version in versions.items():
+                self.versions[knowledge_base_id] = max(version, self.version(knowledge_base_id))
+
+            self.entries.clear()
+
+
+class RedisAnswerCacheVersions:
+    # Keeps the version of every knowledge base in Redis, and publishes every new version on a channel that every
+    # server process listens to. Invalidations are rare, so they call Redis right away, while the subscription is
+    # read from a thread of its own as socketio_manager does. Every (re)subscription reads all the versions again
+    def __init__(self, client: Any, channel: str):
+        self.client = client
+        self.channel = channel
+        self.key_prefix = f"{channel}:version:"
+
+    @classmethod
+    def from_url(cls, url: str, channel: str) -> 'RedisAnswerCacheVersions':
+        import redis
+
+        return cls(redis.Redis.from_url(url), channel)
+
+    def increment(self, knowledge_base_id: str) -> int:
+        version = int(self.client.incr(self.key_prefix + knowledge_base_id))
+        self.client.publish(self.channel, json.dumps({'knowledge_base_id': knowledge_base_id, 'version': version}))
+
+        return version
+
+    def read_versions(self) -> dict[str, int]:
+        keys = list(self.client.scan_iter(match=self.key_prefix + '*'))
+        values = self.client.mget(keys) if len(keys) > 0 else []
+
+        return {
+            (key.decode() if isinstance(key, bytes) else key)[len(self.key_prefix):]: int(value)
+            for key, value in zip(keys, values) if value is not None
+        }
+
+    def start_listening(self, cache: AnswerCache):
+        threading.Thread(target=self._listen_forever, args=(cache,), name='answer-cache-listener', daemon=True).start()
+
+    def _listen_forever(self, cache: AnswerCache):
+        while True:
+            try:
+                pubsub = self.client.pubsub()
+                pubsub.subscribe(self.channel)
+
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        cache.resync(self.read_versions())
+                    elif message['type'] == 'message':
+                        invalidation = json.loads(message['data'])
+                        cache.apply_version(invalidation['knowledge_base_id'], invalidation['version'])
+            except Exception:
+                logger.exception("Lost the answer cache invalidations channel, subscribing again")
+
+                time.sleep(1)
+
+
+def create_answer_cache() -> AnswerCache:
+    message_queue = settings.socketio.message_queue
+    shared_versions = None
+
+    if message_queue.startswith(('redis://', 'rediss://')):
+        shared_versions = RedisAnswerCacheVersions.from_url(message_queue, f"{settings.socketio.channel}:answer-cache")
+    elif message_queue:
+        logger.warning("The answer cache is disabled, several server processes only share its versions through Redis")
+
+    cache = AnswerCache(
+        similarity_threshold=settings.answer_cache.similarity_threshold,
+        max_entries_per_knowledge_base=settings.answer_cache.max_entries_per_knowledge_base,
+        ttl=settings.answer_cache.ttl_seconds,
+        shared_versions=shared_versions,
+        unshared_processes=bool(message_queue) and shared_versions is None
+    )
+
+    if shared_versions is not None:
+        shared_versions.start_listening(cache)
+
+    return cache
+
+
+answer_cache = create_answer_cache()
@@ -0,0 +1,56 @@
+import multiprocessing
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+from config import settings
+from services.llm_event_loop import wait_for_future
+from logger import logger
+
+T = TypeVar('T')
+
+QUERY_EMBEDDING_WORKLOAD = 'query_embedding'
+DOCUMENT_EMBEDDING_WORKLOAD = 'document_embedding'
+PARSING_WORKLOAD = 'parsing'
+
+PARSING_PRELOAD_MODULES = ['services.resource_ingestion', 'langchain.document_loaders', 'langchain.text_splitter', 'pypdf']
+
+# Every request runs on the same server loop, so CPU bound work done inline stalls all of them, answer streams
+# included. Embedding runs in threads since the models release the GIL while encoding, parsing in processes since
+# the parsers hold it. Each workload has its own pool, so query embeddings never wait behind ingestion batches
+_pools: dict[str, Executor] = {}
+_pools_lock = threading.Lock()
+
+
+def create_pool(workload: str) -> Executor:
+    if workload == PARSING_WORKLOAD:
+        # Forking a process that runs threads (the flusher, the LLM event loop, embedding threads) can leave a lock
+        # held in the child by a thread that does not exist there, so workers are forked from a fork server that
+        # runs none. It imports the parsers once, so every worker starts with them loaded
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(PARSING_PRELOAD_MODULES)
+
+        return ProcessPoolExecutor(max_workers=settings.ingestion.parsing_processes, mp_context=context)
+
+    threads = settings.cpu_offload.query_embedding_threads if workload == QUERY_EMBEDDING_WORKLOAD else settings.cpu_offload.document_embedding_threads
+
+    return ThreadPoolExecutor(max_workers=threads, thread_name_prefix=workload.replace('_', '-'))
+
+
+def get_pool(workload: str) -> Executor:
+    with _pools_lock:
+        pool = _pools.get(workload)
+
+        if pool is None:
+            logger.debug(f"Starting the {workload} pool")
+            pool = _pools[workload] = create_pool(workload)
+
+        return pool
+
+
+def run_offloaded(workload: str, function: Callable[..., T], *args: Any) -> T:
+    # Waits for the pool by yielding to the server. With cpu_offload.enabled off, the function runs inline
+    if not settings.cpu_offload.enabled:
+        return function(*args)
+
+    return wait_for_future(get_pool(workload).submit(function, *args))
@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import numpy as np
+
+from config import settings
+from logger import logger
+
+MODEL_NAME = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
+
+TORCH_BACKEND = 'torch'
+TORCH_INT8_BACKEND = 'torch_int8'
+ONNX_BACKEND = 'onnx'
+ONNX_INT8_BACKEND = 'onnx_int8'
+
+ONNX_MODEL_FILE = 'model.onnx'
+ONNX_INT8_MODEL_FILE = 'model.int8.onnx'
+
+# Same limit the sentence-transformers configuration of the model sets
+MAX_SEQUENCE_LENGTH = 128
+ENCODE_BATCH_SIZE = 32
+
+
+class EmbeddingModel(ABC):
+    # Returns a normalized float32 matrix with one row per document
+    @abstractmethod
+    def encode(self, documents: list[str]) -> np.ndarray:
+        pass
+
+
+class TorchEmbeddingModel(EmbeddingModel):
+    def __init__(self, quantized: bool = False):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(MODEL_NAME).eval()
+
+        if quantized:
+            # Linear layers hold nearly all the weights, they run with int8 weights and dynamically quantized activations
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def encode(self, documents: list[str]) -> np.ndarray:
+        return self.model.encode(documents, show_progress_bar=False, convert_to_numpy=True, normalize_embeddings=True)
+
+
+class OnnxEmbeddingModel(EmbeddingModel):
+    def __init__(self, model_dir: str, quantized: bool = False):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("The onnx embeddings backends need onnxruntime, install it with: pip install onnxruntime") from e
+
+        from transformers import AutoTokenizer
+
+        model_file = ONNX_INT8_MODEL_FILE if quantized else ONNX_MODEL_FILE
+
+        if not os.path.exists(os.path.join(model_dir, model_file)):
+            export_onnx_model(model_dir)
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, model_file), session_options, providers=['CPUExecutionProvider'])
+
+    def encode(self, documents: list[str]) -> np.ndarray:
+        embeddings = np.empty((len(documents), settings.database.embedding_size), dtype=np.float32)
+
+        for start in range(0, len(documents), ENCODE_BATCH_SIZE):
+            inputs = self.tokenizer(
+                documents[start:start + ENCODE_BATCH_SIZE],
+                padding=True,
+                truncation=True,
+                max_length=MAX_SEQUENCE_LENGTH,
+                return_tensors='np'
+            )
+            attention_mask = inputs['attention_mask'].astype(np.int64)
+            token_embeddings = self.session.run(None, {
+                'input_ids': inputs['input_ids'].astype(np.int64),
+                'attention_mask': attention_mask
+            })[0]
+
+            # Mean pooling over the real tokens, as the sentence-transformers pipeline of the model does
+            mask = attention_mask[:, :, np.newaxis].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+            embeddings[start:start + len(pooled)] = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+        return embeddings
+
+
+def export_onnx_model(model_dir: str):
+    # Exports the transformer of the model, and an int8 quantized copy of it, next to its tokenizer
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoTokenizer
+
+    logger.info(f"Exporting {MODEL_NAME} to ONNX in {model_dir}")
+
+    os.makedirs(model_dir, exist_ok=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    transformer = AutoModel.from_pretrained(MODEL_NAME).eval()
+    inputs = tokenizer(["Export"], return_tensors='pt')
+
+    with torch.no_grad():
+        torch.onnx.export(
+            transformer,
+            (inputs['input_ids'], inputs['attention_mask']),
+            os.path.join(model_dir, ONNX_MODEL_FILE),
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['last_hidden_state'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'sequence'},
+                'attention_mask': {0: 'batch', 1: 'sequence'},
+                'last_hidden_state': {0: 'batch', 1: 'sequence'}
+            },
+            opset_version=14
+        )
+
+    quantize_dynamic(
+        os.path.join(model_dir, ONNX_MODEL_FILE),
+        os.path.join(model_dir, ONNX_INT8_MODEL_FILE),
+        weight_type=QuantType.QInt8
+    )
+    tokenizer.save_pretrained(model_dir)
+
+
+def create_embedding_model(backend: str) -> EmbeddingModel:
+    if backend == TORCH_BACKEND:
+        return TorchEmbeddingModel()
+    elif backend == TORCH_INT8_BACKEND:
+        return TorchEmbeddingModel(quantized=True)
+    elif backend == ONNX_BACKEND:
+        return OnnxEmbeddingModel(settings.embeddings.onnx_model_path)
+    elif backend == ONNX_INT8_BACKEND:
+        return OnnxEmbeddingModel(settings.embeddings.onnx_model_path, quantized=True)
+    else:
+        raise ValueError(f"Unknown embeddings backend: {backend}")
+
+
+def embeddings_cache_model_name(backend: str) -> str:
+    # Backends produce slightly different vectors, so each one gets its own cache entries.
+    # The default backend keeps the plain model name so existing caches stay valid
+    return MODEL_NAME if backend == TORCH_BACKEND else f"{MODEL_NAME}#{backend}"
+
+
+_model: Optional[EmbeddingModel] = None
+_model_lock = threading.Lock()
+
+def get_embedding_model() -> EmbeddingModel:
+    # Loaded on first use. When loaded before forking, e.g. with embeddings.preload, the weights are shared
+    # copy-on-write by the forked processes since they are never written to after loading
+    global _model
+
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                start_time = time.time()
+                _model = create_embedding_model(settings.embeddings.backend)
+
+                logger.info(f"Loaded {settings.embeddings.backend} embeddings model in {time.time() - start_time:.2f} seconds")
+
+    return _model
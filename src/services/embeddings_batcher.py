@@ -0,0 +1,113 @@
+import threading
+import time
+from typing import Optional, cast
+
+import numpy as np
+
+from api.server_application import socketio
+from config import settings
+from services.cpu_offload import QUERY_EMBEDDING_WORKLOAD
+from services.embeddings_calculator import EmbeddingsCalculator, embeddings_cache
+from services.metrics import EMBED_QUERY_STAGE, embed_batch_size, record_stage
+from logger import logger
+
+
+class PendingEmbedding:
+    def __init__(self, document: str):
+        self.document = document
+        self.done = socketio.server.eio.create_event()
+        self.embedding: Optional[np.ndarray] = None
+        self.error: Optional[Exception] = None
+
+
+class EmbeddingsBatcher:
+    # Gathers the single query embeddings requested concurrently and encodes them in one forward pass
+    def __init__(self, embeddings_calculator: EmbeddingsCalculator, max_batch_size: int, max_wait: float):
+        self.embeddings_calculator = embeddings_calculator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending: list[PendingEmbedding] = []
+        self.flush_scheduled = False
+        self.lock = threading.Lock()
+
+    def embed_query(self, document: str) -> np.ndarray:
+        start_time = time.perf_counter()
+
+        if embeddings_cache is not None:
+            cached_embedding = embeddings_cache.get_many([document])[0]
+
+            if cached_embedding is not None:
+                record_stage(EMBED_QUERY_STAGE, time.perf_counter() - start_time, cached=True)
+
+                return cached_embedding
+
+        pending_embedding = PendingEmbedding(document)
+
+        with self.lock:
+            self.pending.append(pending_embedding)
+
+            batch_full = len(self.pending) >= self.max_batch_size
+            schedule_flush = not batch_full and not self.flush_scheduled
+
+            if schedule_flush:
+                self.flush_scheduled = True
+
+        if batch_full:
+            self._flush()
+        elif schedule_flush:
+            socketio.start_background_task(self._flush_after_wait)
+
+        pending_embedding.done.wait()
+
+        record_stage(EMBED_QUERY_STAGE, time.perf_counter() - start_time, cached=False)
+
+        if pending_embedding.error is not None:
+            raise pending_embedding.error
+
+        return cast(np.ndarray, pending_embedding.embedding)
+
+    def _flush_after_wait(self):
+        socketio.sleep(self.max_wait)
+
+        with self.lock:
+            self.flush_scheduled = False
+
+        self._flush()
+
+    def _flush(self):
+        while True:
+            with self.lock:
+                batch = self.pending[:self.max_batch_size]
+                self.pending = self.pending[self.max_batch_size:]
+
+            if len(batch) == 0:
+                return
+
+            logger.debug(f"Embedding micro batch of {len(batch)} queries")
+            embed_batch_size.observe(len(batch), 'queries')
+
+            # Users asking the same question at once get the same embedding
+            documents = list(dict.fromkeys(p.document for p in batch))
+            rows = {document: i for i, document in enumerate(documents)}
+
+            try:
+                embeddings = self.embeddings_calculator.calculate_embeddings((documents, 0, len(documents)), QUERY_EMBEDDING_WORKLOAD)
+
+                for pending_embedding in batch:
+                    pending_embedding.embedding = embeddings[rows[pending_embedding.document]]
+
+                if embeddings_cache is not None:
+                    embeddings_cache.put_many(documents, embeddings)
+            except Exception as e:
+                for pending_embedding in batch:
+                    pending_embedding.error = e
+            finally:
+                for pending_embedding in batch:
+                    pending_embedding.done.set()
+
+
+embeddings_batcher = EmbeddingsBatcher(
+    EmbeddingsCalculator(),
+    max_batch_size=settings.embeddings.micro_batch_size,
+    max_wait=settings.embeddings.micro_batch_wait
+)
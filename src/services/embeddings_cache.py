@@ -0,0 +1,191 @@
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional, cast
+
+import numpy as np
+
+from logger import logger
+
+SQLITE_MAX_VARIABLES = 500
+
+
+class EmbeddingsCacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.memory_bytes = 0
+        self.memory_entries = 0
+
+    def to_dict(self) -> dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'memory_bytes': self.memory_bytes,
+            'memory_entries': self.memory_entries
+        }
+
+
+class EmbeddingsCache:
+    # In memory LRU limited by a byte budget in front of an optional SQLite store, keyed by model and text hash.
+    # Embeddings are written to SQLite by a thread of its own, which commits everything queued meanwhile in one
+    # transaction, so requests never wait on a commit. The store keeps the max_database_rows last written
+    # embeddings, for database_ttl_seconds at most, 0 lifting either limit
+    def __init__(
+        self,
+        model_name: str,
+        memory_budget_bytes: int,
+        database_path: Optional[str] = None,
+        max_database_rows: int = 0,
+        database_ttl_seconds: float = 0
+    ):
+        self.model_name = model_name
+        self.memory_budget_bytes = memory_budget_bytes
+        self.database_path = database_path
+        self.max_database_rows = max_database_rows
+        self.database_ttl_seconds = database_ttl_seconds
+        self.entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.stats = EmbeddingsCacheStats()
+        self.lock = threading.Lock()
+        self.database: Optional[sqlite3.Connection] = None
+        self.pending_writes: 'queue.Queue[list[tuple[str, bytes, float]]]' = queue.Queue()
+
+        if database_path:
+            os.makedirs(os.path.dirname(os.path.abspath(database_path)), exist_ok=True)
+
+            self.database = sqlite3.connect(database_path, check_same_thread=False)
+            # Readers are not blocked by the commits of the writer thread
+            self.database.execute("PRAGMA journal_mode=WAL")
+            self.database.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+
+            # Stores created before eviction have no write times, their rows are the first ones to expire
+            if 'created_at' not in [column[1] for column in self.database.execute("PRAGMA table_info(embeddings)")]:
+                self.database.execute("ALTER TABLE embeddings ADD COLUMN created_at REAL NOT NULL DEFAULT 0")
+
+            self.database.execute("CREATE INDEX IF NOT EXISTS embeddings_created_at ON embeddings (created_at)")
+            self.database.commit()
+
+            threading.Thread(target=self._write_forever, name='embeddings-cache-writer', daemon=True).start()
+
+    def key(self, document: str) -> str:
+        normalized_document = " ".join(unicodedata.normalize('NFC', document).split())
+
+        return hashlib.sha256(f"{self.model_name}\0{normalized_document}".encode('utf-8')).hexdigest()
+
+    def get_many(self, documents: list[str]) -> list[Optional[np.ndarray]]:
+        keys = [self.key(document) for document in documents]
+        found: dict[str, np.ndarray] = {}
+
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[key] = self.entries[key]
+
+            missing_keys = [key for key in set(keys) if key not in found]
+
+            for key, embedding in self._read_from_database(missing_keys).items():
+                found[key] = embedding
+                self._remember(key, embedding)
+
+            results = [found.get(key) for key in keys]
+
+            hits = sum(1 for result in results if result is not None)
+            self.stats.hits += hits
+            self.stats.misses += len(results) - hits
+
+        return results
+
+    def put_many(self, documents: list[str], embeddings: np.ndarray):
+        keys = [self.key(document) for document in documents]
+
+        with self.lock:
+            for key, embedding in zip(keys, embeddings):
+                self._remember(key, np.array(embedding, dtype=np.float32))
+
+        if self.database is not None:
+            now = time.time()
+            self.pending_writes.put([(key, np.asarray(embedding, dtype=np.float32).tobytes(), now) for key, embedding in zip(keys, embeddings)])
+
+    def wait_for_writes(self):
+        # Until every embedding put so far is committed
+        self.pending_writes.join()
+
+    def _write_forever(self):
+        database = sqlite3.connect(cast(str, self.database_path))
+
+        while True:
+            batches = [self.pending_writes.get()]
+
+            while True:
+                try:
+                    batches.append(self.pending_writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                database.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, embedding, created_at) VALUES (?, ?, ?)",
+                    [row for batch in batches for row in batch]
+                )
+                self._evict(database)
+                database.commit()
+            except Exception:
+                logger.exception("Failed to write embeddings to the cache database")
+
+                database.rollback()
+            finally:
+                for _ in batches:
+                    self.pending_writes.task_done()
+
+    def _evict(self, database: sqlite3.Connection):
+        # Replaced rows get new rowids, so rowids follow write order
+        if self.database_ttl_seconds > 0:
+            database.execute("DELETE FROM embeddings WHERE created_at < ?", (time.time() - self.database_ttl_seconds,))
+
+        if self.max_database_rows > 0:
+            database.execute(
+                "DELETE FROM embeddings WHERE rowid <= (SELECT rowid FROM embeddings ORDER BY rowid DESC LIMIT 1 OFFSET ?)",
+                (self.max_database_rows,)
+            )
+
+    def _read_from_database(self, keys: list[str]) -> dict[str, np.ndarray]:
+        if self.database is None or len(keys) == 0:
+            return {}
+
+        found = {}
+
+        for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+            batch_keys = keys[i:i + SQLITE_MAX_VARIABLES]
+
+            rows = self.database.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(batch_keys))})",
+                batch_keys
+            ).fetchall()
+
+            for key, embedding in rows:
+                found[key] = np.frombuffer(embedding, dtype=np.float32)
+
+        return found
+
+    def _remember(self, key: str, embedding: np.ndarray):
+        if key in self.entries:
+            self.stats.memory_bytes -= self.entries[key].nbytes
+
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        self.stats.memory_bytes += embedding.nbytes
+
+        while self.stats.memory_bytes > self.memory_budget_bytes and len(self.entries) > 0:
+            _, evicted_embedding = self.entries.popitem(last=False)
+            self.stats.memory_bytes -= evicted_embedding.nbytes
+
+        self.stats.memory_entries = len(self.entries)
+
+    def log_stats(self):
+        logger.debug(f"Embeddings cache stats: {self.stats.to_dict()}")
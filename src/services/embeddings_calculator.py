@@ -1,33 +1,62 @@
-
 import time
-from sentence_transformers import SentenceTransformer
+from typing import Optional
 
 import numpy as np
 
+from config import settings
+from services.cpu_offload import DOCUMENT_EMBEDDING_WORKLOAD, run_offloaded
+from services.embedding_models import embeddings_cache_model_name, get_embedding_model
+from services.embeddings_cache import EmbeddingsCache
+from services.metrics import EMBED_STAGE, embed_batch_size, record_stage
 from logger import logger
 
-model = SentenceTransformer('sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2').eval()
+embeddings_cache: Optional[EmbeddingsCache] = EmbeddingsCache(
+    embeddings_cache_model_name(settings.embeddings.backend),
+    memory_budget_bytes=settings.embeddings_cache.memory_budget_bytes,
+    database_path=settings.embeddings_cache.database_path,
+    max_database_rows=settings.embeddings_cache.max_database_rows,
+    database_ttl_seconds=settings.embeddings_cache.database_ttl_seconds
+) if settings.embeddings_cache.enabled else None
+
+def encode(documents: list[str]) -> np.ndarray:
+    return get_embedding_model().encode(documents)
 
-class EmbeddingsCalculator:
-    def embed_documents(self, documents: list[str]) -> list[list[float]]:
-        embeddings_result: list[list[float]] = []
 
+class EmbeddingsCalculator:
+    def embed_documents(self, documents: list[str]) -> np.ndarray:
         logger.debug(f"Calculating embeddings for {len(documents)} content segments")
-        start_time = time.time()
+        start_time = time.perf_counter()
+
+        cached_embeddings = embeddings_cache.get_many(documents) if embeddings_cache is not None else [None] * len(documents)
+        missing_indexes = [i for i, embedding in enumerate(cached_embeddings) if embedding is None]
 
-        embeddings_result = self.calculate_embeddings((documents, 0, len(documents)))
+        embeddings_result = np.empty((len(documents), settings.database.embedding_size), dtype=np.float32)
 
-        end_time = time.time()
-        elapsed_time = end_time - start_time
+        for i, embedding in enumerate(cached_embeddings):
+            if embedding is not None:
+                embeddings_result[i] = embedding
 
-        logger.debug(f"Embedding operation took {elapsed_time:.2f} seconds")
+        # Repeated texts, e.g. page headers and footers, are encoded once
+        missing_documents = list(dict.fromkeys(documents[i] for i in missing_indexes))
+
+        if len(missing_documents) > 0:
+            embed_batch_size.observe(len(missing_documents), 'documents')
+            missing_embeddings = self.calculate_embeddings((missing_documents, 0, len(missing_documents)))
+            rows = {document: i for i, document in enumerate(missing_documents)}
+            embeddings_result[missing_indexes] = missing_embeddings[[rows[documents[i]] for i in missing_indexes]]
+
+            if embeddings_cache is not None:
+                embeddings_cache.put_many(missing_documents, missing_embeddings)
+
+        record_stage(EMBED_STAGE, time.perf_counter() - start_time, texts=len(documents), encoded=len(missing_documents))
+
+        if embeddings_cache is not None:
+            embeddings_cache.log_stats()
 
         return embeddings_result
 
-    def calculate_embeddings(self, batch: tuple[list[str], int, int]) -> list[list[float]]:
+    def calculate_embeddings(self, batch: tuple[list[str], int, int], workload: str = DOCUMENT_EMBEDDING_WORKLOAD) -> np.ndarray:
         logger.debug(f"Calculating embeddings for content segments {batch[1]} to {batch[2]}")
 
-        batch_embeddings = model.encode(batch[0], show_progress_bar=False)
-        normalized_batch_embeddings = [embedding / np.linalg.norm(embedding) for embedding in batch_embeddings]
-
-        return [embedding.tolist() for embedding in normalized_batch_embeddings]
\ No newline at end of file
+        # Normalized float32 matrix with one row per document
+        return run_offloaded(workload, encode, batch[0])
@@ -1,142 +1,197 @@
+import json
+from abc import ABC, abstractmethod
+from typing import Any, Optional
 
-from typing import TypedDict, cast, Optional
-from pymilvus import (
-    SearchResult,
-    utility,
-    FieldSchema, CollectionSchema, DataType,
-    Collection,
-)
-from config import settings
+import numpy as np
+
+from custom_types import Wisdom
 
 ID_FIELD = "id"
 RESOURCE_NAME_FIELD = "resource_name"
 RESOURCE_ID_FIELD = "resource_id"
 DATA_FIELD = "data"
 EMBEDDINGS_FIELD = "embeddings"
+CHUNK_NUMBER_FIELD = "chunk_number"
+TOTAL_CHUNKS_FIELD = "total_chunks"
+PERCENTAGE_IN_FIELD = "percentage_in"
+PAGE_INDEX_FIELD = "page_index"
+RESOURCE_MIMETYPE_FIELD = "resource_mimetype"
+CONTENT_HASH_FIELD = "content_hash"
+
+# Chunk metadata used to be kept as a JSON string in this field, see migrations.chunk_fields
 PAYLOAD_FIELD = "payload"
 
+# Stores have no null scalars, so chunks without a page, e.g. of non PDF resources, keep this one
+NO_PAGE_INDEX = -1
+
+METADATA_FIELDS = [
+    ID_FIELD, RESOURCE_NAME_FIELD, RESOURCE_ID_FIELD, DATA_FIELD, CHUNK_NUMBER_FIELD, TOTAL_CHUNKS_FIELD,
+    PERCENTAGE_IN_FIELD, PAGE_INDEX_FIELD, RESOURCE_MIMETYPE_FIELD, CONTENT_HASH_FIELD
+]
+
+
+class ResourceChunkInfo:
+    # One chunk of a resource with its position in it. Requests build thousands of them, so they are slotted
+    # records rather than dicts, and positions are plain scalars rather than a JSON payload
+    __slots__ = ('id', 'resource_name', 'resource_id', 'data', 'embeddings', 'chunk_number', 'total_chunks',
+                 'percentage_in', 'page_index', 'resource_mimetype', 'content_hash')
+
+    def __init__(
+        self,
+        id: Optional[int],
+        resource_name: str,
+        resource_id: str,
+        data: str,
+        chunk_number: int,
+        total_chunks: int,
+        percentage_in: float,
+        page_index: Optional[int],
+        resource_mimetype: str,
+        content_hash: str,
+        embeddings: Optional[np.ndarray] = None
+    ):
+        self.id = id
+        self.resource_name = resource_name
+        self.resource_id = resource_id
+        self.data = data
+        self.chunk_number = chunk_number
+        self.total_chunks = total_chunks
+        self.percentage_in = percentage_in
+        self.page_index = page_index
+        self.resource_mimetype = resource_mimetype
+        self.content_hash = content_hash
+        self.embeddings = embeddings
+
+    @classmethod
+    def from_fields(cls, fields: dict[str, Any]) -> 'ResourceChunkInfo':
+        # From a row of a store, missing fields (e.g. data when only metadata was queried) are left empty
+        page_index = fields.get(PAGE_INDEX_FIELD, NO_PAGE_INDEX)
+
+        return cls(
+            id=fields.get(ID_FIELD),
+            resource_name=fields.get(RESOURCE_NAME_FIELD, ""),
+            resource_id=fields.get(RESOURCE_ID_FIELD, ""),
+            data=fields.get(DATA_FIELD, ""),
+            chunk_number=fields.get(CHUNK_NUMBER_FIELD, 0),
+            total_chunks=fields.get(TOTAL_CHUNKS_FIELD, 0),
+            percentage_in=fields.get(PERCENTAGE_IN_FIELD, 0.0),
+            page_index=None if page_index == NO_PAGE_INDEX else page_index,
+            resource_mimetype=fields.get(RESOURCE_MIMETYPE_FIELD, ""),
+            content_hash=fields.get(CONTENT_HASH_FIELD, ""),
+            embeddings=fields.get(EMBEDDINGS_FIELD)
+        )
 
-class ResourceChunkInfo(TypedDict):
-    id: Optional[int]
-    resource_name: str
-    resource_id: str
-    data: str
-    embeddings: list[float]
-    payload: str
-
-
-class CollectionEmbeddingsStore:
-    def __init__(self, collection_name: str, host: str = settings.milvus.host, port: str = settings.milvus.port):
-        self.collection_name = self.make_guid_compatible(collection_name)
-        self.host = host
-        self.port = port
-        self.connection_alias = "default"
-        self.collection: Collection
+    def field(self, name: str) -> Any:
+        # The value stored in the field of that name
+        if name == PAGE_INDEX_FIELD:
+            return NO_PAGE_INDEX if self.page_index is None else self.page_index
 
-    def make_guid_compatible(self, collection_name: str) -> str:
-        return "_" + collection_name.replace("-", "_")
+        return getattr(self, name)
 
-    def setup(self, create_index: bool = False):
-        fields = [
-            FieldSchema(name=ID_FIELD, dtype=DataType.INT64, is_primary=True, auto_id=True),
-            FieldSchema(name=RESOURCE_NAME_FIELD, dtype=DataType.VARCHAR, max_length=settings.database.resource_name_size),
-            FieldSchema(name=RESOURCE_ID_FIELD, dtype=DataType.VARCHAR, max_length=settings.database.resource_id_size),
-            FieldSchema(name=DATA_FIELD, dtype=DataType.VARCHAR, max_length=settings.database.data_size),
-            FieldSchema(name=EMBEDDINGS_FIELD, dtype=DataType.FLOAT_VECTOR, dim=settings.database.embedding_size),
-            FieldSchema(name=PAYLOAD_FIELD, dtype=DataType.VARCHAR, max_length=settings.database.payload_size)
-        ]
-
-        resource_chunk_schema = CollectionSchema(fields, "Schema for holding resource chunk embeddings")
-
-        self.collection = Collection(self.collection_name, resource_chunk_schema, consistency_level="Bounded")
-
-        if create_index:
-            try:
-                index = {
-                    "index_type": "IVF_FLAT",
-                    "metric_type": "IP",
-                    "params": {"nlist": 128},
-                }
-
-                self.collection.create_index(EMBEDDINGS_FIELD, index)
-            except:
-                pass
-            finally:
-                pass
+    def copy(self, **changes: Any) -> 'ResourceChunkInfo':
+        chunk = ResourceChunkInfo.__new__(ResourceChunkInfo)
 
-    def drop_collection(self):
-        utility.drop_collection(self.collection_name)
+        for name in ResourceChunkInfo.__slots__:
+            setattr(chunk, name, changes[name] if name in changes else getattr(self, name))
 
-    def delete_resource_chunks(self, resource_id: str):
-        self.collection.load()  # type: ignore
+        return chunk
 
-        result = self.collection.query(
-            expr=f"{RESOURCE_ID_FIELD} == \"{resource_id}\"",
-            output_fields=[ID_FIELD, RESOURCE_ID_FIELD]
-        )
+    def position(self) -> tuple:
+        # Everything but the text and embeddings, compared to only rewrite kept chunks that moved when a resource is
+        # re-assimilated. Milvus keeps percentage_in as a float32, so it is compared at that precision
+        return (self.resource_name, self.chunk_number, self.total_chunks, float(np.float32(self.percentage_in)), self.page_index, self.resource_mimetype)
 
-        ids_to_delete = [r[ID_FIELD] for r in result]
+    def payload(self) -> dict[str, Any]:
+        # The metadata in the shape the API has always returned it. The content hash is only used to diff
+        # re-assimilated resources, so it is not part of it
+        return {
+            'total_chunks': self.total_chunks,
+            'percentage_in': self.percentage_in,
+            'chunk_number': self.chunk_number,
+            'resource_mimetype': self.resource_mimetype,
+            'page_index': self.page_index
+        }
 
-        self.collection.delete(f"{ID_FIELD} in [{','.join([str(id) for id in ids_to_delete])}]")  # type: ignore
 
-    def insert_resource_chunks(self, entities: list[ResourceChunkInfo]):
-        if self.collection is None:
-            raise ValueError("Collection not created.")
+def fields_from_payload(payload: str) -> dict[str, Any]:
+    # Scalar fields of a chunk stored before they had fields of their own
+    values = json.loads(payload)
+    page_index = values.get('page_index')
 
-        formatted_entities = [
-            [e[RESOURCE_NAME_FIELD] for e in entities],
-            [e[RESOURCE_ID_FIELD] for e in entities],
-            [e[DATA_FIELD] for e in entities],
-            [e[EMBEDDINGS_FIELD] for e in entities],
-            [e[PAYLOAD_FIELD] for e in entities],
-        ]
+    return {
+        CHUNK_NUMBER_FIELD: int(values.get('chunk_number', 0)),
+        TOTAL_CHUNKS_FIELD: int(values.get('total_chunks', 0)),
+        PERCENTAGE_IN_FIELD: float(values.get('percentage_in', 0.0)),
+        PAGE_INDEX_FIELD: NO_PAGE_INDEX if page_index is None else int(page_index),
+        RESOURCE_MIMETYPE_FIELD: values.get('resource_mimetype') or "",
+        CONTENT_HASH_FIELD: values.get('content_hash') or ""
+    }
 
-        self.collection.insert(formatted_entities)
 
-        self.collection.flush()
+class EmbeddingsStore(ABC):
+    loaded: bool
+    indexed: bool
+    # Whether release frees what the store loaded. The registry only counts such stores against its limit
+    releasable = True
 
-    def search_similar_chunks(self, query_vectors: list[float], limit: int = 5) -> list[tuple[ResourceChunkInfo, float]]:
-        self.collection.load()
-
-        if self.collection is None:
-            raise ValueError(
-                "Collection not created. Please call create_collection() method first.")
-
-        result = self.collection.search(
-            [query_vectors],
-            "embeddings",
-            {"metric_type": "IP", "params": {"nprobe": 10}},
-            limit=limit,
-            output_fields=[ID_FIELD, DATA_FIELD, RESOURCE_ID_FIELD, RESOURCE_NAME_FIELD, PAYLOAD_FIELD],
-            consistency_level="Bounded"
-        )
+    def make_guid_compatible(self, collection_name: str) -> str:
+        return "_" + collection_name.replace("-", "_")
 
-        result = cast(SearchResult, result)
+    @abstractmethod
+    def setup(self, create_index: bool = False):
+        pass
 
-        return [(cast(ResourceChunkInfo, {
-            ID_FIELD: r.entity.id,
-            RESOURCE_NAME_FIELD: r.entity.resource_name,
-            RESOURCE_ID_FIELD: r.entity.resource_id,
-            DATA_FIELD: r.entity.data,
-            PAYLOAD_FIELD: r.entity.payload
-        }), cast(float, r.distance)) for r in result[0]]
+    @abstractmethod
+    def ensure_index(self):
+        pass
 
-    def get_chunks_data(self, chunk_ids: list[str]) -> list[ResourceChunkInfo]:
-        self.collection.load()
+    @abstractmethod
+    def ensure_loaded(self):
+        pass
 
-        if self.collection is None:
-            raise ValueError(
-                "Collection not created. Please call create_collection() method first.")
+    @abstractmethod
+    def release(self):
+        pass
 
-        result = self.collection.query(
-            expr=f"{ID_FIELD} in [{','.join([str(id) for id in chunk_ids])}]",
-            output_fields=[ID_FIELD, DATA_FIELD, RESOURCE_ID_FIELD, RESOURCE_NAME_FIELD, PAYLOAD_FIELD]
-        )
+    @abstractmethod
+    def drop_collection(self):
+        pass
 
-        return [cast(ResourceChunkInfo, {
-            ID_FIELD: r[ID_FIELD],
-            RESOURCE_NAME_FIELD: r[RESOURCE_NAME_FIELD],
-            RESOURCE_ID_FIELD: r[RESOURCE_ID_FIELD],
-            DATA_FIELD: r[DATA_FIELD],
-            PAYLOAD_FIELD: r[PAYLOAD_FIELD]
-        }) for r in result]
+    @abstractmethod
+    def delete_resource_chunks(self, resource_id: str):
+        pass
+
+    # Inserted chunks are searchable right away, when they are persisted is up to the store
+    @abstractmethod
+    def insert_resource_chunks(self, entities: list[ResourceChunkInfo]) -> list[int]:
+        pass
+
+    @abstractmethod
+    def get_resource_chunks_metadata(self, resource_id: str) -> list[ResourceChunkInfo]:
+        pass
+
+    @abstractmethod
+    def delete_chunks(self, chunk_ids: list[int]):
+        pass
+
+    # Rewrites the position of already stored chunks, their texts and embeddings stay as they are. Stores that
+    # cannot update chunks in place store them again under new ids: returns the new id of every such chunk
+    @abstractmethod
+    def update_chunk_positions(self, entities: list[ResourceChunkInfo]) -> dict[int, int]:
+        pass
+
+    # Higher wisdom levels search more of the index, see embeddings_store.search_params
+    @abstractmethod
+    def search_similar_chunks(self, query_vector: np.ndarray, limit: int = 5, wisdom: Wisdom = Wisdom.MEDIUM) -> list[tuple[ResourceChunkInfo, float]]:
+        pass
+
+    # Searches several query vectors in one round trip, returning only the ids of the most similar chunks of
+    # each query with their similarity, so chunks shared between queries can be fetched once
+    @abstractmethod
+    def search_similar_chunk_ids(self, query_vectors: np.ndarray, limit: int = 5, wisdom: Wisdom = Wisdom.MEDIUM) -> list[list[tuple[int, float]]]:
+        pass
+
+    # The stored embeddings are only fetched when asked for, e.g. to score chunks that were found lexically
+    @abstractmethod
+    def get_chunks_data(self, chunk_ids: list[str], with_embeddings: bool = False) -> list[ResourceChunkInfo]:
+        pass
@@ -0,0 +1,197 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator
+
+from api.server_application import socketio
+from config import settings
+from services.embeddings_store import EmbeddingsStore
+from services.metrics import STORE_LOAD_STAGE, STORE_SETUP_STAGE, record_stage
+from logger import logger
+
+
+MILVUS_BACKEND = 'milvus'
+LOCAL_BACKEND = 'local'
+
+
+def create_embeddings_store(knowledge_base_id: str) -> EmbeddingsStore:
+    # Backends are imported on first use, so pymilvus is only loaded when Milvus is used
+    if settings.embeddings_store.backend == MILVUS_BACKEND:
+        from services.milvus_embeddings_store import SHARED_STORAGE, CollectionEmbeddingsStore, SharedCollectionEmbeddingsStore
+
+        if settings.milvus.storage_mode == SHARED_STORAGE:
+            return SharedCollectionEmbeddingsStore(knowledge_base_id)
+
+        return CollectionEmbeddingsStore(collection_name=knowledge_base_id)
+    elif settings.embeddings_store.backend == LOCAL_BACKEND:
+        from services.local_embeddings_store import LocalEmbeddingsStore
+
+        return LocalEmbeddingsStore(collection_name=knowledge_base_id)
+    else:
+        raise ValueError(f"Unknown embeddings store backend: {settings.embeddings_store.backend}")
+
+
+class EmbeddingsStoreRegistry:
+    # Keeps one store per knowledge base so collection handles, index and load state are reused across requests.
+    # Stores are kept in least recently used order, and past max_loaded_collections the least recently used ones
+    # are released and forgotten, as are stores idle for idle_release_seconds. Stores that release nothing, like
+    # those of shared collections, do not count against max_loaded_collections, and the others are also kept in
+    # an order of their own so the least recently used one is found right away. Stores leased by a request (see
+    # lease_store) are not released until it is done with them. A forgotten store still used by a request is
+    # handed out again rather than a second one being created for its knowledge base
+    def __init__(self, max_loaded_collections: int, idle_release_seconds: float):
+        self.max_loaded_collections = max_loaded_collections
+        self.idle_release_seconds = idle_release_seconds
+        self.stores: OrderedDict[str, EmbeddingsStore] = OrderedDict()
+        self.releasable_stores: OrderedDict[str, EmbeddingsStore] = OrderedDict()
+        self.leases: dict[str, int] = {}
+        self.open_stores: weakref.WeakValueDictionary[str, EmbeddingsStore] = weakref.WeakValueDictionary()
+        self.last_used: dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.idle_sweeper_started = False
+
+    @contextmanager
+    def lease_store(self, knowledge_base_id: str, create_index: bool = False, load: bool = True) -> Iterator[EmbeddingsStore]:
+        # The store of the knowledge base, which is not released while the block runs
+        with self.lock:
+            self.leases[knowledge_base_id] = self.leases.get(knowledge_base_id, 0) + 1
+
+        try:
+            yield self.get_store(knowledge_base_id, create_index, load)
+        finally:
+            with self.lock:
+                self.leases[knowledge_base_id] -= 1
+
+                if self.leases[knowledge_base_id] == 0:
+                    del self.leases[knowledge_base_id]
+
+    def get_store(self, knowledge_base_id: str, create_index: bool = False, load: bool = True) -> EmbeddingsStore:
+        # Stores used across blocking calls should be leased instead, so they are not released meanwhile
+        with self.lock:
+            store = self.stores.get(knowledge_base_id) or self.open_stores.get(knowledge_base_id)
+
+        # Only setting up and loading are timed, stores are usually already set up and loaded
+        if store is None:
+            start_time = time.perf_counter()
+            new_store = create_embeddings_store(knowledge_base_id)
+            new_store.setup()
+
+            with self.lock:
+                store = self.stores.get(knowledge_base_id) or self.open_stores.setdefault(knowledge_base_id, new_store)
+
+            record_stage(STORE_SETUP_STAGE, time.perf_counter() - start_time)
+
+        with self.lock:
+            self.stores[knowledge_base_id] = store
+            self.stores.move_to_end(knowledge_base_id)
+            self.last_used[knowledge_base_id] = time.time()
+
+            if store.releasable:
+                self.releasable_stores[knowledge_base_id] = store
+                self.releasable_stores.move_to_end(knowledge_base_id)
+
+        if create_index and not store.indexed:
+            start_time = time.perf_counter()
+            store.ensure_index()
+            record_stage(STORE_LOAD_STAGE, time.perf_counter() - start_time, index=True)
+
+        if load and not store.loaded:
+            start_time = time.perf_counter()
+            store.ensure_loaded()
+            record_stage(STORE_LOAD_STAGE, time.perf_counter() - start_time)
+
+        self._release_least_recently_used(keep=knowledge_base_id)
+        self._start_idle_sweeper()
+
+        return store
+
+    def drop_store(self, knowledge_base_id: str):
+        with self.lock:
+            store = self.stores.pop(knowledge_base_id, None) or self.open_stores.get(knowledge_base_id)
+            self.open_stores.pop(knowledge_base_id, None)
+            self.releasable_stores.pop(knowledge_base_id, None)
+            self.last_used.pop(knowledge_base_id, None)
+
+        if store is None:
+            store = create_embeddings_store(knowledge_base_id)
+
+        store.drop_collection()
+
+    def release_idle_stores(self):
+        now = time.time()
+        idle_stores: list[tuple[str, EmbeddingsStore]] = []
+
+        # Stores are in least recently used order, so the idle ones are at the front. Leased ones are skipped
+        with self.lock:
+            for knowledge_base_id in self.stores:
+                if now - self.last_used[knowledge_base_id] <= self.idle_release_seconds:
+                    break
+
+                if knowledge_base_id not in self.leases:
+                    idle_stores.append((knowledge_base_id, self.stores[knowledge_base_id]))
+
+            for knowledge_base_id, _ in idle_stores:
+                self._forget(knowledge_base_id)
+
+        for knowledge_base_id, store in idle_stores:
+            logger.debug(f"Releasing idle collection of knowledge base {knowledge_base_id}")
+
+            store.release()
+
+    def _release_least_recently_used(self, keep: str):
+        # The store of keep is being handed out, so it is treated as leased
+        stores_to_release: list[tuple[str, EmbeddingsStore]] = []
+
+        with self.lock:
+            # Leased stores are put back at the front, so they are the first ones released once no longer leased
+            leased_stores: list[tuple[str, EmbeddingsStore]] = []
+
+            while len(self.releasable_stores) > 0 and len(self.releasable_stores) + len(leased_stores) > self.max_loaded_collections:
+                knowledge_base_id, store = self.releasable_stores.popitem(last=False)
+
+                if knowledge_base_id in self.leases or knowledge_base_id == keep:
+                    leased_stores.append((knowledge_base_id, store))
+                else:
+                    stores_to_release.append(self._forget(knowledge_base_id))
+
+            for knowledge_base_id, store in reversed(leased_stores):
+                self.releasable_stores[knowledge_base_id] = store
+                self.releasable_stores.move_to_end(knowledge_base_id, last=False)
+
+        for knowledge_base_id, store in stores_to_release:
+            logger.debug(f"Releasing least recently used collection of knowledge base {knowledge_base_id}")
+
+            store.release()
+
+    def _forget(self, knowledge_base_id: str) -> tuple[str, EmbeddingsStore]:
+        # Called with the lock held
+        self.last_used.pop(knowledge_base_id, None)
+        self.releasable_stores.pop(knowledge_base_id, None)
+
+        return knowledge_base_id, self.stores.pop(knowledge_base_id)
+
+    def _start_idle_sweeper(self):
+        with self.lock:
+            if self.idle_sweeper_started:
+                return
+
+            self.idle_sweeper_started = True
+
+        def sweep():
+            while True:
+                socketio.sleep(self.idle_release_seconds / 2)
+
+                try:
+                    self.release_idle_stores()
+                except Exception:
+                    logger.exception("Failed to release idle collections")
+
+        socketio.start_background_task(sweep)
+
+
+embeddings_stores = EmbeddingsStoreRegistry(
+    max_loaded_collections=settings.embeddings_store.max_loaded_collections,
+    idle_release_seconds=settings.embeddings_store.idle_release_seconds
+)
@@ -0,0 +1,163 @@
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any, Optional
+
+from api.server_application import socketio
+from config import settings
+from services.resource_ingestion import ProcessedDataStats, ResourceLimitExceededError, ingest_resource
+from services.socket_rooms import emit_to_room, knowledge_base_room
+from logger import logger
+
+JOB_QUEUED = 'QUEUED'
+JOB_RUNNING = 'RUNNING'
+JOB_SUCCEEDED = 'SUCCEEDED'
+JOB_FAILED = 'FAILED'
+
+
+class IngestionQueueFullError(Exception):
+    pass
+
+
+class IngestionJob:
+    def __init__(self, knowledge_base_id: str, resource_id: str, resource_name: str, mimetype: str, file_path: str, work_dir: str):
+        self.id = str(uuid.uuid4())
+        self.knowledge_base_id = knowledge_base_id
+        self.resource_id = resource_id
+        self.resource_name = resource_name
+        self.mimetype = mimetype
+        self.file_path = file_path
+        self.work_dir = work_dir
+        self.status = JOB_QUEUED
+        self.current_stage: Optional[str] = None
+        self.stage_timings: dict[str, float] = {}
+        self.processed_data_stats: Optional[ProcessedDataStats] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'job_id': self.id,
+            'knowledge_base_id': self.knowledge_base_id,
+            'resource_id': self.resource_id,
+            'resource_name': self.resource_name,
+            'status': self.status,
+            'current_stage': self.current_stage,
+            'stage_timings': self.stage_timings,
+            'processed_data_stats': self.processed_data_stats,
+            'error': self.error
+        }
+
+
+class IngestionJobQueue:
+    # Workers are only alive while there are pending jobs, so an idle queue costs nothing
+    def __init__(self, max_workers: int, max_queue_depth: int, max_queue_depth_per_knowledge_base: int, finished_job_ttl: float):
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_depth_per_knowledge_base = max_queue_depth_per_knowledge_base
+        self.finished_job_ttl = finished_job_ttl
+        self.jobs: dict[str, IngestionJob] = {}
+        self.pending_jobs: deque[IngestionJob] = deque()
+        self.active_workers = 0
+        self.lock = threading.Lock()
+
+    def submit(self, job: IngestionJob):
+        with self.lock:
+            self._forget_finished_jobs()
+
+            if len(self.pending_jobs) >= self.max_queue_depth:
+                raise IngestionQueueFullError('Ingestion queue is full')
+
+            knowledge_base_depth = sum(1 for pending_job in self.pending_jobs if pending_job.knowledge_base_id == job.knowledge_base_id)
+
+            if knowledge_base_depth >= self.max_queue_depth_per_knowledge_base:
+                raise IngestionQueueFullError(f"Too many pending ingestion jobs for knowledge base {job.knowledge_base_id}")
+
+            self.jobs[job.id] = job
+            self.pending_jobs.append(job)
+
+            start_worker = self.active_workers < self.max_workers
+
+            if start_worker:
+                self.active_workers += 1
+
+        if start_worker:
+            socketio.start_background_task(self._work)
+
+        logger.info(f"Queued ingestion job {job.id} for resource {job.resource_id} of knowledge base {job.knowledge_base_id}")
+
+    def get_job(self, job_id: str) -> Optional[IngestionJob]:
+        return self.jobs.get(job_id)
+
+    def queue_depth(self) -> int:
+        return len(self.pending_jobs)
+
+    def _forget_finished_jobs(self):
+        now = time.time()
+
+        expired_job_ids = [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished_at is not None and now - job.finished_at > self.finished_job_ttl
+        ]
+
+        for job_id in expired_job_ids:
+            del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            with self.lock:
+                if len(self.pending_jobs) == 0:
+                    self.active_workers -= 1
+                    return
+
+                job = self.pending_jobs.popleft()
+
+            self._run(job)
+
+    def _run(self, job: IngestionJob):
+        job.status = JOB_RUNNING
+        self._emit_progress(job)
+
+        def on_stage(stage: str, elapsed_time: float):
+            job.current_stage = stage
+            job.stage_timings[stage] = elapsed_time
+            self._emit_progress(job)
+
+        try:
+            job.processed_data_stats = ingest_resource(
+                job.knowledge_base_id,
+                job.resource_id,
+                job.resource_name,
+                job.mimetype,
+                job.file_path,
+                on_stage=on_stage
+            )
+            job.status = JOB_SUCCEEDED
+        except ResourceLimitExceededError as e:
+            job.status = JOB_FAILED
+            job.error = str(e)
+        except Exception as e:
+            logger.exception(f"Ingestion job {job.id} failed")
+
+            job.status = JOB_FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+
+        self._emit_progress(job)
+
+    def _emit_progress(self, job: IngestionJob):
+        emit_to_room('ingestion_progress', job.to_dict(), knowledge_base_room(job.knowledge_base_id))
+        socketio.sleep(0)
+
+
+ingestion_job_queue = IngestionJobQueue(
+    max_workers=settings.ingestion.max_workers,
+    max_queue_depth=settings.ingestion.max_queue_depth,
+    max_queue_depth_per_knowledge_base=settings.ingestion.max_queue_depth_per_knowledge_base,
+    finished_job_ttl=settings.ingestion.finished_job_ttl
+)
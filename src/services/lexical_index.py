@@ -0,0 +1,343 @@
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from config import settings
+from logger import logger
+
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./]\w+)*")
+TOKEN_SEPARATORS = re.compile(r"[-./]")
+
+MAX_TERM_FREQUENCY = np.iinfo(np.uint16).max
+
+
+class LexicalChunk(NamedTuple):
+    id: int
+    resource_id: str
+    data: str
+
+
+def tokenize(text: str) -> list[str]:
+    # Codes such as ERR-1042 or AB.12/X are kept whole and also indexed by their parts
+    tokens: list[str] = []
+
+    for match in TOKEN_PATTERN.finditer(unicodedata.normalize('NFKC', text).lower()):
+        token = match.group()
+        tokens.append(token)
+
+        if TOKEN_SEPARATORS.search(token):
+            tokens.extend(part for part in TOKEN_SEPARATORS.split(token) if part)
+
+    return tokens
+
+
+class LexicalIndexSnapshot(NamedTuple):
+    # Everything a search reads. Updates build a new snapshot and replace the reference to it, so a search never
+    # sees arrays of different updates, and nothing in a snapshot is modified once it is published
+    terms: list[str]
+    term_ids: dict[str, int]
+    resource_ids: list[str]
+    resource_indexes: dict[str, int]
+    term_offsets: np.ndarray
+    posting_rows: np.ndarray
+    posting_frequencies: np.ndarray
+    posting_weights: np.ndarray
+    chunk_ids: np.ndarray
+    chunk_resources: np.ndarray
+    chunk_lengths: np.ndarray
+
+
+EMPTY_SNAPSHOT = LexicalIndexSnapshot(
+    terms=[],
+    term_ids={},
+    resource_ids=[],
+    resource_indexes={},
+    term_offsets=np.zeros(1, dtype=np.int64),
+    posting_rows=np.empty(0, dtype=np.int32),
+    posting_frequencies=np.empty(0, dtype=np.uint16),
+    posting_weights=np.empty(0, dtype=np.float32),
+    chunk_ids=np.empty(0, dtype=np.int64),
+    chunk_resources=np.empty(0, dtype=np.int32),
+    chunk_lengths=np.empty(0, dtype=np.int32)
+)
+
+
+class LexicalIndex:
+    # BM25 index over the chunks of a knowledge base. Postings are kept as a CSR matrix ordered by term, with one
+    # row per chunk. Updates merge the new postings into the kept ones without sorting those again, but the whole
+    # index is still saved as a single npz file after every update, benchmarks.lexical_search measures both
+    def __init__(self, file_path: str, k1: float = settings.lexical_index.k1, b: float = settings.lexical_index.b):
+        self.file_path = file_path
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        self.snapshot = EMPTY_SNAPSHOT
+
+    def load(self):
+        if not os.path.exists(self.file_path):
+            return
+
+        with np.load(self.file_path) as index:
+            terms = json.loads(index['terms'].tobytes().decode('utf-8'))
+            resource_ids = json.loads(index['resource_ids'].tobytes().decode('utf-8'))
+            posting_rows = index['posting_rows']
+            posting_frequencies = index['posting_frequencies']
+            chunk_lengths = index['chunk_lengths']
+
+            self.snapshot = LexicalIndexSnapshot(
+                terms=terms,
+                term_ids={term: term_id for term_id, term in enumerate(terms)},
+                resource_ids=resource_ids,
+                resource_indexes={resource_id: index for index, resource_id in enumerate(resource_ids)},
+                term_offsets=index['term_offsets'],
+                posting_rows=posting_rows,
+                posting_frequencies=posting_frequencies,
+                posting_weights=self._posting_weights(posting_rows, posting_frequencies, chunk_lengths),
+                chunk_ids=index['chunk_ids'],
+                chunk_resources=index['chunk_resources'],
+                chunk_lengths=chunk_lengths
+            )
+
+    def replace_resources(self, resource_ids: list[str], chunks: list[LexicalChunk]):
+        # Removes every chunk of the given resources and adds the new chunks, in a single update
+        with self.lock:
+            snapshot = self.snapshot
+            removed_resources = [snapshot.resource_indexes[r] for r in resource_ids if r in snapshot.resource_indexes]
+            keep = ~np.isin(snapshot.chunk_resources, removed_resources)
+
+            if keep.all() and len(chunks) == 0:
+                return
+
+            term_ids, new_term_ids, new_rows, new_frequencies, new_lengths = self._count_terms(chunks, int(keep.sum()), snapshot.term_ids)
+            terms = snapshot.terms if len(term_ids) == len(snapshot.terms) else list(term_ids)
+
+            # Kept postings stay in term order, so counting them up to every term boundary gives their offsets.
+            # Terms seen for the first time have none
+            kept_postings = keep[snapshot.posting_rows]
+            kept_offsets = np.concatenate([[0], np.cumsum(kept_postings, dtype=np.int64)])[snapshot.term_offsets]
+            kept_offsets = np.concatenate([kept_offsets, np.full(len(terms) + 1 - len(kept_offsets), kept_offsets[-1])])
+            row_remap = np.cumsum(keep, dtype=np.int64) - 1
+
+            # Only the new postings are sorted, and each one goes after the kept postings of its term. New rows come
+            # after every kept row, so the rows of every term stay in ascending order
+            order = np.argsort(new_term_ids, kind='stable')
+            new_term_ids = new_term_ids[order]
+            insert_positions = kept_offsets[new_term_ids + 1]
+            new_counts = np.bincount(new_term_ids, minlength=len(terms))
+
+            posting_rows = np.insert(row_remap[snapshot.posting_rows[kept_postings]], insert_positions, new_rows[order]).astype(np.int32)
+            posting_frequencies = np.insert(snapshot.posting_frequencies[kept_postings], insert_positions, new_frequencies[order])
+            chunk_lengths = np.concatenate([snapshot.chunk_lengths[keep], new_lengths]).astype(np.int32)
+
+            all_resource_ids, resource_indexes = snapshot.resource_ids, snapshot.resource_indexes
+            new_resource_ids = list(dict.fromkeys(c.resource_id for c in chunks if c.resource_id not in resource_indexes))
+
+            if len(new_resource_ids) > 0:
+                all_resource_ids = all_resource_ids + new_resource_ids
+                resource_indexes = {resource_id: index for index, resource_id in enumerate(all_resource_ids)}
+
+            self.snapshot = LexicalIndexSnapshot(
+                terms=terms,
+                term_ids=term_ids,
+                resource_ids=all_resource_ids,
+                resource_indexes=resource_indexes,
+                term_offsets=kept_offsets + np.concatenate([[0], np.cumsum(new_counts, dtype=np.int64)]),
+                posting_rows=posting_rows,
+                posting_frequencies=posting_frequencies,
+                posting_weights=self._posting_weights(posting_rows, posting_frequencies, chunk_lengths),
+                chunk_ids=np.concatenate([snapshot.chunk_ids[keep], [chunk.id for chunk in chunks]]).astype(np.int64),
+                chunk_resources=np.concatenate([
+                    snapshot.chunk_resources[keep],
+                    [resource_indexes[chunk.resource_id] for chunk in chunks]
+                ]).astype(np.int32),
+                chunk_lengths=chunk_lengths
+            )
+
+            self._save()
+
+        logger.debug(f"Lexical index {self.file_path} holds {len(chunk_lengths)} chunks and {len(posting_rows)} postings")
+
+    def remap_chunk_ids(self, id_map: dict[int, int]):
+        # For chunks copied to new ids, e.g. by migrations.chunk_fields
+        with self.lock:
+            self.snapshot = self.snapshot._replace(
+                chunk_ids=np.asarray([id_map.get(int(id), int(id)) for id in self.snapshot.chunk_ids], dtype=np.int64)
+            )
+
+            self._save()
+
+    def remove_resource(self, resource_id: str):
+        self.replace_resources([resource_id], [])
+
+    def search(self, query: str, limit: int) -> list[tuple[int, float]]:
+        # Returns chunk ids with their BM25 score, best first
+        snapshot = self.snapshot
+        term_offsets, posting_rows, posting_weights = snapshot.term_offsets, snapshot.posting_rows, snapshot.posting_weights
+        chunk_ids = snapshot.chunk_ids
+        total_chunks = len(chunk_ids)
+
+        matched_rows: list[np.ndarray] = []
+        matched_scores: list[np.ndarray] = []
+
+        for term in set(tokenize(query)):
+            term_id = snapshot.term_ids.get(term)
+
+            if term_id is None:
+                continue
+
+            start, end = term_offsets[term_id], term_offsets[term_id + 1]
+            document_frequency = end - start
+
+            if document_frequency == 0:
+                continue
+
+            idf = math.log(1 + (total_chunks - document_frequency + 0.5) / (document_frequency + 0.5))
+
+            matched_rows.append(posting_rows[start:end])
+            matched_scores.append(posting_weights[start:end] * np.float32(idf))
+
+        if len(matched_rows) == 0:
+            return []
+
+        if len(matched_rows) == 1:
+            candidates = matched_rows[0]
+            scores = np.zeros(total_chunks, dtype=np.float32)
+            scores[candidates] = matched_scores[0]
+        else:
+            scores = np.bincount(np.concatenate(matched_rows), weights=np.concatenate(matched_scores), minlength=total_chunks)
+            candidates = np.flatnonzero(scores)
+
+        limit = min(limit, len(candidates))
+        top = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        top = top[np.argsort(-scores[top])]
+
+        return [(int(chunk_ids[row]), float(scores[row])) for row in top]
+
+    def _count_terms(
+        self,
+        chunks: list[LexicalChunk],
+        first_row: int,
+        term_ids: dict[str, int]
+    ) -> tuple[dict[str, int], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # Returns the term ids including the terms seen for the first time, with the postings and lengths of the
+        # chunks. Searches may be reading the given term ids, so new terms are added to a copy
+        copied = False
+        chunk_term_ids: list[int] = []
+        rows: list[int] = []
+        frequencies: list[int] = []
+        lengths: list[int] = []
+
+        for i, chunk in enumerate(chunks):
+            tokens = tokenize(chunk.data)
+            lengths.append(len(tokens))
+
+            for term, frequency in Counter(tokens).items():
+                term_id = term_ids.get(term)
+
+                if term_id is None:
+                    if not copied:
+                        term_ids = dict(term_ids)
+                        copied = True
+
+                    term_id = len(term_ids)
+                    term_ids[term] = term_id
+
+                chunk_term_ids.append(term_id)
+                rows.append(first_row + i)
+                frequencies.append(min(frequency, MAX_TERM_FREQUENCY))
+
+        return (
+            term_ids,
+            np.asarray(chunk_term_ids, dtype=np.int64),
+            np.asarray(rows, dtype=np.int64),
+            np.asarray(frequencies, dtype=np.uint16),
+            np.asarray(lengths, dtype=np.int32)
+        )
+
+    def _posting_weights(self, posting_rows: np.ndarray, posting_frequencies: np.ndarray, chunk_lengths: np.ndarray) -> np.ndarray:
+        # The BM25 term frequency part of every posting is precomputed, so a lookup only multiplies it by the idf
+        if len(chunk_lengths) == 0:
+            return np.empty(0, dtype=np.float32)
+
+        average_length = max(float(chunk_lengths.mean()), 1.0)
+        length_norms = (self.k1 * (1 - self.b + self.b * chunk_lengths / average_length)).astype(np.float32)
+        frequencies = posting_frequencies.astype(np.float32)
+
+        return frequencies * np.float32(self.k1 + 1) / (frequencies + length_norms[posting_rows])
+
+    def _save(self):
+        snapshot = self.snapshot
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+
+        with open(self.file_path + '.tmp', 'wb') as index_file:
+            np.savez(
+                index_file,
+                terms=np.frombuffer(json.dumps(snapshot.terms).encode('utf-8'), dtype=np.uint8),
+                resource_ids=np.frombuffer(json.dumps(snapshot.resource_ids).encode('utf-8'), dtype=np.uint8),
+                term_offsets=snapshot.term_offsets,
+                posting_rows=snapshot.posting_rows,
+                posting_frequencies=snapshot.posting_frequencies,
+                chunk_ids=snapshot.chunk_ids,
+                chunk_resources=snapshot.chunk_resources,
+                chunk_lengths=snapshot.chunk_lengths
+            )
+
+        os.replace(self.file_path + '.tmp', self.file_path)
+
+
+class LexicalIndexRegistry:
+    # Keeps the lexical indexes of the most recently used knowledge bases in memory, the rest stay on disk
+    def __init__(self, path: str, max_loaded_indexes: int):
+        self.path = path
+        self.max_loaded_indexes = max_loaded_indexes
+        self.indexes: OrderedDict[str, LexicalIndex] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_index(self, knowledge_base_id: str) -> LexicalIndex:
+        with self.lock:
+            index = self.indexes.get(knowledge_base_id)
+
+            if index is not None:
+                self.indexes.move_to_end(knowledge_base_id)
+                return index
+
+        index = LexicalIndex(self._file_path(knowledge_base_id))
+        index.load()
+
+        with self.lock:
+            index = self.indexes.setdefault(knowledge_base_id, index)
+            self.indexes.move_to_end(knowledge_base_id)
+
+            while len(self.indexes) > self.max_loaded_indexes:
+                self.indexes.popitem(last=False)
+
+        return index
+
+    def find_index(self, knowledge_base_id: str) -> Optional[LexicalIndex]:
+        if knowledge_base_id not in self.indexes and not os.path.exists(self._file_path(knowledge_base_id)):
+            return None
+
+        return self.get_index(knowledge_base_id)
+
+    def drop_index(self, knowledge_base_id: str):
+        with self.lock:
+            self.indexes.pop(knowledge_base_id, None)
+
+        if os.path.exists(self._file_path(knowledge_base_id)):
+            os.remove(self._file_path(knowledge_base_id))
+
+    def _file_path(self, knowledge_base_id: str) -> str:
+        return os.path.join(self.path, "_" + knowledge_base_id.replace("-", "_") + ".npz")
+
+
+lexical_indexes = LexicalIndexRegistry(
+    path=settings.lexical_index.path,
+    max_loaded_indexes=settings.lexical_index.max_loaded_indexes
+)
@@ -0,0 +1,158 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Coroutine, Iterator, Optional, TypeVar
+
+from api.server_application import socketio
+from config import settings
+
+if TYPE_CHECKING:
+    import aiohttp
+
+T = TypeVar('T')
+
+
+class LlmEventLoop:
+    # Runs the asyncio loop used for OpenAI calls in its own thread, so requests keep one pooled HTTP session per model
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread: Optional[threading.Thread] = None
+        self.sessions: dict[str, 'aiohttp.ClientSession'] = {}
+        self.lock = threading.Lock()
+
+    def submit(self, coroutine: Coroutine[Any, Any, T]) -> 'Future[T]':
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop.run_forever, name='llm-event-loop', daemon=True)
+                self.thread.start()
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def get_session(self, model: str) -> 'aiohttp.ClientSession':
+        # Only called from coroutines running on the loop, so no locking is needed
+        import aiohttp
+
+        session = self.sessions.get(model)
+
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=settings.llm.max_connections_per_model),
+                timeout=aiohttp.ClientTimeout(total=settings.llm.request_timeout)
+            )
+            self.sessions[model] = session
+
+        return session
+
+
+class ThreadSafeEvent:
+    # An event set from any thread and waited on by a request without polling. Waiting on a threading.Event would
+    # block the gevent hub and every request with it, so setting it wakes the hub of the waiter through an async
+    # watcher, the only thread safe way in. Created by the waiter, and closed by it once done waiting
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.closed = False
+
+        if socketio.async_mode == 'gevent':
+            import gevent
+            from gevent.event import Event
+
+            self.event: Any = Event()
+            self.watcher: Any = gevent.get_hub().loop.async_()
+            self.watcher.start(self.event.set)
+        else:
+            self.event = threading.Event()
+            self.watcher = None
+
+    def set(self):
+        # Only held while waking the hub up, which does not block
+        with self.lock:
+            if self.closed:
+                return
+
+            if self.watcher is not None:
+                self.watcher.send()
+            else:
+                self.event.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.event.wait(timeout)
+
+    def clear(self):
+        self.event.clear()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+            if self.watcher is not None:
+                self.watcher.close()
+
+
+def wait_for_future(future: 'Future[T]', timeout: Optional[float] = None) -> T:
+    # Yields to the server while waiting so other requests keep being served. Raises TimeoutError and cancels
+    # the future when it is not done within the timeout
+    done = ThreadSafeEvent()
+    future.add_done_callback(lambda _: done.set())
+
+    try:
+        if not done.wait(timeout) and not future.done():
+            future.cancel()
+            raise TimeoutError(f"Future not done within {timeout} seconds")
+    finally:
+        done.close()
+
+    return future.result()
+
+
+class YieldingLock:
+    # A lock requests wait on while yielding to the server, see hold_lock. Releasing it wakes its waiters through
+    # their ThreadSafeEvent. Reentrant locks can be taken again by the thread holding them, which the greenlets of
+    # the server all share
+    def __init__(self, reentrant: bool = False):
+        self.lock = threading.RLock() if reentrant else threading.Lock()
+        self.waiters: list[ThreadSafeEvent] = []
+        self.waiters_lock = threading.Lock()
+
+    def acquire(self):
+        while not self.lock.acquire(blocking=False):
+            waiter = ThreadSafeEvent()
+
+            with self.waiters_lock:
+                self.waiters.append(waiter)
+
+            try:
+                # The lock may have been released before the waiter was added
+                if self.lock.acquire(blocking=False):
+                    return
+
+                waiter.wait()
+            finally:
+                with self.waiters_lock:
+                    self.waiters.remove(waiter)
+
+                waiter.close()
+
+    def release(self):
+        self.lock.release()
+
+        with self.waiters_lock:
+            waiters = list(self.waiters)
+
+        for waiter in waiters:
+            waiter.set()
+
+
+@contextmanager
+def hold_lock(lock: YieldingLock) -> Iterator[None]:
+    # Waiting on a lock held by another thread would block the gevent hub and every request with it, so requests
+    # and threads alike take the locks they share with YieldingLock
+    lock.acquire()
+
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+llm_event_loop = LlmEventLoop()
@@ -1,12 +1,24 @@
-
+import json
 import time
+from concurrent.futures import Future
+from typing import Callable, Optional
 
-from langchain.chat_models import ChatOpenAI
-from langchain.schema import (SystemMessage)
 from custom_types import Wisdom
+from services.llm_event_loop import llm_event_loop, wait_for_future
 from services.llm_stream_handler import LlmStreamHandler
+from services.metrics import LLM_CHAT_STAGE, record_stage
 
 from config import settings
+from logger import logger
+
+SEARCH_QUERY_MODEL = "gpt-3.5-turbo"
+
+# Tokens each model accepts for the prompt and the answer together
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-4": 8192
+}
 
 
 class LlmProvider:
@@ -20,31 +32,76 @@ class LlmProvider:
         else:
             raise ValueError(f"Unknown wisdom level: {wisdom}")
 
-    def request_answer(self, prompt: str, reference: str = '', wisdom_level: Wisdom = Wisdom.MEDIUM) -> str:
-        start_time = time.time()
+    def model_name(self, wisdom: Wisdom) -> str:
+        return self._wisdom_to_model_name(wisdom)
 
-        handler = LlmStreamHandler(reference)
-        model = self._wisdom_to_model_name(wisdom_level)
-        chat = ChatOpenAI(streaming=True, callbacks=[handler], temperature=0.2, model_name=model, client=None, openai_api_key=settings.open_ai_secrets.api_key)
-        response = chat([SystemMessage(content=prompt)])
+    def context_window(self, wisdom: Wisdom) -> int:
+        return MODEL_CONTEXT_WINDOWS[self._wisdom_to_model_name(wisdom)]
 
-        end_time = time.time()
-        elapsed_time = end_time - start_time
+    def request_answer(self, prompt: str, reference: str = '', wisdom_level: Wisdom = Wisdom.MEDIUM, handler: Optional[LlmStreamHandler] = None) -> str:
+        if handler is None:
+            handler = LlmStreamHandler(reference)
 
-        print(f"Function 'prompt' took {elapsed_time:.2f} seconds")
+        model = self._wisdom_to_model_name(wisdom_level)
+        return handler.pump(llm_event_loop.submit(self._stream_chat(prompt, model, 0.2, handler.push_token)))
 
-        return response.content
+    def start_search_query(self, prompt: str) -> 'Future[str]':
+        # Returns right away so the caller can do other work while the query is being rewritten
+        return llm_event_loop.submit(self._chat(prompt, SEARCH_QUERY_MODEL, 0.1))
 
     def get_search_query(self, prompt: str) -> str:
-        start_time = time.time()
+        return wait_for_future(self.start_search_query(prompt))
+
+    async def _chat(self, prompt: str, model: str, temperature: float) -> str:
+        import openai
+
+        start_time = time.perf_counter()
+
+        openai.aiosession.set(llm_event_loop.get_session(model))
+        response = await openai.ChatCompletion.acreate(
+            model=model,
+            messages=[{ 'role': 'system', 'content': prompt }],
+            temperature=temperature,
+            api_key=settings.open_ai_secrets.api_key
+        )
+
+        elapsed_time = time.perf_counter() - start_time
+        record_stage(LLM_CHAT_STAGE, elapsed_time, model=model)
+
+        logger.debug(f"Chat request with {model} took {elapsed_time:.2f} seconds")
+
+        return response['choices'][0]['message']['content']
+
+    async def _stream_chat(self, prompt: str, model: str, temperature: float, on_token: Callable[[str], None]) -> str:
+        import openai
+
+        openai.aiosession.set(llm_event_loop.get_session(model))
+        response = await openai.ChatCompletion.acreate(
+            model=model,
+            messages=[{ 'role': 'system', 'content': prompt }],
+            temperature=temperature,
+            stream=True,
+            api_key=settings.open_ai_secrets.api_key
+        )
+
+        tokens: list[str] = []
+
+        async for chunk in response:
+            token = chunk['choices'][0]['delta'].get('content')
 
-        chat = ChatOpenAI(temperature=0.1, model_name="gpt-3.5-turbo", client=None, openai_api_key=settings.open_ai_secrets.api_key)
-        response = chat([SystemMessage(content=prompt)])
+            if token:
+                tokens.append(token)
+                on_token(token)
 
-        end_time = time.time()
-        elapsed_time = end_time - start_time
+        return "".join(tokens)
 
-        print(f"Function 'prompt' took {elapsed_time:.2f} seconds")
 
-        return response.content
+def parse_search_query(response: str, question: str) -> str:
+    # The model is asked for { "search_query": <search_query> } and null when it is not sure, in which case
+    # the question itself is used
+    try:
+        search_query = json.loads(response).get('search_query')
+    except (json.JSONDecodeError, AttributeError):
+        return response.strip() or question
 
+    return search_query if isinstance(search_query, str) and search_query.strip() else question
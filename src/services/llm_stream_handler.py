@@ -1,53 +1,104 @@
+import queue
+import time
+from concurrent.futures import Future
+from typing import Optional
 
-from typing import Any, Dict, List, Union
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.schema import AgentAction, AgentFinish, LLMResult
 from api.server_application import socketio
+from config import settings
+from services.llm_event_loop import ThreadSafeEvent
+from services.metrics import LLM_FIRST_TOKEN_STAGE, LLM_TOTAL_STAGE, llm_tokens, record_stage
+from services.socket_rooms import answer_room, emit_to_room
 from logger import logger
 
 
-class LlmStreamHandler(BaseCallbackHandler):
-    def __init__(self, reference: str):
-        super().__init__()
+class LlmStreamHandler:
+    # Tokens are pushed from the LLM event loop thread and emitted from the request in frames of a few tokens,
+    # once max_frame_tokens are pending or frame_interval seconds went by since the previous frame. Frames only go
+    # to the clients subscribed to the reference, or to the session that asked for the answer
+    def __init__(self, reference: str, session_id: Optional[str] = None):
         self.reference = reference
+        self.room = session_id if session_id is not None else answer_room(reference)
+        self.tokens: list[str] = []
+        self.pending_tokens: queue.SimpleQueue[str] = queue.SimpleQueue()
+        self.frame_tokens: list[str] = []
+        self.last_frame_time = time.time()
+        self.first_token_time: float = 0.0
+        self.start_time = time.time()
+        self.wake_up: Optional[ThreadSafeEvent] = None
 
-    def on_llm_start( self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
-        """Run when LLM starts running."""
+    def push_token(self, token: str) -> None:
+        """Run on every new token, from any thread."""
+        self.pending_tokens.put(token)
+        wake_up = self.wake_up
 
-    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
-        socketio.emit('answer_token', { 'token': token, 'reference': self.reference })
-        socketio.sleep(0)
+        if wake_up is not None:
+            wake_up.set()
+
+    def pump(self, future: 'Future[str]') -> str:
+        """Emit the tokens of an answer in frames until it finishes, then return it."""
+        # Woken up by every token and by the end of the answer, and when pending tokens are due for a frame
+        wake_up = self.wake_up = ThreadSafeEvent()
+        future.add_done_callback(lambda _: wake_up.set())
+
+        try:
+            while not future.done():
+                wake_up.wait(self._time_to_next_frame())
+                wake_up.clear()
+                self._emit_frames(flush=False)
+        finally:
+            wake_up.close()
+
+        self._emit_frames(flush=True)
+
+        elapsed_time = time.time() - self.start_time
+        time_to_first_token = self.first_token_time - self.start_time if self.first_token_time else elapsed_time
 
-    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
-       pass 
+        record_stage(LLM_FIRST_TOKEN_STAGE, time_to_first_token)
+        record_stage(LLM_TOTAL_STAGE, elapsed_time, tokens=len(self.tokens))
+        llm_tokens.inc(amount=len(self.tokens))
 
-    def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
-        print(error)
-    
-    def on_chain_start( self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any) -> None:
-        """Run when chain starts running."""
+        logger.debug(
+            f"Answer {self.reference} streamed {len(self.tokens)} tokens in {elapsed_time:.2f} seconds, "
+            f"first token after {time_to_first_token:.2f} seconds"
+        )
 
-    def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
-        """Run when chain ends running."""
+        return future.result()
 
-    def on_chain_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
-        """Run when chain errors."""
+    def replay_tokens(self, tokens: list[str]) -> None:
+        """Stream previously generated tokens the same way as live ones."""
+        for token in tokens:
+            self.push_token(token)
 
-    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> None:
-        """Run when tool starts running."""
+        self._emit_frames(flush=True)
 
-    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
-        """Run on agent action."""
-        pass
+    def _time_to_next_frame(self) -> Optional[float]:
+        if len(self.frame_tokens) == 0:
+            return None
 
-    def on_tool_end(self, output: str, **kwargs: Any) -> None:
-        """Run when tool ends running."""
+        return max(0.0, settings.streaming.frame_interval - (time.time() - self.last_frame_time))
 
-    def on_tool_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
-        """Run when tool errors."""
+    def _emit_frames(self, flush: bool) -> None:
+        while True:
+            try:
+                token = self.pending_tokens.get_nowait()
+            except queue.Empty:
+                break
 
-    def on_text(self, text: str, **kwargs: Any) -> None:
-        """Run on arbitrary text."""
+            if not self.first_token_time:
+                self.first_token_time = time.time()
+
+            self.tokens.append(token)
+            self.frame_tokens.append(token)
+
+            if len(self.frame_tokens) >= settings.streaming.max_frame_tokens:
+                self._emit_frame()
+
+        if len(self.frame_tokens) > 0 and (flush or time.time() - self.last_frame_time >= settings.streaming.frame_interval):
+            self._emit_frame()
+
+    def _emit_frame(self) -> None:
+        emit_to_room('answer_token', { 'token': "".join(self.frame_tokens), 'reference': self.reference }, self.room)
+        socketio.sleep(0)
 
-    def on_agent_finish(self, finish: AgentFinish, **kwargs: Any) -> None:
-        """Run on agent end."""
\ No newline at end of file
+        self.frame_tokens = []
+        self.last_frame_time = time.time()
@@ -0,0 +1,721 @@
+import json
+import os
+import shutil
+from typing import NamedTuple, Optional, cast
+
+import numpy as np
+
+from config import settings
+from custom_types import Wisdom
+from services.embeddings_store import (
+    EmbeddingsStore, ResourceChunkInfo,
+    METADATA_FIELDS, NO_PAGE_INDEX, ID_FIELD, RESOURCE_NAME_FIELD, RESOURCE_ID_FIELD, DATA_FIELD, CHUNK_NUMBER_FIELD,
+    TOTAL_CHUNKS_FIELD, PERCENTAGE_IN_FIELD, PAGE_INDEX_FIELD, RESOURCE_MIMETYPE_FIELD, CONTENT_HASH_FIELD, PAYLOAD_FIELD,
+    fields_from_payload
+)
+from services.llm_event_loop import YieldingLock, hold_lock
+from logger import logger
+
+VECTORS_FILE = "vectors.f32"
+STORE_FILE = "store.json"
+DELETED_FILE = "deleted.u8"
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_LISTS_FILE = "ivf_lists.i32"
+PQ_CODEBOOKS_FILE = "pq_codebooks.npy"
+PQ_CODES_FILE = "pq_codes.u8"
+
+# Stores used to keep every column in this JSON sidecar, they are converted when loaded
+METADATA_FILE = "metadata.json"
+LEGACY_IVF_FILE = "ivf.npz"
+
+METADATA_COLUMNS = METADATA_FIELDS
+
+# Fixed size columns, kept as binary files of these types
+NUMBER_COLUMNS = {
+    ID_FIELD: np.int64,
+    CHUNK_NUMBER_FIELD: np.int64,
+    TOTAL_CHUNKS_FIELD: np.int64,
+    PERCENTAGE_IN_FIELD: np.float64,
+    PAGE_INDEX_FIELD: np.int64
+}
+
+# Strings are appended to a UTF-8 blob, with the start and end of every row in an offsets file
+TEXT_COLUMNS = [RESOURCE_NAME_FIELD, RESOURCE_ID_FIELD, DATA_FIELD, RESOURCE_MIMETYPE_FIELD, CONTENT_HASH_FIELD]
+
+FLAT_INDEX = "FLAT"
+IVF_INDEX = "IVF"
+IVF_PQ_INDEX = "IVF_PQ"
+AUTO_INDEX = "AUTO"
+
+KMEANS_ITERATIONS = 10
+KMEANS_BATCH_SIZE = 65536
+
+PQ_CENTROIDS = 256
+PQ_TRAINING_VECTORS = 16384
+
+# Deleted rows are only marked as such until they are this share of the store, then the store is compacted
+COMPACTION_RATIO = 0.5
+
+
+def upgrade_legacy_metadata(metadata: dict) -> dict:
+    # Splits the JSON payload column of stores written before chunks had scalar fields. Saved with the next write
+    payload_fields = [fields_from_payload(payload) for payload in metadata.pop(PAYLOAD_FIELD)]
+
+    for field in METADATA_COLUMNS:
+        if field not in metadata:
+            metadata[field] = [fields[field] for fields in payload_fields]
+
+    return metadata
+
+
+def number_file(column: str) -> str:
+    return f"{column}.{np.dtype(NUMBER_COLUMNS[column]).str[1:]}"
+
+
+def text_file(column: str) -> str:
+    return f"{column}.txt"
+
+
+def offsets_file(column: str) -> str:
+    return f"{column}.offsets.i64"
+
+
+class LocalStoreState(NamedTuple):
+    # What searches read, replaced as a whole whenever rows are added or deleted or the store is compacted. Rows
+    # beyond the vectors of a state may already be in its texts and row_by_id, which writes extend in place
+    vectors: np.ndarray
+    numbers: dict[str, np.ndarray]
+    texts: dict[str, list[str]]
+    deleted: np.ndarray
+    row_by_id: dict[int, int]
+    ivf_centroids: Optional[np.ndarray] = None
+    ivf_lists: Optional[np.ndarray] = None
+    pq_codebooks: Optional[np.ndarray] = None
+    pq_codes: Optional[np.ndarray] = None
+
+
+class LocalEmbeddingsStore(EmbeddingsStore):
+    # Keeps the normalized float32 vectors of a knowledge base in a memory mapped file and every metadata column in
+    # files of its own, all aligned by row. Writes append to the files or overwrite single values in place, and a
+    # small store.json holding the number of rows is written last, so rows past it are dropped when loading.
+    # Compacting writes every file again in a new generation folder, which store.json then points to
+    def __init__(self, collection_name: str, path: str = settings.embeddings_store.local.path):
+        self.collection_name = self.make_guid_compatible(collection_name)
+        self.directory = os.path.join(path, self.collection_name)
+        self.dimension = settings.database.embedding_size
+        self.index_type = settings.embeddings_store.local.index_type
+        self.lock = YieldingLock()
+        self.indexed = False
+        self.state: Optional[LocalStoreState] = None
+        self.next_id = 1
+        self.generation = 0
+        self.text_bytes: dict[str, int] = {}
+        self.trained_rows = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self.state is not None
+
+    def setup(self, create_index: bool = False):
+        os.makedirs(self.directory, exist_ok=True)
+
+        if create_index:
+            self.ensure_index()
+
+    def ensure_index(self):
+        self.indexed = True
+
+    def ensure_loaded(self):
+        self._loaded_state()
+
+    def release(self):
+        with hold_lock(self.lock):
+            self.state = None
+
+    def drop_collection(self):
+        self.release()
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def delete_resource_chunks(self, resource_id: str):
+        with hold_lock(self.lock):
+            state = self._load()
+            resource_ids = state.texts[RESOURCE_ID_FIELD]
+
+            self._delete_rows(state, [row for row in np.flatnonzero(~state.deleted) if resource_ids[row] == resource_id])
+
+    def insert_resource_chunks(self, entities: list[ResourceChunkInfo]) -> list[int]:
+        if len(entities) == 0:
+            self.ensure_loaded()
+            return []
+
+        with hold_lock(self.lock):
+            state = self._load()
+            first_row = len(state.vectors)
+            ids = list(range(self.next_id, self.next_id + len(entities)))
+            new_vectors = np.asarray([e.embeddings for e in entities], dtype=np.float32)
+
+            self._append(VECTORS_FILE, new_vectors.tobytes())
+            self._append(DELETED_FILE, bytes(len(entities)))
+
+            numbers = {}
+            for column, dtype in NUMBER_COLUMNS.items():
+                values = np.asarray(ids if column == ID_FIELD else [e.field(column) for e in entities], dtype=dtype)
+                self._append(number_file(column), values.tobytes())
+                numbers[column] = np.concatenate([state.numbers[column], values])
+
+            for column in TEXT_COLUMNS:
+                values = [e.field(column) for e in entities]
+                self._append_texts(column, values)
+                state.texts[column].extend(values)
+
+            for row, id in enumerate(ids, start=first_row):
+                state.row_by_id[id] = row
+
+            self.next_id += len(entities)
+            state = state._replace(
+                vectors=self._map_vectors(first_row + len(entities)),
+                numbers=numbers,
+                deleted=np.concatenate([state.deleted, np.zeros(len(entities), dtype=bool)])
+            )
+
+            if state.ivf_centroids is not None and state.ivf_lists is not None:
+                new_lists = self._assign_lists(new_vectors, state.ivf_centroids)
+                self._append(IVF_LISTS_FILE, new_lists.tobytes())
+                state = state._replace(ivf_lists=np.concatenate([state.ivf_lists, new_lists]))
+
+            if state.pq_codebooks is not None and state.pq_codes is not None:
+                new_codes = self._encode(new_vectors, state.pq_codebooks)
+                self._append(PQ_CODES_FILE, new_codes.tobytes())
+                state = state._replace(pq_codes=np.concatenate([state.pq_codes, new_codes]))
+
+            self._write_store_file(len(state.vectors))
+            self.state = self._refresh_index(state)
+
+        return ids
+
+    def get_resource_chunks_metadata(self, resource_id: str) -> list[ResourceChunkInfo]:
+        state = self._loaded_state()
+        resource_ids = state.texts[RESOURCE_ID_FIELD]
+
+        return [
+            self._row_to_chunk(state, row)
+            for row in np.flatnonzero(~state.deleted) if resource_ids[row] == resource_id
+        ]
+
+    def delete_chunks(self, chunk_ids: list[int]):
+        with hold_lock(self.lock):
+            state = self._load()
+
+            self._delete_rows(state, [state.row_by_id[id] for id in chunk_ids if id in state.row_by_id])
+
+    def update_chunk_positions(self, entities: list[ResourceChunkInfo]) -> dict[int, int]:
+        # Values are overwritten in their files, changed strings are appended to their blob, so ids never change
+        with hold_lock(self.lock):
+            state = self._load()
+
+            for entity in entities:
+                row = state.row_by_id[cast(int, entity.id)]
+
+                for column in [CHUNK_NUMBER_FIELD, TOTAL_CHUNKS_FIELD, PERCENTAGE_IN_FIELD, PAGE_INDEX_FIELD]:
+                    value = np.asarray(entity.field(column), dtype=NUMBER_COLUMNS[column])
+
+                    if state.numbers[column][row] != value:
+                        state.numbers[column][row] = value
+                        self._write_at(number_file(column), row * value.itemsize, value.tobytes())
+
+                for column in [RESOURCE_NAME_FIELD, RESOURCE_MIMETYPE_FIELD]:
+                    value = entity.field(column)
+
+                    if state.texts[column][row] != value:
+                        state.texts[column][row] = value
+                        self._write_text_at(column, row, value, len(state.vectors))
+
+        return {}
+
+    def search_similar_chunks(self, query_vector: np.ndarray, limit: int = 5, wisdom: Wisdom = Wisdom.MEDIUM) -> list[tuple[ResourceChunkInfo, float]]:
+        state = self._loaded_state()
+        query = np.asarray(query_vector, dtype=np.float32)
+
+        return [(self._row_to_chunk(state, row), score) for row, score in self._search_rows(state, query, limit, wisdom)]
+
+    def search_similar_chunk_ids(self, query_vectors: np.ndarray, limit: int = 5, wisdom: Wisdom = Wisdom.MEDIUM) -> list[list[tuple[int, float]]]:
+        state = self._loaded_state()
+        ids = state.numbers[ID_FIELD]
+        queries = np.asarray(query_vectors, dtype=np.float32)
+
+        # Without IVF lists every query scores every vector, so all of them are scored in a single matrix product
+        if state.ivf_centroids is None:
+            all_scores = state.vectors @ queries.T
+            all_scores[state.deleted] = -np.inf
+            top_rows = [self._top_rows(np.arange(len(all_scores)), all_scores[:, i], limit) for i in range(len(queries))]
+        else:
+            top_rows = [self._search_rows(state, query, limit, wisdom) for query in queries]
+
+        return [[(int(ids[row]), score) for row, score in rows] for rows in top_rows]
+
+    def get_chunks_data(self, chunk_ids: list[str], with_embeddings: bool = False) -> list[ResourceChunkInfo]:
+        state = self._loaded_state()
+        rows = [row for row in (state.row_by_id.get(int(id)) for id in chunk_ids) if row is not None and row < len(state.vectors)]
+
+        if with_embeddings:
+            return [self._row_to_chunk(state, row, embeddings=np.array(state.vectors[row])) for row in rows]
+
+        return [self._row_to_chunk(state, row) for row in rows]
+
+    def _loaded_state(self) -> LocalStoreState:
+        state = self.state
+
+        if state is not None:
+            return state
+
+        with hold_lock(self.lock):
+            return self._load()
+
+    def _load(self) -> LocalStoreState:
+        # Called with the lock held
+        if self.state is not None:
+            return self.state
+
+        store_path = os.path.join(self.directory, STORE_FILE)
+
+        if not os.path.exists(store_path) and os.path.exists(os.path.join(self.directory, METADATA_FILE)):
+            self._convert_metadata_file()
+
+        if os.path.exists(store_path):
+            with open(store_path, 'r') as store_file:
+                store = json.load(store_file)
+        else:
+            store = {'rows': 0, 'next_id': 1, 'generation': 0, 'text_bytes': {}, 'trained_rows': 0}
+
+        rows = store['rows']
+        self.next_id = store['next_id']
+        self.generation = store['generation']
+        self.text_bytes = {column: store['text_bytes'].get(column, 0) for column in TEXT_COLUMNS}
+        self.trained_rows = store['trained_rows']
+
+        # Generations left over by an interrupted compaction are dropped
+        os.makedirs(self._path(''), exist_ok=True)
+
+        for name in os.listdir(self.directory):
+            if name.isdigit() and int(name) != self.generation:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+        # Files are cut to their committed size, dropping whatever an interrupted write appended
+        state = LocalStoreState(
+            vectors=self._read_committed(VECTORS_FILE, np.float32, rows, self.dimension, map=True),
+            numbers={column: self._read_committed(number_file(column), dtype, rows) for column, dtype in NUMBER_COLUMNS.items()},
+            texts={column: self._read_texts(column, rows) for column in TEXT_COLUMNS},
+            deleted=self._read_committed(DELETED_FILE, np.uint8, rows).astype(bool),
+            row_by_id={}
+        )
+
+        state.row_by_id.update((int(id), row) for row, id in enumerate(state.numbers[ID_FIELD]) if not state.deleted[row])
+        self.state = self._load_index(state)
+
+        return self.state
+
+    def _convert_metadata_file(self):
+        # Writes the columns of a JSON sidecar to their own files, for stores written before they had them
+        metadata_path = os.path.join(self.directory, METADATA_FILE)
+
+        with open(metadata_path, 'r') as metadata_file:
+            metadata = json.load(metadata_file)
+
+        if PAYLOAD_FIELD in metadata:
+            metadata = upgrade_legacy_metadata(metadata)
+
+        rows = len(metadata[ID_FIELD])
+        self.generation = 0
+        os.makedirs(self._path(''), exist_ok=True)
+
+        if os.path.exists(os.path.join(self.directory, VECTORS_FILE)):
+            os.replace(os.path.join(self.directory, VECTORS_FILE), self._path(VECTORS_FILE))
+
+        for column, dtype in NUMBER_COLUMNS.items():
+            self._replace_file(number_file(column), np.asarray(metadata[column], dtype=dtype).tobytes())
+
+        for column in TEXT_COLUMNS:
+            self._rewrite_texts(column, metadata[column])
+
+        self._replace_file(DELETED_FILE, bytes(rows))
+        self.next_id = metadata['next_id']
+        self.trained_rows = 0
+        self._write_store_file(rows)
+
+        os.remove(metadata_path)
+
+        if os.path.exists(os.path.join(self.directory, LEGACY_IVF_FILE)):
+            os.remove(os.path.join(self.directory, LEGACY_IVF_FILE))
+
+        logger.info(f"Converted the metadata of local embeddings store {self.collection_name} to column files")
+
+    def _delete_rows(self, state: LocalStoreState, rows: list[int]):
+        # Called with the lock held. Rows are marked as deleted, and the store is compacted once they are too many.
+        # Searches may still be reading the mask of the state, so a new state gets a copy of it, as inserts do
+        if len(rows) == 0:
+            return
+
+        deleted = state.deleted.copy()
+
+        with open(self._path(DELETED_FILE), 'r+b') as deleted_file:
+            for row in rows:
+                deleted[row] = True
+                state.row_by_id.pop(int(state.numbers[ID_FIELD][row]), None)
+                deleted_file.seek(int(row))
+                deleted_file.write(b'\x01')
+
+        state = state._replace(deleted=deleted)
+
+        if deleted.sum() > COMPACTION_RATIO * len(deleted):
+            state = self._compact(state)
+
+        self.state = state
+
+    def _compact(self, state: LocalStoreState) -> LocalStoreState:
+        keep = ~state.deleted
+        rows = int(keep.sum())
+        previous_directory = self._path('')
+
+        logger.debug(f"Compacting local embeddings store {self.collection_name} to {rows} of {len(keep)} rows")
+
+        # Readers holding the previous memory map keep reading the old file, which is only gone once they finish
+        self.generation += 1
+        os.makedirs(self._path(''), exist_ok=True)
+        self._replace_file(VECTORS_FILE, np.ascontiguousarray(state.vectors[keep]).tobytes())
+        self._replace_file(DELETED_FILE, bytes(rows))
+
+        numbers = {column: values[keep] for column, values in state.numbers.items()}
+        for column, values in numbers.items():
+            self._replace_file(number_file(column), values.tobytes())
+
+        texts = {column: [value for value, kept in zip(values, keep) if kept] for column, values in state.texts.items()}
+        for column, values in texts.items():
+            self._rewrite_texts(column, values)
+
+        state = LocalStoreState(
+            vectors=self._map_vectors(rows),
+            numbers=numbers,
+            texts=texts,
+            deleted=np.zeros(rows, dtype=bool),
+            row_by_id={int(id): row for row, id in enumerate(numbers[ID_FIELD])},
+            ivf_centroids=state.ivf_centroids,
+            ivf_lists=state.ivf_lists[keep] if state.ivf_lists is not None else None,
+            pq_codebooks=state.pq_codebooks,
+            pq_codes=state.pq_codes[keep] if state.pq_codes is not None else None
+        )
+
+        if state.ivf_centroids is not None and state.ivf_lists is not None:
+            np.save(self._path(IVF_CENTROIDS_FILE), state.ivf_centroids)
+            self._replace_file(IVF_LISTS_FILE, state.ivf_lists.tobytes())
+
+        if state.pq_codebooks is not None and state.pq_codes is not None:
+            np.save(self._path(PQ_CODEBOOKS_FILE), state.pq_codebooks)
+            self._replace_file(PQ_CODES_FILE, state.pq_codes.tobytes())
+
+        self._write_store_file(rows)
+        shutil.rmtree(previous_directory, ignore_errors=True)
+
+        return self._refresh_index(state)
+
+    def _search_rows(self, state: LocalStoreState, query: np.ndarray, limit: int, wisdom: Wisdom) -> list[tuple[int, float]]:
+        candidates = self._ivf_candidates(state, query, wisdom)
+
+        if candidates is None:
+            scores = state.vectors @ query
+            scores[state.deleted] = -np.inf
+
+            return self._top_rows(np.arange(len(scores)), scores, limit)
+
+        codebooks, codes = state.pq_codebooks, state.pq_codes
+
+        # With product quantization the candidates are ranked by their codes, and only the best of them are scored
+        # against their vectors
+        if codebooks is not None and codes is not None:
+            refined = limit * settings.embeddings_store.local.pq_refine_factor
+
+            if len(candidates) > refined:
+                tables = np.einsum('mcd,md->mc', codebooks, query.reshape(len(codebooks), -1))
+                approximate_scores = tables[np.arange(len(codebooks)), codes[candidates]].sum(axis=1)
+                candidates = np.sort(candidates[np.argpartition(-approximate_scores, refined - 1)[:refined]])
+
+        return self._top_rows(candidates, state.vectors[candidates] @ query, limit)
+
+    def _top_rows(self, rows: np.ndarray, scores: np.ndarray, limit: int) -> list[tuple[int, float]]:
+        limit = min(limit, len(scores))
+
+        if limit == 0:
+            return []
+
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+
+        # Deleted rows are scored -inf
+        return [(int(rows[i]), float(scores[i])) for i in top if scores[i] != -np.inf]
+
+    def _row_to_chunk(self, state: LocalStoreState, row: int, embeddings: Optional[np.ndarray] = None) -> ResourceChunkInfo:
+        numbers, texts = state.numbers, state.texts
+        page_index = int(numbers[PAGE_INDEX_FIELD][row])
+
+        return ResourceChunkInfo(
+            id=int(numbers[ID_FIELD][row]),
+            resource_name=texts[RESOURCE_NAME_FIELD][row],
+            resource_id=texts[RESOURCE_ID_FIELD][row],
+            data=texts[DATA_FIELD][row],
+            chunk_number=int(numbers[CHUNK_NUMBER_FIELD][row]),
+            total_chunks=int(numbers[TOTAL_CHUNKS_FIELD][row]),
+            percentage_in=float(numbers[PERCENTAGE_IN_FIELD][row]),
+            page_index=None if page_index == NO_PAGE_INDEX else page_index,
+            resource_mimetype=texts[RESOURCE_MIMETYPE_FIELD][row],
+            content_hash=texts[CONTENT_HASH_FIELD][row],
+            embeddings=embeddings
+        )
+
+    def _path(self, file_name: str) -> str:
+        return os.path.join(self.directory, str(self.generation), file_name)
+
+    def _map_vectors(self, rows: int) -> np.ndarray:
+        if rows == 0 or not os.path.exists(self._path(VECTORS_FILE)):
+            return np.empty((0, self.dimension), dtype=np.float32)
+
+        return np.memmap(self._path(VECTORS_FILE), dtype=np.float32, mode='r', shape=(rows, self.dimension))
+
+    def _read_committed(self, file_name: str, dtype, rows: int, width: int = 1, map: bool = False) -> np.ndarray:
+        path = self._path(file_name)
+        size = rows * width * np.dtype(dtype).itemsize
+
+        if not os.path.exists(path) or os.path.getsize(path) < size:
+            if rows > 0:
+                raise ValueError(f"File {path} of local embeddings store {self.collection_name} is missing rows")
+
+            return np.empty((0, width) if width > 1 else 0, dtype=dtype)
+
+        if os.path.getsize(path) > size:
+            os.truncate(path, size)
+
+        if map:
+            return self._map_vectors(rows)
+
+        values = np.fromfile(path, dtype=dtype, count=rows * width)
+
+        return values.reshape(rows, width) if width > 1 else values
+
+    def _read_texts(self, column: str, rows: int) -> list[str]:
+        offsets = self._read_committed(offsets_file(column), np.int64, rows, 2)
+        text_path = self._path(text_file(column))
+
+        if not os.path.exists(text_path):
+            return []
+
+        if os.path.getsize(text_path) > self.text_bytes[column]:
+            os.truncate(text_path, self.text_bytes[column])
+
+        with open(text_path, 'rb') as blob_file:
+            blob = blob_file.read()
+
+        return [blob[start:end].decode('utf-8') for start, end in offsets]
+
+    def _append(self, file_name: str, data: bytes):
+        with open(self._path(file_name), 'ab') as appended_file:
+            appended_file.write(data)
+
+    def _write_at(self, file_name: str, offset: int, data: bytes):
+        with open(self._path(file_name), 'r+b') as written_file:
+            written_file.seek(offset)
+            written_file.write(data)
+
+    def _replace_file(self, file_name: str, data: bytes):
+        with open(self._path(file_name) + '.tmp', 'wb') as replaced_file:
+            replaced_file.write(data)
+
+        os.replace(self._path(file_name) + '.tmp', self._path(file_name))
+
+    def _append_texts(self, column: str, values: list[str]):
+        encoded = [value.encode('utf-8') for value in values]
+        ends = self.text_bytes[column] + np.cumsum([len(value) for value in encoded], dtype=np.int64)
+        offsets = np.stack([ends - [len(value) for value in encoded], ends], axis=1).astype(np.int64)
+
+        self._append(text_file(column), b''.join(encoded))
+        self._append(offsets_file(column), offsets.tobytes())
+        self.text_bytes[column] = int(ends[-1]) if len(ends) > 0 else self.text_bytes[column]
+
+    def _write_text_at(self, column: str, row: int, value: str, rows: int):
+        # The previous value stays in the blob until the store is compacted. The new one is committed before the
+        # offsets of the row point to it
+        encoded = value.encode('utf-8')
+        start = self.text_bytes[column]
+
+        self._append(text_file(column), encoded)
+        self.text_bytes[column] = start + len(encoded)
+        self._write_store_file(rows)
+        self._write_at(offsets_file(column), row * 16, np.asarray([start, start + len(encoded)], dtype=np.int64).tobytes())
+
+    def _rewrite_texts(self, column: str, values: list[str]):
+        self.text_bytes[column] = 0
+        self._replace_file(text_file(column), b'')
+        self._replace_file(offsets_file(column), b'')
+        self._append_texts(column, values)
+
+    def _write_store_file(self, rows: int):
+        # Written last, rows past the ones it counts are not part of the store yet
+        store_path = os.path.join(self.directory, STORE_FILE)
+
+        with open(store_path + '.tmp', 'w') as store_file:
+            json.dump({
+                'rows': rows,
+                'next_id': self.next_id,
+                'generation': self.generation,
+                'text_bytes': self.text_bytes,
+                'trained_rows': self.trained_rows
+            }, store_file)
+
+        os.replace(store_path + '.tmp', store_path)
+
+    def _index_kind(self, rows: int) -> str:
+        local_settings = settings.embeddings_store.local
+
+        if self.index_type == IVF_INDEX:
+            return IVF_INDEX if rows >= local_settings.nlist else FLAT_INDEX
+        elif self.index_type == IVF_PQ_INDEX:
+            return IVF_PQ_INDEX if rows >= max(local_settings.nlist, PQ_CENTROIDS) else FLAT_INDEX
+        elif self.index_type == AUTO_INDEX:
+            if rows >= local_settings.pq_min_vectors:
+                return IVF_PQ_INDEX
+
+            return IVF_INDEX if rows >= local_settings.ivf_min_vectors else FLAT_INDEX
+        else:
+            return FLAT_INDEX
+
+    def _load_index(self, state: LocalStoreState) -> LocalStoreState:
+        rows = len(state.vectors)
+        kind = self._index_kind(int((~state.deleted).sum()))
+
+        try:
+            if kind != FLAT_INDEX:
+                state = state._replace(
+                    ivf_centroids=np.load(self._path(IVF_CENTROIDS_FILE)),
+                    ivf_lists=self._read_committed(IVF_LISTS_FILE, np.int32, rows)
+                )
+
+            if kind == IVF_PQ_INDEX:
+                codebooks = np.load(self._path(PQ_CODEBOOKS_FILE))
+                state = state._replace(pq_codebooks=codebooks, pq_codes=self._read_committed(PQ_CODES_FILE, np.uint8, rows, len(codebooks)))
+        except (OSError, ValueError):
+            # Missing or incomplete, e.g. when the index kind changed, so the index is trained again
+            return self._refresh_index(state._replace(ivf_centroids=None, ivf_lists=None, pq_codebooks=None, pq_codes=None), force=True)
+
+        return self._refresh_index(state)
+
+    def _refresh_index(self, state: LocalStoreState, force: bool = False) -> LocalStoreState:
+        live_rows = int((~state.deleted).sum())
+        kind = self._index_kind(live_rows)
+
+        if kind == FLAT_INDEX:
+            return state._replace(ivf_centroids=None, ivf_lists=None, pq_codebooks=None, pq_codes=None)
+
+        # Lists and codes are trained again once the base has doubled since they were, or when codes are missing
+        needs_codes = kind == IVF_PQ_INDEX and state.pq_codebooks is None
+        has_extra_codes = kind != IVF_PQ_INDEX and state.pq_codebooks is not None
+
+        if not force and state.ivf_centroids is not None and live_rows < 2 * self.trained_rows and not needs_codes:
+            return state._replace(pq_codebooks=None, pq_codes=None) if has_extra_codes else state
+
+        logger.debug(f"Training {kind} index of {self.collection_name} over {live_rows} vectors")
+
+        vectors = state.vectors
+        live_vectors = np.asarray(vectors[~state.deleted])
+        centroids = self._train_centroids(live_vectors, settings.embeddings_store.local.nlist)
+        lists = self._assign_lists(vectors, centroids)
+
+        np.save(self._path(IVF_CENTROIDS_FILE), centroids)
+        self._replace_file(IVF_LISTS_FILE, lists.tobytes())
+        state = state._replace(ivf_centroids=centroids, ivf_lists=lists, pq_codebooks=None, pq_codes=None)
+
+        if kind == IVF_PQ_INDEX:
+            codebooks = self._train_codebooks(live_vectors, settings.embeddings_store.local.pq_subvectors)
+            codes = self._encode(vectors, codebooks)
+
+            np.save(self._path(PQ_CODEBOOKS_FILE), codebooks)
+            self._replace_file(PQ_CODES_FILE, codes.tobytes())
+            state = state._replace(pq_codebooks=codebooks, pq_codes=codes)
+
+        self.trained_rows = live_rows
+        self._write_store_file(len(vectors))
+
+        return state
+
+    def _train_centroids(self, vectors: np.ndarray, nlist: int) -> np.ndarray:
+        random = np.random.default_rng(0)
+        centroids = vectors[random.choice(len(vectors), size=min(nlist, len(vectors)), replace=False)].copy()
+
+        for _ in range(KMEANS_ITERATIONS):
+            assignments = self._assign_lists(vectors, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, vectors)
+
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            non_empty = norms[:, 0] > 0
+            centroids[non_empty] = sums[non_empty] / norms[non_empty]
+
+        return centroids
+
+    def _assign_lists(self, vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        assignments = np.empty(len(vectors), dtype=np.int32)
+
+        for start in range(0, len(vectors), KMEANS_BATCH_SIZE):
+            batch = np.asarray(vectors[start:start + KMEANS_BATCH_SIZE])
+            assignments[start:start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+
+        return assignments
+
+    def _train_codebooks(self, vectors: np.ndarray, subvectors: int) -> np.ndarray:
+        # One set of PQ_CENTROIDS centroids per slice of the dimensions, trained by k-means on a sample
+        if self.dimension % subvectors != 0:
+            raise ValueError(f"embeddings_store.local.pq_subvectors must divide the embedding size {self.dimension}")
+
+        random = np.random.default_rng(0)
+        sample = vectors[random.choice(len(vectors), size=min(PQ_TRAINING_VECTORS, len(vectors)), replace=False)]
+        slices = sample.reshape(len(sample), subvectors, -1)
+        codebooks = slices[random.choice(len(sample), size=PQ_CENTROIDS, replace=len(sample) < PQ_CENTROIDS)].transpose(1, 0, 2).copy()
+
+        # Centroids of all slices are numbered slice * PQ_CENTROIDS + code, so each k-means step is a few bincounts
+        centroid_offsets = np.arange(subvectors) * PQ_CENTROIDS
+
+        for _ in range(KMEANS_ITERATIONS):
+            centroid_indexes = (self._encode(sample, codebooks) + centroid_offsets).ravel()
+            counts = np.bincount(centroid_indexes, minlength=subvectors * PQ_CENTROIDS)
+            sums = np.stack([
+                np.bincount(centroid_indexes, weights=slices[:, :, d].ravel(), minlength=subvectors * PQ_CENTROIDS)
+                for d in range(slices.shape[2])
+            ], axis=1)
+
+            non_empty = counts > 0
+            flat_codebooks = codebooks.reshape(-1, slices.shape[2])
+            flat_codebooks[non_empty] = sums[non_empty] / counts[non_empty, None]
+
+        return codebooks
+
+    def _encode(self, vectors: np.ndarray, codebooks: np.ndarray) -> np.ndarray:
+        # The nearest centroid of every slice, by euclidean distance
+        codes = np.empty((len(vectors), len(codebooks)), dtype=np.uint8)
+        half_norms = (codebooks ** 2).sum(axis=2) / 2
+
+        for start in range(0, len(vectors), KMEANS_BATCH_SIZE):
+            slices = np.asarray(vectors[start:start + KMEANS_BATCH_SIZE]).reshape(-1, len(codebooks), codebooks.shape[2])
+
+            for slice_index, codebook in enumerate(codebooks):
+                codes[start:start + len(slices), slice_index] = np.argmax(slices[:, slice_index] @ codebook.T - half_norms[slice_index], axis=1)
+
+        return codes
+
+    def _ivf_candidates(self, state: LocalStoreState, query: np.ndarray, wisdom: Wisdom) -> Optional[np.ndarray]:
+        centroids, lists = state.ivf_centroids, state.ivf_lists
+
+        if centroids is None or lists is None:
+            return None
+
+        rows = len(state.vectors)
+        nprobe = min(settings.embeddings_store.search_params[wisdom.name]['nprobe'], len(centroids))
+        probed_lists = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+
+        return np.flatnonzero(np.isin(lists[:rows], probed_lists) & ~state.deleted[:rows])
@@ -0,0 +1,242 @@
+import bisect
+import contextvars
+import math
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+from config import settings
+from logger import logger
+
+SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+TOKEN_BUCKETS = [128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768]
+
+# Stages of answering questions, as labels of the stage duration histogram. Ingestion stages are labeled
+# ingestion_ followed by the stage names of services.resource_ingestion
+EMBED_STAGE = 'embed'
+EMBED_QUERY_STAGE = 'embed_query'
+STORE_SETUP_STAGE = 'store_setup'
+STORE_LOAD_STAGE = 'store_load'
+VECTOR_SEARCH_STAGE = 'vector_search'
+LEXICAL_SEARCH_STAGE = 'lexical_search'
+RERANK_STAGE = 'rerank'
+SEW_STAGE = 'sew'
+PROMPT_BUILD_STAGE = 'prompt_build'
+LLM_CHAT_STAGE = 'llm_chat'
+LLM_FIRST_TOKEN_STAGE = 'llm_first_token'
+LLM_TOTAL_STAGE = 'llm_total'
+SOCKETIO_EMIT_STAGE = 'socketio_emit'
+
+
+def format_labels(label_names: tuple[str, ...], label_values: tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{escape_label(value)}"' for name, value in zip(label_names, label_values)]
+
+    if extra:
+        labels.append(extra)
+
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values: dict[tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"] + [
+            f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}"
+            for label_values, value in values
+        ]
+
+
+class Histogram:
+    # Cumulative bucket counts, sum and count per label values, as Prometheus histograms expose them.
+    # Observing is a bisect and a few additions under a lock, cheap enough for every request
+    def __init__(self, name: str, description: str, buckets: list[float], label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.buckets = sorted(buckets)
+        self.label_names = label_names
+        self.series: dict[tuple[str, ...], list[float]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        # Every series holds one count per bucket and the +Inf bucket, then the sum
+        bucket = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            series = self.series.get(label_values)
+
+            if series is None:
+                series = self.series[label_values] = [0.0] * (len(self.buckets) + 2)
+
+            series[bucket] += 1
+            series[-1] += value
+
+    def render(self) -> list[str]:
+        with self.lock:
+            series = [(label_values, list(values)) for label_values, values in self.series.items()]
+
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+
+        for label_values, values in series:
+            cumulative_count = 0.0
+
+            for bound, count in zip(self.buckets + [math.inf], values):
+                cumulative_count += count
+                bound_label = 'le="' + format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, label_values, bound_label)} {format_value(cumulative_count)}")
+
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, label_values)} {format_value(values[-1])}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, label_values)} {format_value(cumulative_count)}")
+
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, Any] = {}
+
+    def counter(self, name: str, description: str, label_names: tuple[str, ...] = ()) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, description, label_names))
+
+    def histogram(self, name: str, description: str, buckets: list[float], label_names: tuple[str, ...] = ()) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, description, buckets, label_names))
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        return "\n".join(line for metric in self.metrics.values() for line in metric.render()) + "\n"
+
+
+metrics = MetricsRegistry()
+
+stage_duration = metrics.histogram(
+    'myqa_stage_duration_seconds',
+    "Time spent in every stage of answering questions and ingesting resources",
+    settings.metrics.latency_buckets,
+    ('stage',)
+)
+http_request_duration = metrics.histogram(
+    'myqa_http_request_duration_seconds',
+    "Time spent handling HTTP requests",
+    settings.metrics.latency_buckets,
+    ('endpoint', 'method', 'status')
+)
+embed_batch_size = metrics.histogram(
+    'myqa_embed_batch_size',
+    "Texts encoded per embeddings model call",
+    SIZE_BUCKETS,
+    ('kind',)
+)
+prompt_tokens = metrics.histogram(
+    'myqa_prompt_tokens',
+    "Tokens of the answer prompts, and of the sources packed into them",
+    TOKEN_BUCKETS,
+    ('part',)
+)
+llm_tokens = metrics.counter('myqa_llm_tokens_total', "Tokens streamed by the LLM")
+socketio_emits = metrics.counter('myqa_socketio_emits_total', "Socket.IO events emitted", ('event',))
+answer_cache_hits = metrics.counter('myqa_answer_cache_hits_total', "Questions answered from the answer cache")
+answer_cache_misses = metrics.counter('myqa_answer_cache_misses_total', "Answer cache lookups that found no similar question")
+answer_cache_latency_saved = metrics.counter(
+    'myqa_answer_cache_latency_saved_seconds_total',
+    "Time the cached answers originally took to compute"
+)
+
+
+class Trace:
+    # The spans of the stages one request went through, with their start relative to the request
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.start_time = time.perf_counter()
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.spans: list[dict[str, Any]] = []
+
+    def add_span(self, name: str, start_time: float, duration: float, attributes: dict[str, Any]):
+        self.spans.append({
+            'name': name,
+            'start_ms': round((start_time - self.start_time) * 1000, 3),
+            'duration_ms': round(duration * 1000, 3),
+            **attributes
+        })
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'id': self.id,
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration_ms': round(self.duration * 1000, 3),
+            'spans': self.spans
+        }
+
+
+# Greenlets and threads started by a request do not see its trace, their stages are only counted in histograms
+current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar('current_trace', default=None)
+recent_traces: deque[Trace] = deque(maxlen=settings.metrics.trace_buffer)
+
+
+def start_trace(name: str, forced: bool = False) -> Optional[Trace]:
+    # Requests are traced when asked to, or at random with metrics.trace_sample_rate
+    if not forced and random.random() >= settings.metrics.trace_sample_rate:
+        return None
+
+    trace = Trace(name)
+    current_trace.set(trace)
+
+    return trace
+
+
+def finish_trace(trace: Trace):
+    trace.duration = time.perf_counter() - trace.start_time
+    current_trace.set(None)
+    recent_traces.append(trace)
+
+    logger.debug(f"Trace {trace.id} of {trace.name} took {trace.duration * 1000:.1f} ms over {len(trace.spans)} spans")
+
+
+def record_stage(stage: str, elapsed_time: float, **attributes: Any):
+    # For stages timed by the caller, the span is taken to end now
+    stage_duration.observe(elapsed_time, stage)
+
+    trace = current_trace.get()
+
+    if trace is not None:
+        trace.add_span(stage, time.perf_counter() - elapsed_time, elapsed_time, attributes)
+
+
+@contextmanager
+def timed_stage(stage: str, **attributes: Any) -> Iterator[dict[str, Any]]:
+    # Yields the span attributes, so the stage can add what it only knows at the end, e.g. token counts
+    start_time = time.perf_counter()
+
+    try:
+        yield attributes
+    finally:
+        record_stage(stage, time.perf_counter() - start_time, **attributes)
@@ -0,0 +1,746 @@
+import threading
+import time
+import zlib
+from functools import lru_cache
+from typing import Any, Iterator, Optional, cast
+
+import numpy as np
+from pymilvus import (
+    SearchResult,
+    connections,
+    utility,
+    FieldSchema, CollectionSchema, DataType,
+    Collection,
+    MilvusException,
+)
+from config import settings
+from custom_types import Wisdom
+from services.embeddings_store import (
+    EmbeddingsStore, ResourceChunkInfo, METADATA_FIELDS,
+    ID_FIELD, RESOURCE_NAME_FIELD, RESOURCE_ID_FIELD, DATA_FIELD, EMBEDDINGS_FIELD, CHUNK_NUMBER_FIELD, TOTAL_CHUNKS_FIELD,
+    PERCENTAGE_IN_FIELD, PAGE_INDEX_FIELD, RESOURCE_MIMETYPE_FIELD, CONTENT_HASH_FIELD, PAYLOAD_FIELD
+)
+from services.answer_cache import answer_cache
+from services.lexical_index import lexical_indexes
+from services.llm_event_loop import YieldingLock, hold_lock
+from logger import logger
+
+COLLECTION_PER_KNOWLEDGE_BASE_STORAGE = "collection_per_knowledge_base"
+SHARED_STORAGE = "shared"
+
+AUTO_INDEX = "AUTO"
+FLAT_INDEX = "FLAT"
+HNSW_INDEX = "HNSW"
+
+# A loaded collection is rebuilt on a copy with this suffix, which then takes its name
+REINDEX_SUFFIX = "_reindex"
+PREVIOUS_SUFFIX = "_previous"
+
+# Milvus refuses queries whose offset and limit add up to more rows than this
+MAX_QUERY_ROWS = 16384
+
+_connection_lock = threading.Lock()
+
+def connect_milvus():
+    # Idempotent, so the startup warmup and the first request can both call it
+    with _connection_lock:
+        if connections.has_connection("default"):
+            return
+
+        connections.connect(host=settings.milvus.host, port=settings.milvus.port)
+
+        logger.info(f"Connected to Milvus at {settings.milvus.host}:{settings.milvus.port}")
+
+
+def string_literal(value: str) -> str:
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def id_batches(ids: list[int], batch_size: int) -> list[str]:
+    # Boolean expressions with thousands of literals are slow to parse, so long id lists are split
+    return [
+        f"{ID_FIELD} in [{','.join(str(id) for id in ids[start:start + batch_size])}]"
+        for start in range(0, len(ids), batch_size)
+    ]
+
+
+def query_pages(collection: Collection, output_fields: list[str], batch_size: int, after_id: int = -1) -> Iterator[list[dict[str, Any]]]:
+    # Every row with an id above after_id, by pages of ids above the last one read. Milvus returns the smallest ids first
+    last_id = after_id
+
+    while True:
+        rows = collection.query(
+            expr=f"{ID_FIELD} > {last_id}", output_fields=output_fields, limit=min(batch_size, MAX_QUERY_ROWS)
+        )
+
+        if len(rows) == 0:
+            return
+
+        yield rows
+
+        last_id = max(row[ID_FIELD] for row in rows)
+
+
+class MilvusFlushScheduler:
+    # Flushing seals the growing segments of a collection, which is slow and serializes concurrent writers, while
+    # inserted rows are searchable before being flushed anyway. Collections are flushed every flush_interval seconds,
+    # or as soon as the flusher wakes up once max_unflushed_rows rows were inserted since their last flush. Entity
+    # counts are only exact after a flush, so that is also when indexes are tuned to the size of the collection.
+    # Inserts never flush nor rebuild an index themselves, both only run on the flusher thread
+    def __init__(self, flush_interval: float, max_unflushed_rows: int):
+        self.flush_interval = flush_interval
+        self.max_unflushed_rows = max_unflushed_rows
+        self.unflushed_rows: dict[str, int] = {}
+        self.stores: dict[str, 'CollectionEmbeddingsStore'] = {}
+        self.due: set[str] = set()
+        self.wake_up = threading.Event()
+        self.lock = threading.Lock()
+        self.started = False
+
+    def record_insert(self, store: 'CollectionEmbeddingsStore', rows: int):
+        collection_name = store.collection_name
+
+        with self.lock:
+            unflushed_rows = self.unflushed_rows.get(collection_name, 0) + rows
+            self.unflushed_rows[collection_name] = unflushed_rows
+            self.stores[collection_name] = store
+
+            if unflushed_rows >= self.max_unflushed_rows:
+                self.due.add(collection_name)
+                self.wake_up.set()
+
+        self._start()
+
+    def forget(self, collection_name: str):
+        with self.lock:
+            self.unflushed_rows.pop(collection_name, None)
+            self.stores.pop(collection_name, None)
+            self.due.discard(collection_name)
+
+    def flush_pending(self):
+        with self.lock:
+            stores = list(self.stores.values())
+            self.unflushed_rows.clear()
+            self.stores.clear()
+            self.due.clear()
+
+        for store in stores:
+            self._flush(store)
+
+    def flush_due(self):
+        # The collections past max_unflushed_rows, the others wait for the next flush_interval
+        with self.lock:
+            stores = [self.stores.pop(collection_name) for collection_name in self.due if collection_name in self.stores]
+
+            for store in stores:
+                self.unflushed_rows.pop(store.collection_name, None)
+
+            self.due.clear()
+
+        for store in stores:
+            self._flush(store)
+
+    def _flush(self, store: 'CollectionEmbeddingsStore'):
+        start_time = time.time()
+
+        try:
+            store.collection.flush()
+
+            logger.debug(f"Flushed collection {store.collection_name} in {time.time() - start_time:.2f} seconds")
+
+            store.tune_index()
+        except Exception:
+            logger.exception(f"Failed to flush collection {store.collection_name}")
+
+    def _start(self):
+        with self.lock:
+            if self.started:
+                return
+
+            self.started = True
+
+        # Inserts call this from the threads of the insert pool, which run no gevent hub that would ever schedule
+        # a background task, and flushes are blocking calls anyway. So the flusher gets a thread of its own
+        def flush_periodically():
+            next_flush = time.monotonic() + self.flush_interval
+
+            while True:
+                self.wake_up.wait(timeout=max(0.0, next_flush - time.monotonic()))
+                self.wake_up.clear()
+
+                if time.monotonic() >= next_flush:
+                    self.flush_pending()
+                    next_flush = time.monotonic() + self.flush_interval
+                else:
+                    self.flush_due()
+
+        threading.Thread(target=flush_periodically, name='milvus-flusher', daemon=True).start()
+
+
+def select_index_profile(entities: int) -> dict:
+    # The first profile whose max_entities is not exceeded, unless milvus.index_type pins one
+    profiles = settings.milvus.index_profiles
+
+    if settings.milvus.index_type != AUTO_INDEX:
+        return next(profile for profile in profiles if profile['index_type'] == settings.milvus.index_type)
+
+    return next(
+        (profile for profile in profiles if profile['max_entities'] is None or entities <= profile['max_entities']),
+        profiles[-1]
+    )
+
+
+def build_search_params(index: dict, wisdom: Wisdom, limit: int) -> dict:
+    level_params = settings.embeddings_store.search_params[wisdom.name]
+    index_type = index['index_type']
+
+    if index_type.startswith('IVF'):
+        params = {"nprobe": min(level_params['nprobe'], index['params']['nlist'])}
+    elif index_type == HNSW_INDEX:
+        # HNSW returns at most ef results
+        params = {"ef": max(level_params['ef'], limit)}
+    else:
+        params = {}
+
+    return {"metric_type": "IP", "params": params}
+
+
+flush_scheduler = MilvusFlushScheduler(
+    flush_interval=settings.milvus.flush_interval,
+    max_unflushed_rows=settings.milvus.max_unflushed_rows
+)
+
+# Deleting by a resource_id expression needs Milvus 2.3, older servers only delete by primary key.
+# Set to False the first time the server rejects such a delete
+_expression_deletes_supported: Optional[bool] = None
+
+
+# Every field but the auto generated id, in schema order
+INSERT_FIELDS = [
+    RESOURCE_NAME_FIELD, RESOURCE_ID_FIELD, DATA_FIELD, EMBEDDINGS_FIELD, CHUNK_NUMBER_FIELD, TOTAL_CHUNKS_FIELD,
+    PERCENTAGE_IN_FIELD, PAGE_INDEX_FIELD, RESOURCE_MIMETYPE_FIELD, CONTENT_HASH_FIELD
+]
+
+
+# Shared collections also keep the knowledge base of every chunk, as their last field
+KNOWLEDGE_BASE_ID_FIELD = "knowledge_base_id"
+SHARED_INSERT_FIELDS = INSERT_FIELDS + [KNOWLEDGE_BASE_ID_FIELD]
+
+
+class LegacyCollectionError(Exception):
+    pass
+
+
+class IndexRebuild:
+    # Deletes made to a loaded collection while a copy of it is indexed, made again on the copy before it takes its
+    # place. Inserted rows get larger ids, so they are copied last instead
+    def __init__(self):
+        self.deleted_ids: list[int] = []
+        self.delete_expressions: list[str] = []
+
+
+@lru_cache(maxsize=None)
+def build_resource_chunk_schema() -> CollectionSchema:
+    fields = [
+        FieldSchema(name=ID_FIELD, dtype=DataType.INT64, is_primary=True, auto_id=True),
+        FieldSchema(name=RESOURCE_NAME_FIELD, dtype=DataType.VARCHAR, max_length=settings.database.resource_name_size),
+        FieldSchema(name=RESOURCE_ID_FIELD, dtype=DataType.VARCHAR, max_length=settings.database.resource_id_size),
+        FieldSchema(name=DATA_FIELD, dtype=DataType.VARCHAR, max_length=settings.database.data_size),
+        FieldSchema(name=EMBEDDINGS_FIELD, dtype=DataType.FLOAT_VECTOR, dim=settings.database.embedding_size),
+        FieldSchema(name=CHUNK_NUMBER_FIELD, dtype=DataType.INT64),
+        FieldSchema(name=TOTAL_CHUNKS_FIELD, dtype=DataType.INT64),
+        FieldSchema(name=PERCENTAGE_IN_FIELD, dtype=DataType.FLOAT),
+        FieldSchema(name=PAGE_INDEX_FIELD, dtype=DataType.INT64),
+        FieldSchema(name=RESOURCE_MIMETYPE_FIELD, dtype=DataType.VARCHAR, max_length=settings.database.mimetype_size),
+        FieldSchema(name=CONTENT_HASH_FIELD, dtype=DataType.VARCHAR, max_length=settings.database.content_hash_size)
+    ]
+
+    return CollectionSchema(fields, "Schema for holding resource chunk embeddings")
+
+
+@lru_cache(maxsize=None)
+def build_shared_resource_chunk_schema() -> CollectionSchema:
+    fields = build_resource_chunk_schema().fields + [FieldSchema(
+        name=KNOWLEDGE_BASE_ID_FIELD,
+        dtype=DataType.VARCHAR,
+        max_length=settings.database.knowledge_base_id_size,
+        is_partition_key=settings.milvus.shared.partition_key
+    )]
+
+    return CollectionSchema(fields, "Schema for holding resource chunk embeddings of several knowledge bases")
+
+
+def shared_collection_name(knowledge_base_id: str) -> str:
+    # A stable hash, so a knowledge base is always found in the same collection
+    shard = zlib.crc32(knowledge_base_id.encode('utf-8')) % settings.milvus.shared.collections
+
+    return f"{settings.milvus.shared.collection_prefix}_{shard}"
+
+
+class CollectionEmbeddingsStore(EmbeddingsStore):
+    def __init__(self, collection_name: str, host: str = settings.milvus.host, port: str = settings.milvus.port):
+        self.collection_name = self.make_guid_compatible(collection_name)
+        self.knowledge_base_id = collection_name
+        self.host = host
+        self.port = port
+        self.connection_alias = "default"
+        self.filter: Optional[str] = None
+        self.insert_fields = INSERT_FIELDS
+        self.init_collection_state()
+
+    def init_collection_state(self):
+        # The handle, index and load state of the collection. Writes and index changes hold the index lock
+        self.collection: Collection
+        self.indexed = False
+        self.loaded = False
+        self.index: dict = {}
+        self.index_lock = YieldingLock(reentrant=True)
+        self.rebuild: Optional[IndexRebuild] = None
+
+    def collection_options(self) -> dict:
+        return {}
+
+    def knowledge_base_of(self, row: dict[str, Any]) -> str:
+        return self.knowledge_base_id
+
+    def scoped(self, expression: str) -> str:
+        # Stores of knowledge bases in shared collections only see their own chunks
+        return expression if self.filter is None else f"{self.filter} and ({expression})"
+
+    def setup(self, create_index: bool = False):
+        connect_milvus()
+
+        if utility.has_collection(self.collection_name) and PAYLOAD_FIELD in [field.name for field in Collection(self.collection_name).schema.fields]:
+            raise LegacyCollectionError(
+                f"Collection {self.collection_name} keeps chunk metadata in a JSON payload, "
+                "migrate it with: python -m migrations.chunk_fields"
+            )
+
+        self.collection = Collection(self.collection_name, build_resource_chunk_schema(), consistency_level="Bounded")
+
+        if create_index:
+            self.ensure_index()
+
+    def ensure_index(self):
+        if self.indexed:
+            return
+
+        with hold_lock(self.index_lock):
+            if self.indexed:
+                return
+
+            if self.collection.has_index():
+                self.index = dict(self.collection.index().params)
+            else:
+                self.index = {**select_index_profile(self.collection.num_entities), "metric_type": "IP"}
+
+                self.collection.create_index(EMBEDDINGS_FIELD, {key: self.index[key] for key in ["index_type", "metric_type", "params"]})
+
+            self.indexed = True
+
+    def larger_index_profile(self) -> Optional[dict]:
+        # The profile that fits the current size, when it is larger than the one of the index. Only larger profiles
+        # are picked, so a base shrinking around a threshold does not rebuild back and forth
+        profile_types = [profile['index_type'] for profile in settings.milvus.index_profiles]
+        profile = select_index_profile(self.collection.num_entities)
+
+        if self.index['index_type'] in profile_types and profile_types.index(profile['index_type']) <= profile_types.index(self.index['index_type']):
+            return None
+
+        return profile
+
+    def tune_index(self):
+        # Rebuilds the index with the profile that fits the current size. Only called by the flusher thread
+        if not self.indexed:
+            return
+
+        # Another server process may have rebuilt it already
+        self.index = dict(self.collection.index().params)
+        profile = self.larger_index_profile()
+
+        if profile is None:
+            return
+
+        start_time = time.time()
+
+        if not self.rebuild_in_place(profile):
+            self.rebuild_on_copy(profile)
+
+        logger.info(
+            f"Rebuilt index of collection {self.collection_name} as {profile['index_type']} "
+            f"in {time.time() - start_time:.2f} seconds"
+        )
+
+    def rebuild_in_place(self, profile: dict) -> bool:
+        # Milvus keeps a single index per field and only drops the index of a released collection. Nothing searches
+        # a released collection, so its index is rebuilt as is, and searches that load it meanwhile wait on the lock.
+        # Returns whether the collection was released
+        with hold_lock(self.index_lock):
+            if self.loaded:
+                return False
+
+            self.collection.drop_index()
+            self.collection.create_index(EMBEDDINGS_FIELD, {"index_type": profile['index_type'], "metric_type": "IP", "params": profile['params']})
+            self.index = {**profile, "metric_type": "IP"}
+
+        return True
+
+    def rebuild_on_copy(self, profile: dict):
+        # A loaded collection stays online: its rows are copied to a new collection, which is indexed and loaded
+        # before it takes the name of the collection. The writes made meanwhile are caught up with under the lock,
+        # during which writes wait. Copied chunks get new ids, so lexical indexes are remapped and cached answers of
+        # the knowledge bases are dropped, as migrations do
+        copy_name = self.collection_name + REINDEX_SUFFIX
+        fields = [ID_FIELD] + self.insert_fields
+        batch_size = settings.milvus.insert_batch_size
+        id_maps: dict[str, dict[int, int]] = {}
+
+        # Left over by an interrupted rebuild
+        if utility.has_collection(copy_name):
+            utility.drop_collection(copy_name)
+
+        copy = Collection(copy_name, self.collection.schema, consistency_level="Bounded", **self.collection_options())
+
+        with hold_lock(self.index_lock):
+            self.rebuild = IndexRebuild()
+
+        try:
+            last_id = self.copy_rows(copy, query_pages(self.collection, fields, batch_size), id_maps)
+
+            copy.flush()
+            copy.create_index(EMBEDDINGS_FIELD, {"index_type": profile['index_type'], "metric_type": "IP", "params": profile['params']})
+            copy.load()
+
+            with hold_lock(self.index_lock):
+                self.copy_rows(copy, query_pages(self.collection, fields, batch_size, after_id=last_id), id_maps)
+                rebuild = cast(IndexRebuild, self.rebuild)
+                id_map = {id: new_id for ids in id_maps.values() for id, new_id in ids.items()}
+
+                for expression in id_batches([id_map[id] for id in rebuild.deleted_ids if id in id_map], settings.milvus.delete_batch_size):
+                    copy.delete(expression)  # type: ignore
+
+                for expression in rebuild.delete_expressions:
+                    copy.delete(expression)  # type: ignore
+
+                utility.rename_collection(self.collection_name, self.collection_name + PREVIOUS_SUFFIX)
+                utility.rename_collection(copy_name, self.collection_name)
+                self.collection = Collection(self.collection_name)
+                self.index = {**profile, "metric_type": "IP"}
+        except Exception:
+            if utility.has_collection(copy_name):
+                utility.drop_collection(copy_name)
+
+            raise
+        finally:
+            with hold_lock(self.index_lock):
+                self.rebuild = None
+
+        utility.drop_collection(self.collection_name + PREVIOUS_SUFFIX)
+
+        for knowledge_base_id, ids in id_maps.items():
+            lexical_index = lexical_indexes.find_index(knowledge_base_id)
+
+            if lexical_index is not None:
+                lexical_index.remap_chunk_ids(ids)
+
+            answer_cache.invalidate(knowledge_base_id)
+
+    def copy_rows(self, copy: Collection, pages: Iterator[list[dict[str, Any]]], id_maps: dict[str, dict[int, int]]) -> int:
+        # Returns the largest copied id
+        last_id = -1
+
+        for rows in pages:
+            new_ids = copy.insert([[row[field] for row in rows] for field in self.insert_fields]).primary_keys
+
+            for row, new_id in zip(rows, new_ids):
+                id_maps.setdefault(self.knowledge_base_of(row), {})[row[ID_FIELD]] = new_id
+
+            last_id = max(last_id, max(row[ID_FIELD] for row in rows))
+
+        return last_id
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+
+        # Collections can only be loaded once indexed, and searches need to know the index type
+        self.ensure_index()
+
+        with hold_lock(self.index_lock):
+            if not self.loaded:
+                self.collection.load()
+                self.loaded = True
+
+    def release(self):
+        if not self.loaded:
+            return
+
+        self.collection.release()
+        self.loaded = False
+
+    def drop_collection(self):
+        flush_scheduler.forget(self.collection_name)
+        utility.drop_collection(self.collection_name)
+
+    def delete_resource_chunks(self, resource_id: str):
+        self.delete_by_expression(self.scoped(f"{RESOURCE_ID_FIELD} == {string_literal(resource_id)}"))
+
+    def delete_by_expression(self, expression: str):
+        global _expression_deletes_supported
+
+        if _expression_deletes_supported is not False:
+            try:
+                with hold_lock(self.index_lock):
+                    self.collection.delete(expression)  # type: ignore
+
+                    if self.rebuild is not None:
+                        self.rebuild.delete_expressions.append(expression)
+
+                _expression_deletes_supported = True
+                return
+            except MilvusException as e:
+                if _expression_deletes_supported:
+                    raise
+
+                logger.info(f"Milvus does not delete by resource id, falling back to deleting by primary key: {e}")
+                _expression_deletes_supported = False
+
+        self.ensure_loaded()
+
+        result = self.collection.query(expr=expression, output_fields=[ID_FIELD])
+
+        self.delete_chunks([r[ID_FIELD] for r in result])
+
+    def insert_resource_chunks(self, entities: list[ResourceChunkInfo]) -> list[int]:
+        if self.collection is None:
+            raise ValueError("Collection not created.")
+
+        batch_size = settings.milvus.insert_batch_size
+        ids: list[int] = []
+
+        # Bounded batches keep every insert request well below the gRPC message size limit
+        for start in range(0, len(entities), batch_size):
+            batch = entities[start:start + batch_size]
+            formatted_entities = [self.column(field, batch) for field in self.insert_fields]
+
+            with hold_lock(self.index_lock):
+                ids.extend(self.collection.insert(formatted_entities).primary_keys)
+
+        flush_scheduler.record_insert(self, len(entities))
+
+        return ids
+
+    def column(self, field: str, batch: list[ResourceChunkInfo]) -> list:
+        if field == EMBEDDINGS_FIELD:
+            return np.asarray([e.embeddings for e in batch], dtype=np.float32).tolist()
+
+        return [e.field(field) for e in batch]
+
+    def get_resource_chunks_metadata(self, resource_id: str) -> list[ResourceChunkInfo]:
+        self.ensure_loaded()
+
+        result = self.collection.query(
+            expr=self.scoped(f"{RESOURCE_ID_FIELD} == {string_literal(resource_id)}"),
+            output_fields=[field for field in METADATA_FIELDS if field != DATA_FIELD]
+        )
+
+        return [ResourceChunkInfo.from_fields(r) for r in result]
+
+    def delete_chunks(self, chunk_ids: list[int]):
+        # Older Milvus servers only delete by primary key, so deletes are not scoped. Ids come from scoped queries
+        with hold_lock(self.index_lock):
+            for expression in id_batches(chunk_ids, settings.milvus.delete_batch_size):
+                self.collection.delete(expression)  # type: ignore
+
+            if self.rebuild is not None:
+                self.rebuild.deleted_ids += chunk_ids
+
+    def update_chunk_positions(self, entities: list[ResourceChunkInfo]) -> dict[int, int]:
+        # Milvus has no in place updates for auto id collections, so moved chunks are inserted again with their
+        # stored embeddings before their old rows are deleted, and get new ids
+        if len(entities) == 0:
+            return {}
+
+        old_ids = [cast(int, entity.id) for entity in entities]
+        stored_embeddings = {chunk.id: chunk.embeddings for chunk in self.get_chunks_data([str(id) for id in old_ids], with_embeddings=True)}
+        new_ids = self.insert_resource_chunks([entity.copy(id=None, embeddings=stored_embeddings[entity.id]) for entity in entities])
+
+        self.delete_chunks(old_ids)
+
+        return dict(zip(old_ids, new_ids))
+
+    def search_similar_chunks(self, query_vector: np.ndarray, limit: int = 5, wisdom: Wisdom = Wisdom.MEDIUM) -> list[tuple[ResourceChunkInfo, float]]:
+        if self.collection is None:
+            raise ValueError(
+                "Collection not created. Please call create_collection() method first.")
+
+        self.ensure_loaded()
+
+        result = self.collection.search(
+            [np.asarray(query_vector, dtype=np.float32).tolist()],
+            "embeddings",
+            build_search_params(self.index, wisdom, limit),
+            limit=limit,
+            expr=self.filter,
+            output_fields=METADATA_FIELDS,
+            consistency_level="Bounded"
+        )
+
+        result = cast(SearchResult, result)
+
+        return [
+            (ResourceChunkInfo.from_fields({**r.to_dict()['entity'], ID_FIELD: r.id}), cast(float, r.distance))
+            for r in result[0]
+        ]
+
+    def search_similar_chunk_ids(self, query_vectors: np.ndarray, limit: int = 5, wisdom: Wisdom = Wisdom.MEDIUM) -> list[list[tuple[int, float]]]:
+        if self.collection is None:
+            raise ValueError(
+                "Collection not created. Please call create_collection() method first.")
+
+        self.ensure_loaded()
+
+        result = self.collection.search(
+            np.asarray(query_vectors, dtype=np.float32).tolist(),
+            "embeddings",
+            build_search_params(self.index, wisdom, limit),
+            limit=limit,
+            expr=self.filter,
+            output_fields=[],
+            consistency_level="Bounded"
+        )
+
+        return [[(cast(int, r.id), cast(float, r.distance)) for r in hits] for hits in cast(SearchResult, result)]
+
+    def get_chunks_data(self, chunk_ids: list[str], with_embeddings: bool = False) -> list[ResourceChunkInfo]:
+        if self.collection is None:
+            raise ValueError(
+                "Collection not created. Please call create_collection() method first.")
+
+        self.ensure_loaded()
+
+        output_fields = METADATA_FIELDS + [EMBEDDINGS_FIELD] if with_embeddings else METADATA_FIELDS
+        chunks: list[ResourceChunkInfo] = []
+
+        for expression in id_batches([int(id) for id in chunk_ids], settings.milvus.delete_batch_size):
+            for r in self.collection.query(expr=self.scoped(expression), output_fields=output_fields):
+                chunk = ResourceChunkInfo.from_fields(r)
+
+                if with_embeddings:
+                    chunk.embeddings = np.asarray(chunk.embeddings, dtype=np.float32)
+
+                chunks.append(chunk)
+
+        return chunks
+
+
+class SharedCollection(CollectionEmbeddingsStore):
+    # A collection holding the chunks of several knowledge bases. Its handle, index and load state are shared by
+    # the stores of those knowledge bases, so it is set up, indexed and loaded once for all of them
+    def __init__(self, collection_name: str):
+        super().__init__(collection_name)
+        self.collection_name = collection_name
+        self.insert_fields = SHARED_INSERT_FIELDS
+        self.setup_lock = threading.Lock()
+        self.set_up = False
+
+    def setup(self, create_index: bool = False):
+        with self.setup_lock:
+            if not self.set_up:
+                connect_milvus()
+
+                self.collection = Collection(self.collection_name, build_shared_resource_chunk_schema(), consistency_level="Bounded", **self.collection_options())
+                self.set_up = True
+
+        if create_index:
+            self.ensure_index()
+
+    def collection_options(self) -> dict:
+        # Without a partition key, knowledge bases are only told apart by filtering on the field
+        return {'num_partitions': settings.milvus.shared.num_partitions} if settings.milvus.shared.partition_key else {}
+
+    def knowledge_base_of(self, row: dict[str, Any]) -> str:
+        return row[KNOWLEDGE_BASE_ID_FIELD]
+
+
+_shared_collections: dict[str, SharedCollection] = {}
+_shared_collections_lock = threading.Lock()
+
+def get_shared_collection(collection_name: str) -> SharedCollection:
+    with _shared_collections_lock:
+        shared_collection = _shared_collections.get(collection_name)
+
+        if shared_collection is None:
+            shared_collection = _shared_collections[collection_name] = SharedCollection(collection_name)
+
+        return shared_collection
+
+
+class SharedCollectionEmbeddingsStore(CollectionEmbeddingsStore):
+    # A knowledge base in one of the milvus.shared.collections collections, its chunks are told apart by their
+    # knowledge_base_id field. As the partition key, Milvus hashes it to one of num_partitions partitions, so
+    # searches filtered on it only scan that partition
+    releasable = False
+
+    def __init__(self, knowledge_base_id: str):
+        super().__init__(knowledge_base_id)
+        self.knowledge_base_id = knowledge_base_id
+        self.collection_name = shared_collection_name(knowledge_base_id)
+        self.filter = f"{KNOWLEDGE_BASE_ID_FIELD} == {string_literal(knowledge_base_id)}"
+        self.insert_fields = SHARED_INSERT_FIELDS
+        self.shared_collection = get_shared_collection(self.collection_name)
+
+    def init_collection_state(self):
+        # The collection state is the one of the shared collection, see the properties below
+        pass
+
+    @property
+    def collection(self) -> Collection:  # type: ignore[override]
+        return self.shared_collection.collection
+
+    @property
+    def index(self) -> dict:  # type: ignore[override]
+        return self.shared_collection.index
+
+    @property
+    def indexed(self) -> bool:  # type: ignore[override]
+        return self.shared_collection.indexed
+
+    @property
+    def loaded(self) -> bool:  # type: ignore[override]
+        return self.shared_collection.loaded
+
+    @property
+    def index_lock(self) -> YieldingLock:  # type: ignore[override]
+        return self.shared_collection.index_lock
+
+    @property
+    def rebuild(self) -> Optional[IndexRebuild]:  # type: ignore[override]
+        return self.shared_collection.rebuild
+
+    def setup(self, create_index: bool = False):
+        self.shared_collection.setup(create_index)
+
+    def ensure_index(self):
+        self.shared_collection.ensure_index()
+
+    def tune_index(self):
+        self.shared_collection.tune_index()
+
+    def ensure_loaded(self):
+        self.shared_collection.ensure_loaded()
+
+    def release(self):
+        # Releasing would unload every knowledge base of the collection, shared collections stay loaded
+        pass
+
+    def drop_collection(self):
+        # Only the chunks of the knowledge base are deleted, the collection stays for the other ones
+        self.setup()
+        self.delete_by_expression(self.filter)
+
+    def column(self, field: str, batch: list[ResourceChunkInfo]) -> list:
+        if field == KNOWLEDGE_BASE_ID_FIELD:
+            return [self.knowledge_base_id] * len(batch)
+
+        return super().column(field, batch)
@@ -0,0 +1,174 @@
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
+
+from config import settings
+from services.embeddings_store import ResourceChunkInfo
+from services.embeddings_store_registry import embeddings_stores
+from services.metrics import RERANK_STAGE, record_stage
+from logger import logger
+
+if TYPE_CHECKING:
+    from sentence_transformers import CrossEncoder
+
+
+def reranking_candidates(limit: int) -> int:
+    # How many chunks to retrieve so reranking can pick limit chunks among them
+    return limit * settings.reranking.candidates_multiplier if settings.reranking.enabled else limit
+
+
+def maximal_marginal_relevance(
+    relevance: np.ndarray,
+    embeddings: np.ndarray,
+    limit: int,
+    mmr_lambda: float,
+    duplicate_similarity: float
+) -> list[int]:
+    # Greedily picks the candidate with the best relevance minus its similarity to the closest candidate picked so far.
+    # Candidates nearly identical to a picked one, e.g. overlapping chunks, are never picked
+    similarities = embeddings @ embeddings.T
+    closest_similarity = np.zeros(len(relevance), dtype=np.float32)
+    available = np.ones(len(relevance), dtype=bool)
+    picked: list[int] = []
+
+    while len(picked) < limit and available.any():
+        scores = np.where(available, mmr_lambda * relevance - (1 - mmr_lambda) * closest_similarity, -np.inf)
+        best = int(np.argmax(scores))
+
+        picked.append(best)
+        closest_similarity = np.maximum(closest_similarity, similarities[best])
+        available[best] = False
+        available &= closest_similarity < duplicate_similarity
+
+    return picked
+
+
+class CrossEncoderScorer:
+    # Scores (query, chunk) pairs with a small cross-encoder on CPU, in batches. Scores are cached by query and chunk
+    # text, as the same questions are often asked again about the same knowledge base
+    def __init__(self, model_name: str, batch_size: int, cache_entries: int):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_entries = cache_entries
+        self.model: Optional['CrossEncoder'] = None
+        self.cache: OrderedDict[str, float] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self) -> 'CrossEncoder':
+        with self.lock:
+            if self.model is None:
+                from sentence_transformers import CrossEncoder
+
+                start_time = time.time()
+                self.model = CrossEncoder(self.model_name, max_length=512, device='cpu')
+
+                logger.info(f"Loaded cross-encoder {self.model_name} in {time.time() - start_time:.2f} seconds")
+
+            return self.model
+
+    def score(self, query: str, documents: list[str]) -> np.ndarray:
+        keys = [hashlib.sha1(f"{query}\0{document}".encode('utf-8')).hexdigest() for document in documents]
+        scores = np.empty(len(documents), dtype=np.float32)
+        missing_indexes: list[int] = []
+
+        with self.lock:
+            for i, key in enumerate(keys):
+                score = self.cache.get(key)
+
+                if score is None:
+                    missing_indexes.append(i)
+                else:
+                    self.cache.move_to_end(key)
+                    scores[i] = score
+
+        if len(missing_indexes) == 0:
+            return scores
+
+        missing_scores = self.load().predict(
+            [(query, documents[i]) for i in missing_indexes],
+            batch_size=self.batch_size,
+            show_progress_bar=False
+        )
+
+        with self.lock:
+            for i, score in zip(missing_indexes, missing_scores):
+                scores[i] = score
+                self.cache[keys[i]] = float(score)
+
+            while len(self.cache) > self.cache_entries:
+                self.cache.popitem(last=False)
+
+        return scores
+
+
+cross_encoder_scorer = CrossEncoderScorer(
+    model_name=settings.reranking.cross_encoder.model,
+    batch_size=settings.reranking.cross_encoder.batch_size,
+    cache_entries=settings.reranking.cross_encoder.cache_entries
+)
+
+
+def rerank_chunks(
+    knowledge_base_id: str,
+    query: str,
+    query_embedding: np.ndarray,
+    chunks_with_similarity: list[tuple[ResourceChunkInfo, float]],
+    limit: int
+) -> list[tuple[ResourceChunkInfo, float]]:
+    # Picks fewer, more diverse chunks among the over-fetched candidates, keeping their similarity to the query.
+    # Relevance is the similarity to the query, or the cross-encoder score when enabled
+    if not settings.reranking.enabled or len(chunks_with_similarity) == 0:
+        return chunks_with_similarity[:limit]
+
+    start_time = time.time()
+    keep = min(limit, max(settings.prompt.min_chunks, math.ceil(limit * settings.reranking.keep_ratio)))
+
+    # Searches do not return embeddings, so they are fetched for all candidates at once
+    chunk_ids = [chunk.id for chunk, _ in chunks_with_similarity]
+
+    with embeddings_stores.lease_store(knowledge_base_id) as embeddings_store:
+        stored_chunks = embeddings_store.get_chunks_data([str(id) for id in chunk_ids], with_embeddings=True)
+
+    embeddings_by_id = {chunk.id: chunk.embeddings for chunk in stored_chunks}
+    candidates = [(chunk, similarity) for chunk, similarity in chunks_with_similarity if chunk.id in embeddings_by_id]
+
+    if len(candidates) == 0:
+        return chunks_with_similarity[:keep]
+
+    embeddings = np.stack([embeddings_by_id[chunk.id] for chunk, _ in candidates]).astype(np.float32)
+    relevance = np.asarray([similarity for _, similarity in candidates], dtype=np.float32)
+    fetch_elapsed_time = time.time() - start_time
+
+    if settings.reranking.cross_encoder.enabled:
+        scores = cross_encoder_scorer.score(query, [chunk.data for chunk, _ in candidates])
+
+        # Scaled to the range of cosine similarities, so both terms of the MMR score weigh alike
+        relevance = (scores - scores.min()) / max(float(scores.max() - scores.min()), 1e-6)
+
+    picked = maximal_marginal_relevance(
+        relevance,
+        embeddings,
+        keep,
+        settings.reranking.mmr_lambda,
+        settings.reranking.duplicate_similarity
+    )
+    reranked = [candidates[i] for i in picked]
+
+    record_stage(RERANK_STAGE, time.time() - start_time, candidates=len(candidates), kept=len(reranked))
+
+    picked_characters = sum(len(chunk.data) for chunk, _ in reranked)
+    dropped_characters = sum(len(chunk.data) for chunk, _ in chunks_with_similarity[:limit]) - picked_characters
+
+    logger.debug(
+        f"Reranked {len(candidates)} candidate chunks to {len(reranked)} in {(time.time() - start_time) * 1000:.1f} ms "
+        f"({fetch_elapsed_time * 1000:.1f} ms fetching embeddings), about {max(0, dropped_characters) // 4} fewer prompt tokens "
+        f"than the top {limit} by similarity"
+    )
+
+    return reranked
+
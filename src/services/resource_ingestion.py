@@ -0,0 +1,431 @@
+import hashlib
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterable, Iterator, Optional, Callable, TypedDict, Union, cast
+
+import numpy as np
+
+from config import settings
+from services.cpu_offload import PARSING_WORKLOAD, get_pool, run_offloaded
+from services.embeddings_calculator import EmbeddingsCalculator
+from services.answer_cache import answer_cache
+from services.embeddings_store import EmbeddingsStore, ResourceChunkInfo
+from services.embeddings_store_registry import embeddings_stores
+from services.lexical_index import LexicalChunk, lexical_indexes
+from services.llm_event_loop import wait_for_future
+from services.metrics import record_stage
+from logger import logger
+
+# langchain and the document parsers are slow to import, so they are only loaded once a resource is ingested
+if TYPE_CHECKING:
+    from langchain.schema import Document
+
+LOAD_STAGE = 'load'
+SPLIT_STAGE = 'split'
+EMBED_STAGE = 'embed'
+STORE_STAGE = 'store'
+
+INGESTION_STAGES = [LOAD_STAGE, SPLIT_STAGE, EMBED_STAGE, STORE_STAGE]
+
+
+class ResourceLimitExceededError(Exception):
+    pass
+
+
+class ProcessedDataStats(TypedDict):
+    total_chunks: int
+    total_characters: int
+
+
+class ResourceUpload(TypedDict):
+    resource_id: str
+    resource_name: str
+    mimetype: str
+    file_path: str
+
+
+class ResourceIngestionError(TypedDict):
+    error: str
+
+
+# Called with the stage name and the seconds it took, after each stage completes
+StageCallback = Callable[[str, float], None]
+
+_insert_pool: Optional[ThreadPoolExecutor] = None
+
+def get_insert_pool() -> ThreadPoolExecutor:
+    global _insert_pool
+
+    if _insert_pool is None:
+        _insert_pool = ThreadPoolExecutor(max_workers=settings.ingestion.insert_threads, thread_name_prefix='store-insert')
+
+    return _insert_pool
+
+
+class PipelinedInserter:
+    # Inserts every batch in the background while the next one is embedded. At most one insert per upload is in
+    # flight, so no more than two batches of vectors are alive at a time
+    def __init__(self, embeddings_store: EmbeddingsStore):
+        self.embeddings_store = embeddings_store
+        self.pending: Optional[tuple[Future[list[int]], list[ResourceChunkInfo]]] = None
+        self.lexical_chunks: list[LexicalChunk] = []
+
+    def insert(self, rows: list[ResourceChunkInfo]):
+        self._wait_pending()
+        self.pending = (get_insert_pool().submit(self.embeddings_store.insert_resource_chunks, rows), rows)
+
+    def finish(self) -> list[LexicalChunk]:
+        # Returns the inserted chunks, with the ids the store gave them
+        self._wait_pending()
+
+        return self.lexical_chunks
+
+    def _wait_pending(self):
+        if self.pending is None:
+            return
+
+        future, rows = self.pending
+        self.pending = None
+        inserted_ids = wait_for_future(future)
+
+        for row in rows:
+            row.embeddings = None
+
+        self.lexical_chunks += [LexicalChunk(id, row.resource_id, row.data) for id, row in zip(inserted_ids, rows)]
+
+
+class TimedIterator:
+    # Accumulates the time spent producing the items of the wrapped iterator
+    def __init__(self, iterable: 'Iterable[Document]'):
+        self.iterator = iter(iterable)
+        self.elapsed_time = 0.0
+
+    def __iter__(self) -> 'Iterator[Document]':
+        return self
+
+    def __next__(self) -> 'Document':
+        start_time = time.time()
+
+        try:
+            return next(self.iterator)
+        finally:
+            self.elapsed_time += time.time() - start_time
+
+
+def iterate_resource_pages(file_path: str, mimetype: str) -> 'Iterator[Document]':
+    from langchain.schema import Document
+
+    if mimetype == 'application/pdf':
+        logger.debug(f"Used pdf file reader for {file_path}")
+
+        from pypdf import PdfReader
+
+        reader = PdfReader(file_path)
+
+        # Pages are parsed one at a time, the same way PyPDFLoader builds its documents
+        for page_index, page in enumerate(reader.pages):
+            yield Document(page_content=page.extract_text(), metadata={'source': file_path, 'page': page_index})
+    else:
+        from langchain.document_loaders import UnstructuredFileLoader
+
+        loader = UnstructuredFileLoader(
+            file_path,
+            strategy='fast'
+        )
+
+        logger.debug(f"Used unstructured file loader for {file_path}")
+
+        yield from loader.load()
+
+
+def split_resource(pages: 'Iterable[Document]') -> 'list[Document]':
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=settings.chunking.chunk_size,
+        chunk_overlap=settings.chunking.chunk_overlap,
+        length_function=len,
+    )
+
+    texts: 'list[Document]' = []
+    total_characters = 0
+
+    for page in pages:
+        page_texts = text_splitter.split_documents([page])
+
+        texts.extend(page_texts)
+        total_characters += sum(len(text.page_content) for text in page_texts)
+
+        # Limits are checked while the document is still being read, so oversized resources fail before any embedding work
+        if len(texts) > settings.limits.max_total_chunks:
+            raise ResourceLimitExceededError('Too many chunks')
+
+        if total_characters > settings.limits.max_total_characters:
+            raise ResourceLimitExceededError('Too many characters')
+
+    return texts
+
+
+def chunk_content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def build_resource_rows(
+    texts: 'list[Document]',
+    embeddings: Optional[np.ndarray],
+    first_chunk_number: int,
+    cumulative_character_count: list[int],
+    total_chunks: int,
+    resource_id: str,
+    resource_name: str,
+    mimetype: str
+) -> list[ResourceChunkInfo]:
+    return [
+        ResourceChunkInfo(
+            id=None,
+            resource_name=resource_name,
+            resource_id=resource_id,
+            data=text.page_content,
+            chunk_number=first_chunk_number + i,
+            total_chunks=total_chunks,
+            percentage_in=cumulative_character_count[first_chunk_number + i] / cumulative_character_count[-1],
+            page_index=text.metadata.get('page', None) if mimetype == 'application/pdf' else None,
+            resource_mimetype=mimetype,
+            content_hash=chunk_content_hash(text.page_content),
+            embeddings=embeddings[i] if embeddings is not None else None
+        ) for i, text in enumerate(texts)
+    ]
+
+
+def diff_resource_chunks(
+    stored_chunks: list[ResourceChunkInfo],
+    rows: list[ResourceChunkInfo]
+) -> tuple[list[ResourceChunkInfo], list[ResourceChunkInfo], list[int]]:
+    # Chunks are matched on their text alone: returns the rows that must be embedded and inserted, the rows of
+    # stored chunks that are kept (with their stored ids) and the ids of stored chunks no longer part of the resource
+    stored_chunks_by_hash: dict[str, list[ResourceChunkInfo]] = {}
+
+    for chunk in stored_chunks:
+        if chunk.content_hash:
+            stored_chunks_by_hash.setdefault(chunk.content_hash, []).append(chunk)
+
+    rows_to_insert: list[ResourceChunkInfo] = []
+    kept_chunks: list[ResourceChunkInfo] = []
+    kept_ids: set[int] = set()
+
+    for row in rows:
+        candidates = stored_chunks_by_hash.get(row.content_hash)
+
+        if not candidates:
+            rows_to_insert.append(row)
+            continue
+
+        stored_chunk = candidates.pop(0)
+        kept_ids.add(cast(int, stored_chunk.id))
+        kept_chunks.append(row.copy(id=stored_chunk.id))
+
+    ids_to_delete = [cast(int, chunk.id) for chunk in stored_chunks if chunk.id not in kept_ids]
+
+    return rows_to_insert, kept_chunks, ids_to_delete
+
+
+def write_resource_rows(
+    knowledge_base_id: str,
+    embeddings_store: EmbeddingsStore,
+    resource_rows: dict[str, list[ResourceChunkInfo]],
+    batch_size: int
+) -> float:
+    # Writes the rows of every resource in place of its stored chunks, returns the time spent embedding
+    lexical_chunks: list[LexicalChunk] = []
+    rows_to_insert: list[ResourceChunkInfo] = []
+
+    for resource_id, rows in resource_rows.items():
+        if not settings.ingestion.incremental_updates:
+            embeddings_store.delete_resource_chunks(resource_id)
+            rows_to_insert += rows
+            continue
+
+        # Only chunks whose text is new are embedded and inserted, kept chunks keep their ids
+        stored_chunks = embeddings_store.get_resource_chunks_metadata(resource_id)
+        new_rows, kept_chunks, ids_to_delete = diff_resource_chunks(stored_chunks, rows)
+        stored_positions = {chunk.id: chunk.position() for chunk in stored_chunks}
+        moved_chunks = [chunk for chunk in kept_chunks if stored_positions[chunk.id] != chunk.position()]
+
+        logger.debug(
+            f"Re-assimilating {resource_id}: {len(new_rows)} new chunks, {len(kept_chunks)} kept chunks "
+            f"({len(moved_chunks)} moved) and {len(ids_to_delete)} removed chunks"
+        )
+
+        embeddings_store.delete_chunks(ids_to_delete)
+
+        # Stores without in place updates give moved chunks new ids. The lexical index gets the new ones below, and
+        # cached answers whose sources hold the old ones are dropped by the invalidation that follows every write
+        id_map = embeddings_store.update_chunk_positions(moved_chunks)
+        kept_chunks = [chunk.copy(id=id_map[chunk.id]) if chunk.id in id_map else chunk for chunk in kept_chunks]
+
+        rows_to_insert += new_rows
+        lexical_chunks += [LexicalChunk(cast(int, c.id), resource_id, c.data) for c in kept_chunks]
+
+    embeddings_calculator = EmbeddingsCalculator()
+    inserter = PipelinedInserter(embeddings_store)
+    embed_elapsed_time = 0.0
+
+    # Embedding and insertion run in bounded batches, each batch is inserted while the next one is embedded
+    for batch_start in range(0, len(rows_to_insert), batch_size):
+        batch_rows = rows_to_insert[batch_start:batch_start + batch_size]
+
+        embed_start_time = time.time()
+        embeddings = embeddings_calculator.embed_documents([row.data for row in batch_rows])
+        embed_elapsed_time += time.time() - embed_start_time
+
+        for row, embedding in zip(batch_rows, embeddings):
+            row.embeddings = embedding
+
+        inserter.insert(batch_rows)
+
+    lexical_chunks += inserter.finish()
+
+    if settings.lexical_index.enabled:
+        lexical_indexes.get_index(knowledge_base_id).replace_resources(list(resource_rows), lexical_chunks)
+
+    return embed_elapsed_time
+
+
+def ingest_resource(
+    knowledge_base_id: str,
+    resource_id: str,
+    resource_name: str,
+    mimetype: str,
+    file_path: str,
+    on_stage: Optional[StageCallback] = None
+) -> ProcessedDataStats:
+    def report_stage(stage: str, elapsed_time: float):
+        logger.debug(f"Stage '{stage}' of resource {resource_id} took {elapsed_time:.2f} seconds")
+        record_stage(f"ingestion_{stage}", elapsed_time)
+
+        if on_stage is not None:
+            on_stage(stage, elapsed_time)
+
+    split_start_time = time.time()
+
+    texts, load_elapsed_time = run_offloaded(PARSING_WORKLOAD, parse_resource, file_path, mimetype)
+
+    report_stage(LOAD_STAGE, load_elapsed_time)
+    report_stage(SPLIT_STAGE, time.time() - split_start_time - load_elapsed_time)
+
+    cumulative_character_count = [0]
+    for text in texts:
+        cumulative_character_count.append(cumulative_character_count[-1] + len(text.page_content))
+
+    store_start_time = time.time()
+
+    rows = build_resource_rows(texts, None, 0, cumulative_character_count, len(texts), resource_id, resource_name, mimetype)
+
+    try:
+        with embeddings_stores.lease_store(knowledge_base_id, create_index=True) as embeddings_store:
+            embed_elapsed_time = write_resource_rows(knowledge_base_id, embeddings_store, {resource_id: rows}, settings.ingestion.batch_size)
+    finally:
+        answer_cache.invalidate(knowledge_base_id)
+
+    report_stage(EMBED_STAGE, embed_elapsed_time)
+    report_stage(STORE_STAGE, time.time() - store_start_time - embed_elapsed_time)
+
+    logger.info(f"Assimilated {resource_name} into knowledge base {knowledge_base_id}")
+
+    return ProcessedDataStats(
+        total_chunks=len(texts),
+        total_characters=cumulative_character_count[-1]
+    )
+
+
+def load_and_split_resource(file_path: str, mimetype: str) -> 'list[Document]':
+    return split_resource(iterate_resource_pages(file_path, mimetype))
+
+
+def parse_resource(file_path: str, mimetype: str) -> 'tuple[list[Document], float]':
+    # Returns the chunks and the time spent loading pages, the rest was spent splitting them
+    pages = TimedIterator(iterate_resource_pages(file_path, mimetype))
+
+    return split_resource(pages), pages.elapsed_time
+
+
+def ingest_resources(
+    knowledge_base_id: str,
+    resources: list[ResourceUpload]
+) -> dict[str, Union[ProcessedDataStats, ResourceIngestionError]]:
+    start_time = time.time()
+
+    # Parsing is CPU bound and holds the GIL, so resources are loaded and split in the parsing processes. Only
+    # max_parsing_files_in_flight files are submitted at a time, and parsed resources are written as soon as they
+    # fill an embedding batch, so memory holds a few parsed files rather than the whole upload
+    parsing_pool = get_pool(PARSING_WORKLOAD)
+    resources_to_parse = iter(resources)
+    in_flight: 'deque[tuple[ResourceUpload, Future[list[Document]]]]' = deque()
+
+    def submit_parsing():
+        while len(in_flight) < settings.ingestion.max_parsing_files_in_flight:
+            resource = next(resources_to_parse, None)
+
+            if resource is None:
+                return
+
+            in_flight.append((resource, parsing_pool.submit(load_and_split_resource, resource['file_path'], resource['mimetype'])))
+
+    results: dict[str, Union[ProcessedDataStats, ResourceIngestionError]] = {}
+    resource_rows: dict[str, list[ResourceChunkInfo]] = {}
+    pending_chunks = 0
+    parse_elapsed_time = 0.0
+
+    with embeddings_stores.lease_store(knowledge_base_id, create_index=True) as embeddings_store:
+        try:
+            submit_parsing()
+
+            while len(in_flight) > 0:
+                resource, future = in_flight.popleft()
+                parse_start_time = time.time()
+
+                try:
+                    texts = wait_for_future(future)
+                except ResourceLimitExceededError as e:
+                    results[resource['resource_id']] = ResourceIngestionError(error=str(e))
+                    continue
+                except Exception as e:
+                    logger.exception(f"Failed to parse resource {resource['resource_id']}")
+
+                    results[resource['resource_id']] = ResourceIngestionError(error=str(e))
+                    continue
+                finally:
+                    parse_elapsed_time += time.time() - parse_start_time
+                    submit_parsing()
+
+                cumulative_character_count = [0]
+                for text in texts:
+                    cumulative_character_count.append(cumulative_character_count[-1] + len(text.page_content))
+
+                results[resource['resource_id']] = ProcessedDataStats(
+                    total_chunks=len(texts),
+                    total_characters=cumulative_character_count[-1]
+                )
+                resource_rows[resource['resource_id']] = build_resource_rows(
+                    texts, None, 0, cumulative_character_count, len(texts), resource['resource_id'], resource['resource_name'], resource['mimetype']
+                )
+                pending_chunks += len(texts)
+
+                # The chunks of several resources are embedded as one stream, in batches much larger than a single upload usually has
+                if pending_chunks >= settings.ingestion.bulk_batch_size:
+                    write_resource_rows(knowledge_base_id, embeddings_store, resource_rows, settings.ingestion.bulk_batch_size)
+                    resource_rows, pending_chunks = {}, 0
+
+            if len(resource_rows) > 0:
+                write_resource_rows(knowledge_base_id, embeddings_store, resource_rows, settings.ingestion.bulk_batch_size)
+        finally:
+            answer_cache.invalidate(knowledge_base_id)
+
+    # Time spent waiting on the parsing processes, parsing overlaps with the writes of parsed resources
+    record_stage(f"ingestion_{LOAD_STAGE}", parse_elapsed_time, resources=len(resources))
+
+    assimilated = sum(1 for result in results.values() if 'error' not in result)
+    logger.info(f"Assimilated {assimilated} of {len(resources)} resources into knowledge base {knowledge_base_id} in {time.time() - start_time:.2f} seconds")
+
+    return results
@@ -0,0 +1,126 @@
+import numpy as np
+
+from config import settings
+from custom_types import Wisdom
+from services.embeddings_store import ResourceChunkInfo
+from services.embeddings_store_registry import embeddings_stores
+from services.lexical_index import lexical_indexes
+from services.metrics import LEXICAL_SEARCH_STAGE, VECTOR_SEARCH_STAGE, timed_stage
+from logger import logger
+
+VECTOR_MODE = 'vector'
+LEXICAL_MODE = 'lexical'
+HYBRID_MODE = 'hybrid'
+
+
+def reciprocal_rank_fusion(rankings: list[list[int]], k: int = settings.retrieval.rrf_k) -> list[int]:
+    # Chunk ids ordered by the sum of 1 / (k + rank) over the rankings they appear in
+    scores: dict[int, float] = {}
+
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1 / (k + rank + 1)
+
+    return sorted(scores, key=lambda chunk_id: scores[chunk_id], reverse=True)
+
+
+def search_chunks(
+    knowledge_base_id: str,
+    query: str,
+    query_embedding: np.ndarray,
+    limit: int,
+    wisdom: Wisdom = Wisdom.MEDIUM
+) -> list[tuple[ResourceChunkInfo, float]]:
+    # Returns the chunks in retrieval order with their similarity to the query embedding
+    with embeddings_stores.lease_store(knowledge_base_id) as embeddings_store:
+        mode = settings.retrieval.mode
+        lexical_index = lexical_indexes.find_index(knowledge_base_id) if mode != VECTOR_MODE else None
+
+        if lexical_index is None:
+            with timed_stage(VECTOR_SEARCH_STAGE, limit=limit):
+                return embeddings_store.search_similar_chunks(query_embedding, limit=limit, wisdom=wisdom)
+
+        candidates_limit = limit * settings.retrieval.candidates_multiplier
+
+        with timed_stage(LEXICAL_SEARCH_STAGE, limit=candidates_limit):
+            lexical_results = lexical_index.search(query, candidates_limit)
+
+        with timed_stage(VECTOR_SEARCH_STAGE, limit=candidates_limit):
+            vector_results = embeddings_store.search_similar_chunks(query_embedding, limit=candidates_limit, wisdom=wisdom) if mode == HYBRID_MODE else []
+
+        fused_ids = reciprocal_rank_fusion([
+            [chunk.id for chunk, _ in vector_results],
+            [chunk_id for chunk_id, _ in lexical_results]
+        ])[:limit]
+
+        chunks_by_id = {chunk.id: (chunk, similarity) for chunk, similarity in vector_results}
+        missing_ids = [str(chunk_id) for chunk_id in fused_ids if chunk_id not in chunks_by_id]
+
+        # Chunks only found lexically are scored against the query embedding as well, so similarity thresholds still apply
+        for chunk in embeddings_store.get_chunks_data(missing_ids, with_embeddings=True) if len(missing_ids) > 0 else []:
+            similarity = float(np.dot(chunk.embeddings, query_embedding))
+            chunk.embeddings = None
+            chunks_by_id[chunk.id] = (chunk, similarity)
+
+        logger.debug(f"{len(missing_ids)} of {len(fused_ids)} chunks retrieved from knowledge base {knowledge_base_id} were only found lexically")
+
+        return [chunks_by_id[chunk_id] for chunk_id in fused_ids if chunk_id in chunks_by_id]
+
+
+def search_chunks_batch(
+    knowledge_base_id: str,
+    queries: list[str],
+    query_embeddings: np.ndarray,
+    limit: int,
+    wisdom: Wisdom = Wisdom.MEDIUM
+) -> list[list[tuple[ResourceChunkInfo, float]]]:
+    # Same as search_chunks for several queries at once: one multi-vector search, and chunks retrieved for
+    # more than one query are fetched once
+    with embeddings_stores.lease_store(knowledge_base_id) as embeddings_store:
+        mode = settings.retrieval.mode
+        lexical_index = lexical_indexes.find_index(knowledge_base_id) if mode != VECTOR_MODE else None
+        candidates_limit = limit * settings.retrieval.candidates_multiplier if lexical_index is not None else limit
+
+        if lexical_index is None or mode == HYBRID_MODE:
+            with timed_stage(VECTOR_SEARCH_STAGE, limit=candidates_limit, queries=len(queries)):
+                vector_results = embeddings_store.search_similar_chunk_ids(query_embeddings, limit=candidates_limit, wisdom=wisdom)
+        else:
+            vector_results = [[] for _ in queries]
+
+        if lexical_index is not None:
+            with timed_stage(LEXICAL_SEARCH_STAGE, limit=candidates_limit, queries=len(queries)):
+                lexical_results = [lexical_index.search(query, candidates_limit) for query in queries]
+        else:
+            lexical_results = [[] for _ in queries]
+
+        rankings = [
+            reciprocal_rank_fusion([
+                [chunk_id for chunk_id, _ in vector_chunk_ids],
+                [chunk_id for chunk_id, _ in lexical_chunk_ids]
+            ])[:limit]
+            for vector_chunk_ids, lexical_chunk_ids in zip(vector_results, lexical_results)
+        ]
+        vector_similarities = [dict(vector_chunk_ids) for vector_chunk_ids in vector_results]
+
+        only_lexical = any(chunk_id not in similarities for ranking, similarities in zip(rankings, vector_similarities) for chunk_id in ranking)
+        chunk_ids = list({chunk_id for ranking in rankings for chunk_id in ranking})
+        chunks = embeddings_store.get_chunks_data([str(chunk_id) for chunk_id in chunk_ids], with_embeddings=only_lexical) if len(chunk_ids) > 0 else []
+        chunks_by_id = {chunk.id: chunk for chunk in chunks}
+
+        results: list[list[tuple[ResourceChunkInfo, float]]] = []
+
+        for i, (ranking, similarities) in enumerate(zip(rankings, vector_similarities)):
+            results.append([
+                (
+                    chunks_by_id[chunk_id],
+                    similarities[chunk_id] if chunk_id in similarities else float(np.dot(chunks_by_id[chunk_id].embeddings, query_embeddings[i]))
+                )
+                for chunk_id in ranking if chunk_id in chunks_by_id
+            ])
+
+        for chunk in chunks:
+            chunk.embeddings = None
+
+        logger.debug(f"Searched {len(queries)} queries of knowledge base {knowledge_base_id}, fetching {len(chunk_ids)} distinct chunks")
+
+        return results
@@ -0,0 +1,47 @@
+import time
+from typing import Any
+
+from api.server_application import socketio
+from config import settings
+from services.metrics import SOCKETIO_EMIT_STAGE, record_stage, socketio_emits
+
+
+def answer_room(reference: str) -> str:
+    return f"answer:{reference}"
+
+
+def knowledge_base_room(knowledge_base_id: str) -> str:
+    return f"knowledge_base:{knowledge_base_id}"
+
+
+def _string_values(data: dict, key: str) -> list[str]:
+    # A single value under key, or a list of them under the plural key
+    values = data.get(key + 's')
+    values = list(values) if isinstance(values, list) else []
+
+    if key in data:
+        values.append(data[key])
+
+    return [value for value in values if isinstance(value, str)]
+
+
+def subscription_rooms(data: Any) -> list[str]:
+    # Rooms of a subscribe or unsubscribe message: answers by reference, ingestion progress by knowledge base
+    if not isinstance(data, dict):
+        return []
+
+    return (
+        [answer_room(reference) for reference in _string_values(data, 'reference')] +
+        [knowledge_base_room(knowledge_base_id) for knowledge_base_id in _string_values(data, 'knowledge_base_id')]
+    )
+
+
+def emit_to_room(event: str, data: dict[str, Any], room: str):
+    # Only clients in the room get the event. socketio.broadcast_events sends it to every client instead,
+    # for clients that do not subscribe yet
+    start_time = time.perf_counter()
+
+    socketio.emit(event, data, to=None if settings.socketio.broadcast_events else room, namespace=settings.socketio.namespace)
+
+    record_stage(SOCKETIO_EMIT_STAGE, time.perf_counter() - start_time, event=event)
+    socketio_emits.inc(event)
@@ -0,0 +1,119 @@
+import threading
+import time
+from typing import Any, Callable
+
+from config import settings
+from logger import logger
+
+STEP_PENDING = 'PENDING'
+STEP_READY = 'READY'
+STEP_FAILED = 'FAILED'
+
+
+class ServiceWarmup:
+    # Loads the slow parts of the service in a thread of its own, so the server already answers health and
+    # readiness checks while they load. Requests arriving earlier load whatever they need on their own
+    def __init__(self):
+        self.steps: dict[str, Callable[[], Any]] = {}
+        self.status: dict[str, str] = {}
+        self.timings: dict[str, float] = {}
+        self.errors: dict[str, str] = {}
+
+    def add_step(self, name: str, step: Callable[[], Any]):
+        self.steps[name] = step
+        self.status[name] = STEP_PENDING
+
+    def start(self):
+        threading.Thread(target=self._run, name='service-warmup', daemon=True).start()
+
+    def ready(self) -> bool:
+        return all(status == STEP_READY for status in self.status.values())
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'ready': self.ready(),
+            'steps': {
+                name: {
+                    'status': self.status[name],
+                    'seconds': self.timings.get(name),
+                    'error': self.errors.get(name)
+                } for name in self.steps
+            }
+        }
+
+    def _run(self):
+        for name, step in self.steps.items():
+            start_time = time.time()
+
+            try:
+                step()
+                self.status[name] = STEP_READY
+            except Exception as e:
+                logger.exception(f"Warmup step '{name}' failed")
+
+                self.status[name] = STEP_FAILED
+                self.errors[name] = str(e)
+
+            self.timings[name] = time.time() - start_time
+
+            logger.info(f"Warmup step '{name}' took {self.timings[name]:.2f} seconds")
+
+
+def warm_milvus_connection():
+    from services.milvus_embeddings_store import connect_milvus
+
+    connect_milvus()
+
+
+def warm_embeddings_model():
+    from services.embedding_models import get_embedding_model
+
+    get_embedding_model().encode(["warmup"])
+
+
+def warm_cross_encoder():
+    from services.reranking import cross_encoder_scorer
+
+    cross_encoder_scorer.load()
+
+
+def warm_tokenizers():
+    from api.controllers.utils.context_builder import get_encoder
+    from services.llm_provider import MODEL_CONTEXT_WINDOWS
+
+    for model_name in MODEL_CONTEXT_WINDOWS:
+        get_encoder(model_name)
+
+
+def warm_document_parsers():
+    import langchain.document_loaders
+    import langchain.text_splitter
+    import pypdf
+
+
+def warm_parsing_processes():
+    # Starting the fork server and the workers blocks, so it is done here rather than by the first upload
+    from services.cpu_offload import PARSING_WORKLOAD, get_pool
+
+    get_pool(PARSING_WORKLOAD).submit(int).result()
+
+
+service_warmup = ServiceWarmup()
+
+def start_service_warmup():
+    from services.embeddings_store_registry import MILVUS_BACKEND
+
+    if settings.embeddings_store.backend == MILVUS_BACKEND:
+        service_warmup.add_step('milvus_connection', warm_milvus_connection)
+
+    if settings.embeddings.preload:
+        service_warmup.add_step('embeddings_model', warm_embeddings_model)
+
+    if settings.reranking.enabled and settings.reranking.cross_encoder.enabled:
+        service_warmup.add_step('cross_encoder', warm_cross_encoder)
+
+    service_warmup.add_step('tokenizers', warm_tokenizers)
+    service_warmup.add_step('document_parsers', warm_document_parsers)
+    service_warmup.add_step('parsing_processes', warm_parsing_processes)
+
+    service_warmup.start()
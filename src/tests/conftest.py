@@ -0,0 +1,50 @@
+import tempfile
+import uuid
+from typing import Any, Callable, Iterator
+
+import numpy as np
+import pytest
+
+from config import settings
+
+# Stores and indexes read their location when their modules are imported, so settings are overridden before any
+# test module imports them. Knowledge bases go to the local store in a directory of their own, no Milvus is needed
+DATA_DIR = tempfile.mkdtemp(prefix='myqa-tests-')
+
+settings.set('embeddings_store.backend', 'local')
+settings.set('embeddings_store.local.path', f"{DATA_DIR}/embeddings")
+settings.set('lexical_index.path', f"{DATA_DIR}/lexical")
+settings.set('embeddings_cache.enabled', False)
+
+
+@pytest.fixture
+def knowledge_base_id() -> Iterator[str]:
+    from services.embeddings_store_registry import embeddings_stores
+    from services.lexical_index import lexical_indexes
+
+    knowledge_base_id = str(uuid.uuid4())
+
+    yield knowledge_base_id
+
+    embeddings_stores.drop_store(knowledge_base_id)
+    lexical_indexes.drop_index(knowledge_base_id)
+
+
+@pytest.fixture
+def rng() -> np.random.Generator:
+    return np.random.default_rng(0)
+
+
+@pytest.fixture
+def override_settings() -> Iterator[Callable[[str, Any], None]]:
+    # Overrides a setting for the test, e.g. override_settings('retrieval.mode', 'vector')
+    previous_values: dict[str, Any] = {}
+
+    def override(key: str, value: Any):
+        previous_values.setdefault(key, settings.get(key))
+        settings.set(key, value)
+
+    yield override
+
+    for key, value in previous_values.items():
+        settings.set(key, value)
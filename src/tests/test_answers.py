@@ -0,0 +1,36 @@
+import json
+from concurrent.futures import Future
+
+from api.controllers.answers import rewrite_search_query
+
+
+def completed_future(result: str) -> 'Future[str]':
+    future: 'Future[str]' = Future()
+    future.set_result(result)
+
+    return future
+
+
+def test_rewritten_search_query_is_used():
+    future = completed_future(json.dumps({'search_query': "How to reset the router"}))
+
+    assert rewrite_search_query(future, "How do I do that?") == "How to reset the router"
+
+
+def test_question_is_used_when_the_rewrite_returns_nothing():
+    assert rewrite_search_query(completed_future(json.dumps({'search_query': None})), "How do I do that?") == "How do I do that?"
+
+
+def test_question_is_used_when_the_rewrite_fails():
+    future: 'Future[str]' = Future()
+    future.set_exception(RuntimeError("Rate limited"))
+
+    assert rewrite_search_query(future, "How do I do that?") == "How do I do that?"
+
+
+def test_question_is_used_when_the_rewrite_times_out(override_settings):
+    override_settings('llm.search_query_timeout', 0.05)
+    future: 'Future[str]' = Future()
+
+    assert rewrite_search_query(future, "How do I do that?") == "How do I do that?"
+    assert future.cancelled()
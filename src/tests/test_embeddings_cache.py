@@ -0,0 +1,70 @@
+import sqlite3
+
+import numpy as np
+
+from services.embeddings_cache import EmbeddingsCache
+from services.embeddings_calculator import EmbeddingsCalculator
+from tests.utils import unit_vectors
+
+
+def stored_keys(database_path: str) -> set[str]:
+    with sqlite3.connect(database_path) as database:
+        return {key for key, in database.execute("SELECT key FROM embeddings")}
+
+
+def test_embeddings_are_written_to_the_database_in_the_background(tmp_path, rng):
+    database_path = str(tmp_path / "embeddings.sqlite3")
+    cache = EmbeddingsCache("model", memory_budget_bytes=1 << 20, database_path=database_path)
+    embeddings = unit_vectors(rng, 2)
+
+    cache.put_many(["First", "Second"], embeddings)
+    cache.put_many(["Third"], embeddings[:1])
+    cache.wait_for_writes()
+
+    # A cache without anything in memory, e.g. of a restarted server, reads them back
+    results = EmbeddingsCache("model", memory_budget_bytes=1 << 20, database_path=database_path).get_many(["Second", "Third", "Fourth"])
+
+    assert np.array_equal(results[0], embeddings[1]) and np.array_equal(results[1], embeddings[0]) and results[2] is None
+
+
+def test_database_keeps_the_last_written_embeddings(tmp_path, rng):
+    database_path = str(tmp_path / "embeddings.sqlite3")
+    cache = EmbeddingsCache("model", memory_budget_bytes=1 << 20, database_path=database_path, max_database_rows=3)
+
+    for i in range(5):
+        cache.put_many([f"Text {i}"], unit_vectors(rng, 1))
+        cache.wait_for_writes()
+
+    assert stored_keys(database_path) == {cache.key(f"Text {i}") for i in range(2, 5)}
+
+
+def test_database_drops_expired_embeddings(tmp_path, rng):
+    database_path = str(tmp_path / "embeddings.sqlite3")
+    cache = EmbeddingsCache("model", memory_budget_bytes=1 << 20, database_path=database_path, database_ttl_seconds=3600)
+
+    cache.put_many(["Old"], unit_vectors(rng, 1))
+    cache.wait_for_writes()
+
+    with sqlite3.connect(database_path) as database:
+        database.execute("UPDATE embeddings SET created_at = created_at - 7200")
+
+    cache.put_many(["New"], unit_vectors(rng, 1))
+    cache.wait_for_writes()
+
+    assert stored_keys(database_path) == {cache.key("New")}
+
+
+def test_repeated_texts_are_encoded_once(monkeypatch, rng):
+    encoded: list[str] = []
+
+    def calculate_embeddings(self, batch: tuple[list[str], int, int]) -> np.ndarray:
+        encoded.extend(batch[0])
+
+        return unit_vectors(rng, len(batch[0]))
+
+    monkeypatch.setattr(EmbeddingsCalculator, 'calculate_embeddings', calculate_embeddings)
+
+    embeddings = EmbeddingsCalculator().embed_documents(["Header", "Body", "Header", "Footer", "Body"])
+
+    assert encoded == ["Header", "Body", "Footer"]
+    assert np.array_equal(embeddings[0], embeddings[2]) and np.array_equal(embeddings[1], embeddings[4])
@@ -0,0 +1,81 @@
+from services import embeddings_store_registry
+from services.embeddings_store_registry import EmbeddingsStoreRegistry
+from services.milvus_embeddings_store import SharedCollectionEmbeddingsStore, get_shared_collection, shared_collection_name
+
+
+class FakeStore:
+    # Set up, indexed and loaded right away, records its releases
+    def __init__(self, releasable: bool):
+        self.releasable = releasable
+        self.indexed = True
+        self.loaded = True
+        self.releases = 0
+
+    def setup(self):
+        pass
+
+    def release(self):
+        self.releases += 1
+        self.loaded = False
+
+
+def test_stores_that_release_nothing_do_not_count_against_the_limit(monkeypatch):
+    created: dict[str, FakeStore] = {}
+
+    def create_store(knowledge_base_id: str) -> FakeStore:
+        created[knowledge_base_id] = FakeStore(releasable=not knowledge_base_id.startswith("shared"))
+
+        return created[knowledge_base_id]
+
+    monkeypatch.setattr(embeddings_store_registry, 'create_embeddings_store', create_store)
+    registry = EmbeddingsStoreRegistry(max_loaded_collections=2, idle_release_seconds=3600)
+
+    for knowledge_base_id in ["first", "shared-1", "shared-2", "second", "shared-3"]:
+        registry.get_store(knowledge_base_id)
+
+    assert all(store.releases == 0 for store in created.values())
+
+    registry.get_store("third")
+
+    # Only the least recently used store with a collection of its own is released
+    assert [id for id, store in created.items() if store.releases > 0] == ["first"]
+    assert list(registry.stores) == ["shared-1", "shared-2", "second", "shared-3", "third"]
+
+
+def test_shared_collection_stores_share_the_collection_state():
+    store = SharedCollectionEmbeddingsStore("knowledge-base")
+    store.shared_collection.indexed = True
+
+    assert not store.releasable and store.index_lock is not None
+    assert store.shared_collection is get_shared_collection(shared_collection_name("knowledge-base"))
+    # Setting up another store of the collection does not reset its state
+    assert SharedCollectionEmbeddingsStore("knowledge-base").indexed and store.indexed
+
+
+def test_leased_stores_are_only_released_once_returned(monkeypatch):
+    created: dict[str, FakeStore] = {}
+
+    def create_store(knowledge_base_id: str) -> FakeStore:
+        created[knowledge_base_id] = FakeStore(releasable=True)
+
+        return created[knowledge_base_id]
+
+    monkeypatch.setattr(embeddings_store_registry, 'create_embeddings_store', create_store)
+    registry = EmbeddingsStoreRegistry(max_loaded_collections=1, idle_release_seconds=3600)
+
+    with registry.lease_store("first") as store:
+        # A request searching the first knowledge base keeps its collection loaded past the limit and when idle
+        registry.get_store("second")
+
+        assert created["second"].releases == 0
+
+        registry.idle_release_seconds = 0
+        registry.release_idle_stores()
+
+        assert store.loaded and created["second"].releases == 1
+
+    registry.idle_release_seconds = 3600
+    registry.get_store("third")
+
+    assert [id for id, store in created.items() if store.releases > 0] == ["first", "second"]
+    assert list(registry.releasable_stores) == ["third"] and registry.leases == {}
@@ -0,0 +1,162 @@
+import os
+import time
+from typing import Any, Callable
+
+import pytest
+
+from api.server_application import socketio
+from services import ingestion_jobs
+from services.ingestion_jobs import (
+    JOB_FAILED, JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED,
+    IngestionJob, IngestionJobQueue, IngestionQueueFullError
+)
+from services.resource_ingestion import LOAD_STAGE, STORE_STAGE, ProcessedDataStats, ResourceLimitExceededError
+
+
+@pytest.fixture
+def progress_events(monkeypatch) -> list[dict[str, Any]]:
+    events: list[dict[str, Any]] = []
+
+    monkeypatch.setattr(ingestion_jobs, 'emit_to_room', lambda event, data, room: events.append({**data, 'event': event, 'room': room}))
+
+    return events
+
+
+def ingest_with(monkeypatch, ingest: Callable[..., ProcessedDataStats]):
+    # Parsing and embedding have tests of their own, the queue only needs something that reports stages
+    monkeypatch.setattr(ingestion_jobs, 'ingest_resource', ingest)
+
+
+def create_job(tmp_path, knowledge_base_id: str = "base") -> IngestionJob:
+    work_dir = tmp_path / f"upload-{time.perf_counter_ns()}"
+    work_dir.mkdir()
+    (work_dir / "manual.txt").write_text("Manual")
+
+    return IngestionJob(knowledge_base_id, "manual", "manual.txt", 'text/plain', str(work_dir / "manual.txt"), str(work_dir))
+
+
+def wait_until_finished(job: IngestionJob, timeout: float = 5):
+    deadline = time.time() + timeout
+
+    while job.finished_at is None:
+        assert time.time() < deadline, f"Job {job.id} did not finish"
+        socketio.sleep(0.01)
+
+
+def create_queue(max_workers: int = 1, max_queue_depth: int = 10, max_queue_depth_per_knowledge_base: int = 10) -> IngestionJobQueue:
+    return IngestionJobQueue(max_workers, max_queue_depth, max_queue_depth_per_knowledge_base, finished_job_ttl=3600)
+
+
+def test_succeeded_job(monkeypatch, tmp_path, progress_events):
+    def ingest(knowledge_base_id, resource_id, resource_name, mimetype, file_path, on_stage):
+        assert os.path.exists(file_path)
+
+        on_stage(LOAD_STAGE, 0.5)
+        on_stage(STORE_STAGE, 0.25)
+
+        return ProcessedDataStats(total_chunks=3, total_characters=120)
+
+    ingest_with(monkeypatch, ingest)
+    queue = create_queue()
+    job = create_job(tmp_path)
+
+    queue.submit(job)
+    assert queue.get_job(job.id) is job
+    assert job.status in (JOB_QUEUED, JOB_RUNNING, JOB_SUCCEEDED)
+
+    wait_until_finished(job)
+
+    assert job.status == JOB_SUCCEEDED
+    assert job.processed_data_stats == {'total_chunks': 3, 'total_characters': 120}
+    assert job.stage_timings == {LOAD_STAGE: 0.5, STORE_STAGE: 0.25}
+    assert job.error is None
+    assert not os.path.exists(job.work_dir)
+
+    assert [(event['status'], event['current_stage']) for event in progress_events] == [
+        (JOB_RUNNING, None), (JOB_RUNNING, LOAD_STAGE), (JOB_RUNNING, STORE_STAGE), (JOB_SUCCEEDED, STORE_STAGE)
+    ]
+    assert all(event['event'] == 'ingestion_progress' and event['room'] == "knowledge_base:base" for event in progress_events)
+    assert queue.active_workers == 0
+
+
+@pytest.mark.parametrize("error", [ResourceLimitExceededError('Too many chunks'), ValueError('Unreadable file')])
+def test_failed_job(monkeypatch, tmp_path, progress_events, error):
+    def ingest(*args, on_stage):
+        raise error
+
+    ingest_with(monkeypatch, ingest)
+    queue = create_queue()
+    job = create_job(tmp_path)
+
+    queue.submit(job)
+    wait_until_finished(job)
+
+    assert job.status == JOB_FAILED
+    assert job.error == str(error)
+    assert job.processed_data_stats is None
+    assert not os.path.exists(job.work_dir)
+    assert progress_events[-1]['status'] == JOB_FAILED and progress_events[-1]['error'] == str(error)
+
+
+def test_jobs_run_one_after_another_per_worker(monkeypatch, tmp_path, progress_events):
+    running: list[str] = []
+    overlapping = False
+
+    def ingest(knowledge_base_id, resource_id, resource_name, mimetype, file_path, on_stage):
+        nonlocal overlapping
+        overlapping = overlapping or len(running) > 0
+        running.append(file_path)
+        socketio.sleep(0.02)
+        running.remove(file_path)
+
+        return ProcessedDataStats(total_chunks=1, total_characters=6)
+
+    ingest_with(monkeypatch, ingest)
+    queue = create_queue(max_workers=1)
+    jobs = [create_job(tmp_path) for _ in range(3)]
+
+    for job in jobs:
+        queue.submit(job)
+
+    for job in jobs:
+        wait_until_finished(job)
+
+    assert [job.status for job in jobs] == [JOB_SUCCEEDED] * 3
+    assert not overlapping
+    assert jobs[0].finished_at <= jobs[1].finished_at <= jobs[2].finished_at
+
+
+def test_full_queue_rejects_jobs(tmp_path):
+    # Without workers, jobs stay pending
+    queue = create_queue(max_workers=0, max_queue_depth=3, max_queue_depth_per_knowledge_base=2)
+
+    queue.submit(create_job(tmp_path, "first"))
+    queue.submit(create_job(tmp_path, "first"))
+
+    with pytest.raises(IngestionQueueFullError):
+        queue.submit(create_job(tmp_path, "first"))
+
+    queue.submit(create_job(tmp_path, "second"))
+
+    with pytest.raises(IngestionQueueFullError):
+        queue.submit(create_job(tmp_path, "third"))
+
+    assert queue.queue_depth() == 3
+
+
+def test_finished_jobs_are_forgotten(monkeypatch, tmp_path, progress_events):
+    ingest_with(monkeypatch, lambda *args, on_stage: ProcessedDataStats(total_chunks=1, total_characters=6))
+    queue = create_queue()
+    job = create_job(tmp_path)
+
+    queue.submit(job)
+    wait_until_finished(job)
+    job.finished_at = time.time() - queue.finished_job_ttl - 1
+
+    next_job = create_job(tmp_path)
+    queue.submit(next_job)
+
+    assert queue.get_job(job.id) is None
+
+    # Left running, the job would ingest for real in a later test
+    wait_until_finished(next_job)
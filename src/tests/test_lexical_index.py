@@ -0,0 +1,152 @@
+import math
+import os
+
+import pytest
+
+from services.lexical_index import LexicalChunk, LexicalIndex, LexicalIndexSnapshot, tokenize
+
+CHUNKS = [
+    LexicalChunk(1, "manual", "Press the power button to reset the printer"),
+    LexicalChunk(2, "manual", "Error ERR-1042 means the printer is out of paper"),
+    LexicalChunk(3, "manual", "Update the firmware from the settings menu of the printer"),
+    LexicalChunk(4, "faq", "The invoice is sent by email once the order ships"),
+]
+
+
+def bm25_scores(chunks: list[LexicalChunk], query: str, k1: float, b: float) -> dict[int, float]:
+    # Straight from the definition, to check the index against
+    documents = {chunk.id: tokenize(chunk.data) for chunk in chunks}
+    average_length = sum(len(tokens) for tokens in documents.values()) / len(documents)
+    scores: dict[int, float] = {}
+
+    for term in set(tokenize(query)):
+        document_frequency = sum(1 for tokens in documents.values() if term in tokens)
+        idf = math.log(1 + (len(documents) - document_frequency + 0.5) / (document_frequency + 0.5))
+
+        for id, tokens in documents.items():
+            frequency = tokens.count(term)
+
+            if frequency > 0:
+                scores[id] = scores.get(id, 0.0) + idf * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * len(tokens) / average_length))
+
+    return scores
+
+
+@pytest.fixture
+def index(tmp_path) -> LexicalIndex:
+    index = LexicalIndex(str(tmp_path / "index.npz"), k1=1.2, b=0.75)
+    index.replace_resources(["manual", "faq"], CHUNKS)
+
+    return index
+
+
+def test_codes_are_indexed_whole_and_by_their_parts():
+    assert tokenize("Error ERR-1042, see AB.12/X") == ["error", "err-1042", "err", "1042", "see", "ab.12/x", "ab", "12", "x"]
+
+
+@pytest.mark.parametrize("query", ["printer", "reset the printer", "ERR-1042", "firmware update settings", "invoice email"])
+def test_scores_are_bm25(index, query):
+    expected_scores = bm25_scores(CHUNKS, query, 1.2, 0.75)
+
+    results = index.search(query, limit=10)
+
+    assert [id for id, _ in results] == sorted(expected_scores, key=lambda id: -expected_scores[id])
+    assert all(score == pytest.approx(expected_scores[id], rel=1e-5) for id, score in results)
+
+
+def test_unknown_terms_find_nothing(index):
+    assert index.search("kangaroo", limit=10) == []
+
+
+def test_limit(index):
+    assert len(index.search("the printer", limit=2)) == 2
+
+
+def test_replacing_a_resource_drops_its_old_chunks(index):
+    new_chunks = [LexicalChunk(5, "manual", "Hold the reset button for ten seconds")]
+
+    index.replace_resources(["manual"], new_chunks)
+
+    assert index.search("printer", limit=10) == []
+    assert [id for id, _ in index.search("reset", limit=10)] == [5]
+    assert [id for id, _ in index.search("invoice", limit=10)] == [4]
+
+    expected_scores = bm25_scores([CHUNKS[3]] + new_chunks, "the reset button", 1.2, 0.75)
+    assert dict(index.search("the reset button", limit=10)) == pytest.approx(expected_scores, rel=1e-5)
+
+
+def test_removing_a_resource(index):
+    index.remove_resource("faq")
+
+    assert index.search("invoice", limit=10) == []
+    assert len(index.search("printer", limit=10)) == 3
+
+
+def test_saved_index_is_loaded_back(index):
+    loaded_index = LexicalIndex(index.file_path, k1=1.2, b=0.75)
+    loaded_index.load()
+
+    assert os.path.exists(index.file_path)
+    assert loaded_index.search("the printer firmware", limit=10) == index.search("the printer firmware", limit=10)
+
+
+def test_remapped_chunk_ids(index):
+    index.remap_chunk_ids({2: 20})
+
+    assert [id for id, _ in index.search("ERR-1042", limit=10)] == [20]
+
+
+def term_postings(snapshot: LexicalIndexSnapshot, term: str) -> list[tuple[int, int]]:
+    # The chunk ids and frequencies of the postings of the term, in their order in the index
+    if term not in snapshot.term_ids:
+        return []
+
+    start, end = snapshot.term_offsets[snapshot.term_ids[term]], snapshot.term_offsets[snapshot.term_ids[term] + 1]
+
+    return [(int(snapshot.chunk_ids[row]), int(frequency)) for row, frequency in zip(snapshot.posting_rows[start:end], snapshot.posting_frequencies[start:end])]
+
+
+def test_updates_give_the_index_a_fresh_build_gives(tmp_path):
+    words = [f"word{i}" for i in range(40)]
+    index = LexicalIndex(str(tmp_path / "updated.npz"), k1=1.2, b=0.75)
+    chunks: dict[str, list[LexicalChunk]] = {}
+    next_id = 1
+
+    # Resources are added, re-assimilated with other words and removed, and new terms keep showing up
+    for step in range(12):
+        resource_id = f"resource-{step % 5}"
+        chunks[resource_id] = [
+            LexicalChunk(next_id + i, resource_id, " ".join(words[(step * 7 + i * j) % (10 + step * 2)] for j in range(8)))
+            for i in range(4)
+        ]
+        next_id += 4
+        index.replace_resources([resource_id], chunks[resource_id])
+
+        if step % 4 == 3:
+            index.remove_resource("resource-1")
+            chunks.pop("resource-1", None)
+
+    # Built at once from the chunks in the order the updated index keeps them
+    rebuilt_index = LexicalIndex(str(tmp_path / "rebuilt.npz"), k1=1.2, b=0.75)
+    ids = [int(id) for id in index.snapshot.chunk_ids]
+    chunks_by_id = {chunk.id: chunk for resource_chunks in chunks.values() for chunk in resource_chunks}
+    rebuilt_index.replace_resources([], [chunks_by_id[id] for id in ids])
+
+    assert sorted(ids) == sorted(chunks_by_id)
+
+    for term in words:
+        assert term_postings(index.snapshot, term) == term_postings(rebuilt_index.snapshot, term)
+        assert index.search(term, limit=100) == pytest.approx(rebuilt_index.search(term, limit=100))
+
+
+def test_updates_never_modify_a_published_snapshot(index):
+    snapshot = index.snapshot
+    term_ids = dict(snapshot.term_ids)
+    posting_rows = snapshot.posting_rows.copy()
+
+    index.replace_resources(["manual"], [LexicalChunk(5, "manual", "A brand new term: toner")])
+
+    assert index.snapshot is not snapshot
+    assert snapshot.term_ids == term_ids and len(snapshot.terms) == len(term_ids)
+    assert (snapshot.posting_rows == posting_rows).all()
+    assert [id for id, _ in index.search("toner", limit=10)] == [5]
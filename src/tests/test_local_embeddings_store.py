@@ -0,0 +1,287 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from api.server_application import socketio
+from custom_types import Wisdom
+from services.llm_event_loop import hold_lock
+from services.local_embeddings_store import IVF_INDEX, IVF_PQ_INDEX, METADATA_FILE, LocalEmbeddingsStore
+from tests.utils import make_chunk, unit_vectors
+
+
+def create_store(knowledge_base_id: str) -> LocalEmbeddingsStore:
+    store = LocalEmbeddingsStore(knowledge_base_id)
+    store.setup(create_index=True)
+
+    return store
+
+
+def insert_vectors(store: LocalEmbeddingsStore, vectors: np.ndarray, resource_id: str = "manual") -> list[int]:
+    return store.insert_resource_chunks([
+        make_chunk(f"Chunk {i} of {resource_id}", i, len(vectors), resource_id, embeddings=vector)
+        for i, vector in enumerate(vectors)
+    ])
+
+
+def test_search_returns_exact_top_k(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    vectors = unit_vectors(rng, 500)
+    ids = insert_vectors(store, vectors)
+    query = unit_vectors(rng, 1)[0]
+
+    results = store.search_similar_chunks(query, limit=10)
+
+    expected_rows = np.argsort(-(vectors @ query))[:10]
+    assert [chunk.id for chunk, _ in results] == [ids[row] for row in expected_rows]
+    assert np.allclose([score for _, score in results], (vectors @ query)[expected_rows], atol=1e-5)
+    assert results[0][0].data == f"Chunk {expected_rows[0]} of manual"
+
+
+def test_search_similar_chunk_ids_matches_single_searches(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    insert_vectors(store, unit_vectors(rng, 300))
+    queries = unit_vectors(rng, 4)
+
+    results = store.search_similar_chunk_ids(queries, limit=5)
+
+    assert len(results) == len(queries)
+
+    for query, result in zip(queries, results):
+        assert [id for id, _ in result] == [chunk.id for chunk, _ in store.search_similar_chunks(query, limit=5)]
+
+
+def test_limit_larger_than_the_store(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    insert_vectors(store, unit_vectors(rng, 3))
+
+    assert len(store.search_similar_chunks(unit_vectors(rng, 1)[0], limit=10)) == 3
+
+
+def test_deleted_resources_are_not_found(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    vectors = unit_vectors(rng, 20)
+    insert_vectors(store, vectors[:10], "first")
+    second_ids = insert_vectors(store, vectors[10:], "second")
+
+    store.delete_resource_chunks("first")
+
+    assert store.get_resource_chunks_metadata("first") == []
+    assert sorted(chunk.id for chunk in store.get_resource_chunks_metadata("second")) == second_ids
+    assert {chunk.resource_id for chunk, _ in store.search_similar_chunks(vectors[0], limit=20)} == {"second"}
+
+
+def test_deleted_chunks_are_not_found(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    vectors = unit_vectors(rng, 10)
+    ids = insert_vectors(store, vectors)
+
+    store.delete_chunks(ids[:3])
+
+    assert [chunk.id for chunk in store.get_chunks_data([str(id) for id in ids])] == ids[3:]
+    assert ids[0] not in [chunk.id for chunk, _ in store.search_similar_chunks(vectors[0], limit=10)]
+
+
+def test_update_chunk_positions_keeps_ids_and_embeddings(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    vectors = unit_vectors(rng, 5)
+    ids = insert_vectors(store, vectors)
+
+    stored_chunk = store.get_chunks_data([str(ids[2])])[0]
+    store.update_chunk_positions([stored_chunk.copy(chunk_number=7, total_chunks=8, percentage_in=0.875, resource_name="renamed.txt")])
+
+    for reloaded in [False, True]:
+        updated_chunk = (create_store(knowledge_base_id) if reloaded else store).get_chunks_data([str(ids[2])], with_embeddings=True)[0]
+
+        assert (updated_chunk.chunk_number, updated_chunk.total_chunks, updated_chunk.percentage_in) == (7, 8, 0.875)
+        assert (updated_chunk.resource_name, updated_chunk.data) == ("renamed.txt", stored_chunk.data)
+        assert np.allclose(updated_chunk.embeddings, vectors[2])
+
+
+def test_chunks_survive_reloading(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    vectors = unit_vectors(rng, 50)
+    ids = insert_vectors(store, vectors)
+    store.delete_chunks(ids[:5])
+
+    reloaded_store = create_store(knowledge_base_id)
+    chunks = reloaded_store.get_chunks_data([str(id) for id in ids], with_embeddings=True)
+
+    assert [chunk.id for chunk in chunks] == ids[5:]
+    assert [chunk.data for chunk in chunks] == [f"Chunk {i} of manual" for i in range(5, 50)]
+    assert all(chunk.page_index is None for chunk in chunks)
+    assert np.allclose(np.stack([chunk.embeddings for chunk in chunks]), vectors[5:])
+
+    # Ids are never given twice, even after reloading
+    new_ids = insert_vectors(reloaded_store, unit_vectors(rng, 2))
+    assert min(new_ids) > max(ids)
+
+
+def clustered_vectors(rng: np.random.Generator, count: int) -> np.ndarray:
+    # Clustered vectors, as embeddings of related texts are
+    centers = unit_vectors(rng, 16)
+    points = centers[rng.integers(16, size=count)] + rng.standard_normal((count, centers.shape[1])).astype(np.float32) * 0.05
+
+    return points / np.linalg.norm(points, axis=1, keepdims=True)
+
+
+def search_recall(store: LocalEmbeddingsStore, rng: np.random.Generator, vectors: np.ndarray, ids: list[int]) -> float:
+    queries = vectors[rng.choice(len(vectors), size=20, replace=False)]
+    hits = 0
+
+    for query in queries:
+        expected_ids = {ids[row] for row in np.argsort(-(vectors @ query))[:10]}
+        hits += len(expected_ids & {chunk.id for chunk, _ in store.search_similar_chunks(query, limit=10, wisdom=Wisdom.MEDIUM)})
+
+    return hits / (10 * len(queries))
+
+
+def test_ivf_search_recall(knowledge_base_id, rng, override_settings):
+    # MEDIUM searches probe 16 of the 64 lists
+    override_settings('embeddings_store.local.nlist', 64)
+    vectors = clustered_vectors(rng, 2000)
+
+    store = create_store(knowledge_base_id)
+    store.index_type = IVF_INDEX
+    ids = insert_vectors(store, vectors)
+    recall = search_recall(store, rng, vectors, ids)
+
+    assert store.state.ivf_centroids is not None and store.state.pq_codebooks is None
+    assert recall >= 0.9
+
+
+def test_ivf_pq_search_recall(knowledge_base_id, rng, override_settings):
+    override_settings('embeddings_store.local.nlist', 64)
+    vectors = clustered_vectors(rng, 2000)
+
+    store = create_store(knowledge_base_id)
+    store.index_type = IVF_PQ_INDEX
+    ids = insert_vectors(store, vectors[:1000])
+    ids += insert_vectors(store, vectors[1000:])
+
+    # Codes are ranked first and only refine_factor * limit candidates are scored against their vectors
+    assert store.state.pq_codes is not None and store.state.pq_codes.shape == (2000, 48)
+    assert search_recall(store, rng, vectors, ids) >= 0.9
+
+    reloaded_store = create_store(knowledge_base_id)
+    reloaded_store.index_type = IVF_PQ_INDEX
+    assert search_recall(reloaded_store, rng, vectors, ids) >= 0.9
+
+
+def test_deleted_chunks_are_compacted_away(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    vectors = unit_vectors(rng, 40)
+    ids = insert_vectors(store, vectors[:20], "first") + insert_vectors(store, vectors[20:], "second")
+
+    # Deleted rows are only marked until they are half of the store
+    store.delete_resource_chunks("first")
+    assert len(store.state.vectors) == 40 and store.state.deleted.sum() == 20
+    assert set(id for id, _ in store.search_similar_chunk_ids(vectors[:1], limit=40)[0]) == set(ids[20:])
+
+    store.delete_chunks(ids[20:22])
+    assert len(store.state.vectors) == 18 and not store.state.deleted.any()
+    assert [chunk.id for chunk, _ in store.search_similar_chunks(vectors[25], limit=1)] == [ids[25]]
+
+    reloaded_store = create_store(knowledge_base_id)
+    chunks = reloaded_store.get_chunks_data([str(id) for id in ids], with_embeddings=True)
+
+    assert [chunk.id for chunk in chunks] == ids[22:]
+    assert np.allclose(np.stack([chunk.embeddings for chunk in chunks]), vectors[22:])
+    assert sorted(os.listdir(store.directory)) == ["1", "store.json"]
+
+
+def test_writes_append_to_column_files(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    insert_vectors(store, unit_vectors(rng, 10))
+    data_path = store._path("data.txt")
+    size = os.path.getsize(data_path)
+
+    insert_vectors(store, unit_vectors(rng, 1), "other")
+
+    with open(data_path, 'rb') as data_file:
+        data_file.seek(size)
+        assert data_file.read() == b"Chunk 0 of other"
+
+
+def test_rows_of_an_interrupted_write_are_dropped(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    ids = insert_vectors(store, unit_vectors(rng, 5))
+
+    # As if the process stopped after appending to some of the files, before store.json counted the row
+    for file_name in ["vectors.f32", "data.txt", "data.offsets.i64", "id.i8"]:
+        with open(store._path(file_name), 'ab') as appended_file:
+            appended_file.write(b"\x07" * 24)
+
+    reloaded_store = create_store(knowledge_base_id)
+    new_ids = insert_vectors(reloaded_store, unit_vectors(rng, 1), "other")
+
+    assert [chunk.data for chunk in reloaded_store.get_chunks_data([str(id) for id in ids + new_ids])] == [f"Chunk {i} of manual" for i in range(5)] + ["Chunk 0 of other"]
+
+
+def test_json_metadata_is_converted(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    vectors = unit_vectors(rng, 3)
+
+    # The layout stores had before their columns got files of their own
+    with open(os.path.join(store.directory, "vectors.f32"), 'wb') as vectors_file:
+        vectors_file.write(vectors.tobytes())
+
+    with open(os.path.join(store.directory, METADATA_FILE), 'w') as metadata_file:
+        json.dump({
+            'id': [4, 5, 6],
+            'resource_name': ["manual.txt"] * 3,
+            'resource_id': ["manual"] * 3,
+            'data': ["One", "Two", "Three"],
+            'payload': [json.dumps({'chunk_number': i, 'total_chunks': 3, 'percentage_in': i / 3, 'resource_mimetype': 'text/plain'}) for i in range(3)],
+            'next_id': 7
+        }, metadata_file)
+
+    chunks = store.get_chunks_data(["4", "5", "6"], with_embeddings=True)
+
+    assert [(chunk.data, chunk.chunk_number, chunk.page_index) for chunk in chunks] == [("One", 0, None), ("Two", 1, None), ("Three", 2, None)]
+    assert np.allclose(np.stack([chunk.embeddings for chunk in chunks]), vectors)
+    assert not os.path.exists(os.path.join(store.directory, METADATA_FILE))
+    assert insert_vectors(store, unit_vectors(rng, 1)) == [7]
+
+
+def test_deletes_leave_the_state_searches_read_as_is(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    ids = insert_vectors(store, unit_vectors(rng, 10))
+    searched_state = store.state
+
+    store.delete_chunks(ids[:2])
+
+    # A search that started before the delete sees every row, the next ones do not see the deleted rows
+    assert not searched_state.deleted.any()
+    assert store.state.deleted.sum() == 2
+    assert len(store.search_similar_chunk_ids(unit_vectors(rng, 1), limit=10)[0]) == 8
+
+
+def test_writes_wait_for_the_lock_without_blocking_the_server(knowledge_base_id, rng):
+    store = create_store(knowledge_base_id)
+    ids = insert_vectors(store, unit_vectors(rng, 10))
+    ticks = []
+    locked = threading.Event()
+
+    def hold_store_lock():
+        with hold_lock(store.lock):
+            locked.set()
+            time.sleep(0.2)
+
+    def tick():
+        while store.lock.lock.locked():
+            ticks.append(time.monotonic())
+            socketio.sleep(0.01)
+
+    # A write from another thread holds the lock while a request deletes chunks on the server
+    writer = threading.Thread(target=hold_store_lock)
+    writer.start()
+    locked.wait()
+
+    socketio.start_background_task(tick)
+    store.delete_chunks(ids[:1])
+    writer.join()
+
+    assert len(ticks) > 5 and store.state.deleted.sum() == 1
@@ -0,0 +1,42 @@
+import re
+
+from migrations import chunk_fields
+from migrations.chunk_fields import invalidate_cached_answers, knowledge_base_id_of
+from services.milvus_embeddings_store import MAX_QUERY_ROWS, query_pages
+
+
+class PagedCollection:
+    # Answers "id > n" queries with the smallest ids first, and refuses result windows larger than Milvus does
+    def __init__(self, ids: list[int]):
+        self.ids = ids
+        self.limits: list[int] = []
+
+    def query(self, expr: str, output_fields: list[str], limit: int) -> list[dict]:
+        assert limit <= MAX_QUERY_ROWS
+        self.limits.append(limit)
+        last_id = int(re.fullmatch(r"id > (-?\d+)", expr).group(1))
+
+        return [{'id': id} for id in sorted(id for id in self.ids if id > last_id)[:limit]]
+
+
+def test_collections_are_read_by_pages_of_ids():
+    ids = list(range(1, 40000, 2))
+    collection = PagedCollection(list(reversed(ids)))
+
+    pages = list(query_pages(collection, ['id'], batch_size=100000))
+
+    assert [row['id'] for page in pages for row in page] == ids
+    assert set(collection.limits) == {MAX_QUERY_ROWS}
+
+
+def test_cached_answers_of_migrated_knowledge_bases_are_dropped(monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(chunk_fields.answer_cache, 'invalidate', invalidated.append)
+    knowledge_base_id = "0f8fad5b-d9cb-469f-a165-70867728950e"
+
+    invalidate_cached_answers("_" + knowledge_base_id.replace("-", "_"), {})
+    invalidate_cached_answers("_named_base", {"_named_base": "named-base"})
+    invalidate_cached_answers("_unknown_base", {})
+
+    assert invalidated == [knowledge_base_id, "named-base"]
+    assert knowledge_base_id_of("_unknown_base", {}) is None
@@ -0,0 +1,56 @@
+import threading
+import time
+
+from services.milvus_embeddings_store import MilvusFlushScheduler
+
+
+class RecordingCollection:
+    def __init__(self):
+        self.flushed = threading.Event()
+        self.flushes = 0
+
+        self.flush_threads: list[str] = []
+
+    def flush(self):
+        self.flushes += 1
+        self.flush_threads.append(threading.current_thread().name)
+        self.flushed.set()
+
+
+class RecordingStore:
+    # Stands for a CollectionEmbeddingsStore, the scheduler only flushes its collection and tunes its index
+    def __init__(self, collection_name: str):
+        self.collection_name = collection_name
+        self.collection = RecordingCollection()
+        self.tuned = 0
+
+    def tune_index(self):
+        self.tuned += 1
+
+
+def test_pending_inserts_are_flushed_after_the_flush_interval():
+    scheduler = MilvusFlushScheduler(flush_interval=0.05, max_unflushed_rows=1000)
+    store = RecordingStore("knowledge_base")
+    start_time = time.monotonic()
+
+    scheduler.record_insert(store, 10)
+
+    assert store.collection.flushed.wait(timeout=5)
+    assert time.monotonic() - start_time >= 0.05
+    assert store.collection.flushes == 1 and store.tuned == 1
+    assert scheduler.stores == {} and scheduler.unflushed_rows == {}
+
+
+def test_collections_are_flushed_right_away_past_max_unflushed_rows():
+    scheduler = MilvusFlushScheduler(flush_interval=60, max_unflushed_rows=100)
+    store = RecordingStore("knowledge_base")
+
+    scheduler.record_insert(store, 60)
+    assert not store.collection.flushed.wait(timeout=0.05)
+
+    scheduler.record_insert(store, 60)
+
+    # The flusher is woken up, the inserting thread neither flushes nor tunes the index itself
+    assert store.collection.flushed.wait(timeout=5)
+    assert store.collection.flush_threads == ['milvus-flusher'] and store.tuned == 1
+    assert scheduler.unflushed_rows == {} and scheduler.due == set()
@@ -0,0 +1,225 @@
+import re
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+from typing import Callable, Optional
+
+from api.server_application import socketio
+from services import milvus_embeddings_store
+from services.answer_cache import answer_cache
+from services.embeddings_store import ID_FIELD
+from services.lexical_index import LexicalChunk, lexical_indexes
+from services.llm_event_loop import YieldingLock, hold_lock, wait_for_future
+from services.milvus_embeddings_store import INSERT_FIELDS, CollectionEmbeddingsStore
+from tests.utils import make_chunk, unit_vectors
+
+
+class FakeCollection:
+    # Stands for a Milvus collection with auto ids, and records the index calls made to it. Index builds take
+    # build_time seconds, during which the on_build of the server is called
+    def __init__(self, server: 'FakeMilvus', name: str):
+        self.server = server
+        self.name = name
+        self.rows: dict[int, dict] = {}
+        self.index_params = {'index_type': "FLAT", 'metric_type': "IP", 'params': {}}
+        self.entities_per_row = 1
+        self.build_time = 0.0
+        self.calls: list[str] = []
+        self.schema = None
+
+    @property
+    def num_entities(self) -> int:
+        return len(self.rows) * self.entities_per_row
+
+    def index(self) -> SimpleNamespace:
+        return SimpleNamespace(params=self.index_params)
+
+    def release(self):
+        self.calls.append('release')
+
+    def drop_index(self):
+        self.calls.append('drop_index')
+
+    def create_index(self, field_name: str, index_params: dict):
+        time.sleep(self.build_time)
+
+        if self.server.on_build is not None:
+            self.server.on_build()
+
+        self.calls.append(f"create_index {index_params['index_type']}")
+        self.index_params = index_params
+
+    def load(self):
+        self.calls.append('load')
+
+    def flush(self):
+        pass
+
+    def insert(self, columns: list[list]) -> SimpleNamespace:
+        ids = list(range(self.server.next_id, self.server.next_id + len(columns[0])))
+        self.server.next_id += len(ids)
+        self.rows.update((id, {**dict(zip(INSERT_FIELDS, values)), ID_FIELD: id}) for id, values in zip(ids, zip(*columns)))
+
+        return SimpleNamespace(primary_keys=ids)
+
+    def matches(self, expr: str) -> list[int]:
+        if expr.startswith(f"{ID_FIELD} > "):
+            return sorted(id for id in self.rows if id > int(expr.split(" > ")[1]))
+
+        return [id for id in (int(id) for id in re.findall(r"\d+", expr)) if id in self.rows]
+
+    def query(self, expr: str, output_fields: list[str], limit: Optional[int] = None) -> list[dict]:
+        return [{field: self.rows[id][field] for field in output_fields + [ID_FIELD]} for id in self.matches(expr)[:limit]]
+
+    def delete(self, expr: str):
+        for id in self.matches(expr):
+            del self.rows[id]
+
+
+class FakeMilvus:
+    # The collections of a Milvus server by name, stands for both pymilvus.Collection and pymilvus.utility
+    def __init__(self):
+        self.collections: dict[str, FakeCollection] = {}
+        self.next_id = 1
+        self.on_build: Optional[Callable[[], None]] = None
+
+    def Collection(self, name: str, schema=None, **options) -> FakeCollection:
+        return self.collections.setdefault(name, FakeCollection(self, name))
+
+    def has_collection(self, name: str) -> bool:
+        return name in self.collections
+
+    def drop_collection(self, name: str):
+        del self.collections[name]
+
+    def rename_collection(self, old_name: str, new_name: str):
+        collection = self.collections[new_name] = self.collections.pop(old_name)
+        collection.name = new_name
+
+
+def indexed_store(monkeypatch, knowledge_base_id: str, entities_per_row: int, loaded: bool) -> CollectionEmbeddingsStore:
+    server = FakeMilvus()
+    monkeypatch.setattr(milvus_embeddings_store, 'Collection', server.Collection)
+    monkeypatch.setattr(milvus_embeddings_store, 'utility', server)
+    monkeypatch.setattr(milvus_embeddings_store.flush_scheduler, 'record_insert', lambda store, rows: None)
+
+    store = CollectionEmbeddingsStore(knowledge_base_id)
+    store.collection = server.Collection(store.collection_name)  # type: ignore[assignment]
+    store.collection.entities_per_row = entities_per_row
+    store.index = {'index_type': "FLAT", 'params': {}, 'metric_type': "IP"}
+    store.indexed = True
+    store.loaded = loaded
+
+    return store
+
+
+def insert_texts(store: CollectionEmbeddingsStore, texts: list[str], rng) -> list[int]:
+    vectors = unit_vectors(rng, len(texts))
+
+    return store.insert_resource_chunks([make_chunk(text, i, len(texts), embeddings=vectors[i]) for i, text in enumerate(texts)])
+
+
+def test_index_is_not_rebuilt_while_its_profile_fits(monkeypatch, knowledge_base_id, rng):
+    store = indexed_store(monkeypatch, knowledge_base_id, entities_per_row=1, loaded=True)
+    insert_texts(store, ["First", "Second"], rng)
+
+    store.tune_index()
+
+    assert store.collection.calls == []
+
+
+def test_released_collections_are_rebuilt_in_place_once(monkeypatch, knowledge_base_id, rng):
+    store = indexed_store(monkeypatch, knowledge_base_id, entities_per_row=50000, loaded=False)
+    insert_texts(store, ["First", "Second"], rng)
+    ids = sorted(store.collection.rows)
+
+    store.tune_index()
+    store.tune_index()
+
+    assert store.collection.calls == ['drop_index', "create_index IVF_FLAT"]
+    assert store.index['index_type'] == "IVF_FLAT" and sorted(store.collection.rows) == ids
+
+
+def test_searches_wait_for_a_rebuild_in_place_without_blocking_the_server(monkeypatch, knowledge_base_id, rng):
+    store = indexed_store(monkeypatch, knowledge_base_id, entities_per_row=50000, loaded=False)
+    insert_texts(store, ["First", "Second"], rng)
+    store.collection.build_time = 0.2
+    ticks = []
+    done = threading.Event()
+
+    def tick():
+        while not done.is_set():
+            ticks.append(time.monotonic())
+            socketio.sleep(0.01)
+
+    # The flusher rebuilds from a thread of its own while a request loads the collection on the server
+    rebuild = threading.Thread(target=store.tune_index)
+    rebuild.start()
+
+    while 'drop_index' not in store.collection.calls:
+        time.sleep(0.001)
+
+    socketio.start_background_task(tick)
+    store.ensure_loaded()
+    done.set()
+    rebuild.join()
+
+    assert len(ticks) > 5
+    assert store.loaded and store.collection.calls == ['drop_index', "create_index IVF_FLAT", 'load']
+
+
+def test_loaded_collections_stay_online_while_rebuilt_on_a_copy(monkeypatch, knowledge_base_id, rng):
+    store = indexed_store(monkeypatch, knowledge_base_id, entities_per_row=50000, loaded=True)
+    live_collection = store.collection
+    texts = ["First", "Second", "Third"]
+    ids = insert_texts(store, texts, rng)
+    lexical_indexes.get_index(knowledge_base_id).replace_resources(["manual"], [LexicalChunk(id, "manual", text) for id, text in zip(ids, texts)])
+    version = answer_cache.version(knowledge_base_id)
+
+    def write_while_building():
+        # The live collection is searched and written to while its copy is indexed
+        assert [chunk.data for chunk in store.get_chunks_data([str(id) for id in ids])] == texts
+        insert_texts(store, ["Fourth"], rng)
+        store.delete_chunks([ids[0]])
+
+    milvus_embeddings_store.utility.on_build = write_while_building
+
+    store.tune_index()
+
+    # The live collection was never released nor reindexed, the copy took its name with the writes made meanwhile
+    assert live_collection.calls == []
+    assert store.collection.name == store.collection_name and store.collection.calls == ["create_index IVF_FLAT", 'load']
+    assert sorted(row['data'] for row in store.collection.rows.values()) == ["Fourth", "Second", "Third"]
+    assert list(milvus_embeddings_store.utility.collections) == [store.collection_name]
+    assert store.index['index_type'] == "IVF_FLAT" and store.rebuild is None
+
+    # Copied chunks have new ids, the lexical index refers to them and cached answers citing the old ones are dropped
+    lexical_ids = [id for id, _ in lexical_indexes.get_index(knowledge_base_id).search("second third", 10)]
+    assert sorted(store.collection.rows[id]['data'] for id in lexical_ids) == ["Second", "Third"]
+    assert answer_cache.version(knowledge_base_id) > version
+
+
+def test_hold_lock_releases_the_lock():
+    lock = YieldingLock()
+
+    with hold_lock(lock):
+        assert lock.lock.locked()
+
+    assert not lock.lock.locked()
+
+
+def test_futures_set_by_threads_wake_their_waiter_without_blocking_the_server():
+    future: 'Future[str]' = Future()
+    ticks = []
+
+    def tick():
+        while not future.done():
+            ticks.append(time.monotonic())
+            socketio.sleep(0.01)
+
+    threading.Timer(0.2, future.set_result, args=("Answer",)).start()
+    socketio.start_background_task(tick)
+
+    assert wait_for_future(future, timeout=5) == "Answer"
+    assert len(ticks) > 5
@@ -0,0 +1,210 @@
+import re
+from concurrent.futures import Future
+from typing import Any, NamedTuple
+
+import numpy as np
+import pytest
+
+from services import milvus_embeddings_store, resource_ingestion
+from services.embeddings_store_registry import embeddings_stores
+from services.embeddings_store import ID_FIELD
+from services.lexical_index import lexical_indexes
+from services.milvus_embeddings_store import INSERT_FIELDS, CollectionEmbeddingsStore
+from services.resource_ingestion import chunk_content_hash, diff_resource_chunks, ingest_resources, write_resource_rows
+from tests.utils import make_chunk, unit_vectors
+
+
+class RecordingEmbeddingsCalculator:
+    # Embeds texts with random vectors and records every text it was asked for
+    embedded_documents: list[str] = []
+
+    def embed_documents(self, documents: list[str]) -> np.ndarray:
+        RecordingEmbeddingsCalculator.embedded_documents += documents
+
+        return unit_vectors(np.random.default_rng(len(RecordingEmbeddingsCalculator.embedded_documents)), len(documents))
+
+
+@pytest.fixture(autouse=True)
+def embeddings_calculator(monkeypatch) -> type[RecordingEmbeddingsCalculator]:
+    RecordingEmbeddingsCalculator.embedded_documents = []
+    monkeypatch.setattr(resource_ingestion, 'EmbeddingsCalculator', RecordingEmbeddingsCalculator)
+
+    return RecordingEmbeddingsCalculator
+
+
+class InMemoryCollection:
+    # Stands for a Milvus collection with auto ids, for the inserts, deletes and queries of the store
+    def __init__(self):
+        self.rows: dict[int, dict] = {}
+        self.next_id = 1
+
+    def insert(self, columns: list[list]):
+        rows = [dict(zip(INSERT_FIELDS, values)) for values in zip(*columns)]
+        ids = list(range(self.next_id, self.next_id + len(rows)))
+        self.next_id += len(rows)
+        self.rows.update((id, {**row, ID_FIELD: id}) for id, row in zip(ids, rows))
+
+        return type('MutationResult', (), {'primary_keys': ids})
+
+    def matches(self, expr: str) -> list[int]:
+        if expr.startswith(f"{ID_FIELD} in "):
+            ids = {int(id) for id in re.findall(r"\d+", expr)}
+            return [id for id in self.rows if id in ids]
+
+        resource_id = re.fullmatch(r'resource_id == "(.*)"', expr).group(1)
+        return [id for id, row in self.rows.items() if row['resource_id'] == resource_id]
+
+    def delete(self, expr: str):
+        for id in self.matches(expr):
+            del self.rows[id]
+
+    def query(self, expr: str, output_fields: list[str]) -> list[dict]:
+        return [{field: self.rows[id][field] for field in output_fields + [ID_FIELD]} for id in self.matches(expr)]
+
+
+def resource_rows(texts: list[str], resource_id: str = "manual") -> list:
+    return [make_chunk(text, i, len(texts), resource_id, content_hash=chunk_content_hash(text)) for i, text in enumerate(texts)]
+
+
+def stored_chunks(texts: list[str]) -> list:
+    return [chunk.copy(id=100 + i) for i, chunk in enumerate(resource_rows(texts))]
+
+
+def test_diff_matches_chunks_on_their_text_only():
+    rows_to_insert, kept_chunks, ids_to_delete = diff_resource_chunks(stored_chunks(["a", "b", "c"]), resource_rows(["new", "a", "b"]))
+
+    assert [row.data for row in rows_to_insert] == ["new"]
+    # Every chunk after the new one moved, and is kept with its stored id and its new position
+    assert [(chunk.id, chunk.data, chunk.chunk_number) for chunk in kept_chunks] == [(100, "a", 1), (101, "b", 2)]
+    assert ids_to_delete == [102]
+
+
+def test_diff_matches_repeated_texts_one_to_one():
+    rows_to_insert, kept_chunks, ids_to_delete = diff_resource_chunks(stored_chunks(["a", "a"]), resource_rows(["a", "a", "a"]))
+
+    assert [row.data for row in rows_to_insert] == ["a"]
+    assert [chunk.id for chunk in kept_chunks] == [100, 101]
+    assert ids_to_delete == []
+
+
+def test_diff_never_keeps_chunks_stored_without_a_hash():
+    chunks = [chunk.copy(content_hash="") for chunk in stored_chunks(["a"])]
+    rows_to_insert, kept_chunks, ids_to_delete = diff_resource_chunks(chunks, resource_rows(["a"]))
+
+    assert [row.data for row in rows_to_insert] == ["a"]
+    assert kept_chunks == []
+    assert ids_to_delete == [100]
+
+
+def test_reassimilating_only_embeds_new_chunks_and_keeps_ids(knowledge_base_id, embeddings_calculator, override_settings):
+    override_settings('ingestion.incremental_updates', True)
+    store = embeddings_stores.get_store(knowledge_base_id, create_index=True)
+    texts = [f"Paragraph {i} of the manual" for i in range(10)]
+
+    write_resource_rows(knowledge_base_id, store, {"manual": resource_rows(texts)}, 4)
+    ids_by_text = {chunk.data: chunk.id for chunk in store.get_resource_chunks_metadata("manual")}
+    embeddings_calculator.embedded_documents = []
+
+    # A paragraph is added at the start and the last one is removed, every other chunk moves by one
+    write_resource_rows(knowledge_base_id, store, {"manual": resource_rows(["A new introduction"] + texts[:-1])}, 4)
+
+    assert embeddings_calculator.embedded_documents == ["A new introduction"]
+
+    chunks = {chunk.data: chunk for chunk in store.get_resource_chunks_metadata("manual")}
+
+    assert len(chunks) == 10 and texts[-1] not in chunks
+    assert all(chunks[text].id == ids_by_text[text] for text in texts[:-1])
+    assert [(chunks[text].chunk_number, chunks[text].total_chunks) for text in texts[:2]] == [(1, 10), (2, 10)]
+
+    lexical_ids = [id for id, _ in lexical_indexes.get_index(knowledge_base_id).search("paragraph manual", 20)]
+    assert sorted(lexical_ids) == sorted(ids_by_text[text] for text in texts[:-1])
+
+
+def test_rewriting_several_resources_without_incremental_updates(knowledge_base_id, embeddings_calculator, override_settings):
+    override_settings('ingestion.incremental_updates', False)
+    store = embeddings_stores.get_store(knowledge_base_id, create_index=True)
+    rows = {"first": resource_rows(["One", "Two"], "first"), "second": resource_rows(["Three"], "second")}
+
+    write_resource_rows(knowledge_base_id, store, rows, 2)
+    write_resource_rows(knowledge_base_id, store, {"first": resource_rows(["One", "Two"], "first")}, 2)
+
+    # Every chunk is embedded again, and only the chunks of the rewritten resource are replaced
+    assert embeddings_calculator.embedded_documents == ["One", "Two", "Three", "One", "Two"]
+    assert sorted(chunk.data for chunk in store.get_resource_chunks_metadata("first")) == ["One", "Two"]
+    assert len(store.get_resource_chunks_metadata("second")) == 1
+
+
+def test_reassimilating_into_milvus_rewrites_positions(knowledge_base_id, embeddings_calculator, override_settings, monkeypatch):
+    override_settings('ingestion.incremental_updates', True)
+    monkeypatch.setattr(milvus_embeddings_store.flush_scheduler, 'record_insert', lambda store, rows: None)
+    store = CollectionEmbeddingsStore(knowledge_base_id)
+    store.collection = InMemoryCollection()  # type: ignore[assignment]
+    store.indexed = store.loaded = True
+    texts = [f"Paragraph {i} of the manual" for i in range(6)]
+
+    write_resource_rows(knowledge_base_id, store, {"manual": resource_rows(texts)}, 4)
+    embeddings_by_text = {chunk.data: chunk.embeddings for chunk in store.get_chunks_data([str(id) for id in store.collection.rows], with_embeddings=True)}
+    embeddings_calculator.embedded_documents = []
+
+    # A paragraph is inserted in the middle and the first one is removed
+    new_texts = texts[1:3] + ["An inserted paragraph"] + texts[3:]
+    write_resource_rows(knowledge_base_id, store, {"manual": resource_rows(new_texts)}, 4)
+
+    assert embeddings_calculator.embedded_documents == ["An inserted paragraph"]
+
+    chunks = sorted(store.get_chunks_data([str(id) for id in store.collection.rows], with_embeddings=True), key=lambda chunk: chunk.chunk_number)
+
+    assert [(chunk.data, chunk.chunk_number, chunk.total_chunks) for chunk in chunks] == [(text, i, 6) for i, text in enumerate(new_texts)]
+    assert [chunk.percentage_in for chunk in chunks] == [i / 6 for i in range(6)]
+    assert all(np.array_equal(chunk.embeddings, embeddings_by_text[chunk.data]) for chunk in chunks if chunk.data in embeddings_by_text)
+
+    # The lexical index refers to the ids the chunks have now
+    lexical_ids = [id for id, _ in lexical_indexes.get_index(knowledge_base_id).search("paragraph", 20)]
+    assert sorted(lexical_ids) == sorted(chunk.id for chunk in chunks)
+
+
+class Page(NamedTuple):
+    page_content: str
+    metadata: dict[str, Any]
+
+
+class CountingPool:
+    # Parses right away, and counts the files submitted but not yet collected
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def submit(self, function, file_path: str, mimetype: str) -> Future:
+        pool = self
+
+        class CollectedFuture(Future):
+            def result(self, timeout=None):
+                pool.in_flight -= 1
+                return super().result(timeout)
+
+        future = CollectedFuture()
+        future.set_result([Page(f"Chunk {i} of {file_path}", {}) for i in range(3)])
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        return future
+
+
+def test_bulk_ingestion_bounds_the_files_in_flight(knowledge_base_id, embeddings_calculator, override_settings, monkeypatch):
+    override_settings('ingestion.max_parsing_files_in_flight', 2)
+    override_settings('ingestion.bulk_batch_size', 4)
+    pool = CountingPool()
+    monkeypatch.setattr(resource_ingestion, 'get_pool', lambda workload: pool)
+    resources = [
+        {'resource_id': f"file-{i}", 'resource_name': f"file-{i}.txt", 'mimetype': 'text/plain', 'file_path': f"file-{i}.txt"}
+        for i in range(7)
+    ]
+
+    results = ingest_resources(knowledge_base_id, resources)  # type: ignore[arg-type]
+
+    assert pool.max_in_flight == 2 and pool.in_flight == 0
+    assert [result['total_chunks'] for result in results.values()] == [3] * 7
+    assert len(embeddings_calculator.embedded_documents) == 21
+
+    store = embeddings_stores.get_store(knowledge_base_id)
+    assert all(len(store.get_resource_chunks_metadata(f"file-{i}")) == 3 for i in range(7))
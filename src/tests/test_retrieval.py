@@ -0,0 +1,63 @@
+import numpy as np
+
+from services.embeddings_store_registry import embeddings_stores
+from services.lexical_index import LexicalChunk, lexical_indexes
+from services.retrieval import reciprocal_rank_fusion, search_chunks, search_chunks_batch
+from tests.utils import make_chunk, unit_vectors
+
+
+def test_reciprocal_rank_fusion():
+    # 1: 1/61 + 1/63, 2: 1/62 + 1/61, 3: 1/63, 4: 1/62
+    assert reciprocal_rank_fusion([[1, 2, 3], [2, 4, 1]], k=60) == [2, 1, 4, 3]
+
+
+def test_reciprocal_rank_fusion_keeps_the_order_of_a_single_ranking():
+    assert reciprocal_rank_fusion([[5, 3, 9], []]) == [5, 3, 9]
+
+
+def create_knowledge_base(knowledge_base_id: str, rng: np.random.Generator) -> tuple[list[int], np.ndarray]:
+    texts = [f"General guidance number {i} about the device" for i in range(30)] + ["Error ERR-1042 means the tray is empty"]
+    vectors = unit_vectors(rng, len(texts))
+    store = embeddings_stores.get_store(knowledge_base_id, create_index=True)
+    ids = store.insert_resource_chunks([make_chunk(text, i, len(texts), embeddings=vector) for i, (text, vector) in enumerate(zip(texts, vectors))])
+
+    lexical_indexes.get_index(knowledge_base_id).replace_resources(["manual"], [LexicalChunk(id, "manual", text) for id, text in zip(ids, texts)])
+
+    return ids, vectors
+
+
+def test_hybrid_search_adds_chunks_only_found_lexically(knowledge_base_id, rng, override_settings):
+    override_settings('retrieval.mode', 'hybrid')
+    ids, vectors = create_knowledge_base(knowledge_base_id, rng)
+
+    # The query embedding is the one of the first chunk, the code only appears in the last one
+    results = search_chunks(knowledge_base_id, "ERR-1042", vectors[0], limit=3)
+    similarities = {chunk.id: similarity for chunk, similarity in results}
+
+    assert len(results) == 3
+    assert ids[0] in similarities and ids[-1] in similarities
+    assert abs(similarities[ids[-1]] - float(vectors[-1] @ vectors[0])) < 1e-5
+    assert all(chunk.embeddings is None for chunk, _ in results)
+
+
+def test_vector_search_ignores_the_lexical_index(knowledge_base_id, rng, override_settings):
+    override_settings('retrieval.mode', 'vector')
+    ids, vectors = create_knowledge_base(knowledge_base_id, rng)
+
+    results = search_chunks(knowledge_base_id, "ERR-1042", vectors[0], limit=3)
+
+    assert [chunk.id for chunk, _ in results] == [ids[row] for row in np.argsort(-(vectors @ vectors[0]))[:3]]
+
+
+def test_batch_search_matches_single_searches(knowledge_base_id, rng, override_settings):
+    override_settings('retrieval.mode', 'hybrid')
+    _, vectors = create_knowledge_base(knowledge_base_id, rng)
+    queries = ["ERR-1042", "device guidance"]
+
+    batch_results = search_chunks_batch(knowledge_base_id, queries, vectors[:2], limit=4)
+
+    for query, query_embedding, results in zip(queries, vectors[:2], batch_results):
+        expected = search_chunks(knowledge_base_id, query, query_embedding, limit=4)
+
+        assert [chunk.id for chunk, _ in results] == [chunk.id for chunk, _ in expected]
+        assert np.allclose([similarity for _, similarity in results], [similarity for _, similarity in expected], atol=1e-5)
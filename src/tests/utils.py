@@ -0,0 +1,35 @@
+from typing import Optional
+
+import numpy as np
+
+from config import settings
+from services.embeddings_store import ResourceChunkInfo
+
+
+def unit_vectors(rng: np.random.Generator, count: int) -> np.ndarray:
+    vectors = rng.standard_normal((count, settings.database.embedding_size)).astype(np.float32)
+
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_chunk(
+    data: str,
+    chunk_number: int = 0,
+    total_chunks: int = 1,
+    resource_id: str = "manual",
+    embeddings: Optional[np.ndarray] = None,
+    content_hash: str = ""
+) -> ResourceChunkInfo:
+    return ResourceChunkInfo(
+        id=None,
+        resource_name=f"{resource_id}.txt",
+        resource_id=resource_id,
+        data=data,
+        chunk_number=chunk_number,
+        total_chunks=total_chunks,
+        percentage_in=chunk_number / total_chunks,
+        page_index=None,
+        resource_mimetype='text/plain',
+        content_hash=content_hash,
+        embeddings=embeddings
+    )